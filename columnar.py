@@ -0,0 +1,267 @@
+import json
+import os
+import shutil
+import sys
+import time
+from array import array
+from typing import Dict, Iterable, List, Sequence
+from constants import CATEGORIES
+from init_db import DATABASE_NAME, create_connection
+from templates import KIGALI_OFFSET, MATCHERS, TABLE_COLUMNS
+
+try:
+    import numpy
+except ImportError:  # Only needed to read the columns back
+    numpy = None
+
+COLUMNAR_DIR = 'data/columnar'
+
+# Rows buffered per partition before they are appended to the column files
+FLUSH_ROWS = 65_536
+
+# Template field type -> column encoding:
+#   int64:      the value as a little-endian int64
+#   timestamp:  Unix epoch seconds, taken from the record's ts column
+#   dictionary: int32 codes into a per-table list of distinct values
+# Account ids ('id') are text: they can have leading zeros or non-digits.
+COLUMN_ENCODINGS = {
+    'txid': 'int64',
+    'id': 'dictionary',
+    'int': 'int64',
+    'money': 'int64',
+    'timestamp': 'timestamp',
+    'phone': 'dictionary',
+    'ref': 'dictionary',
+    'text': 'dictionary',
+}
+
+# Encoding -> (array typecode, NumPy dtype)
+ENCODING_TYPES = {
+    'int64': ('q', '<i8'),
+    'timestamp': ('q', '<i8'),
+    'dictionary': ('i', '<i4'),
+}
+
+# Written in place of missing values
+NULL_INT64 = -2 ** 63
+NULL_CODE = -1
+
+
+def column_encodings(table: str) -> Dict[str, str]:
+    """Maps each column of a table to its encoding, in column order. A key
+    derived from the natural key comes last, so that exports can be joined
+    back to the database."""
+    encodings = {}
+    for _, fields in MATCHERS[table]:
+        for field, field_type in fields:
+            encodings.setdefault(field, COLUMN_ENCODINGS[field_type])
+    if CATEGORIES[table]['natural_key']:
+        encodings[CATEGORIES[table]['key']] = COLUMN_ENCODINGS['txid']
+    return encodings
+
+
+def column_positions(table: str) -> Dict[str, int]:
+    """
+    Locates the value of each encoded column within a record.
+
+    Records hold their values in templates.TABLE_COLUMNS order. Timestamp
+    columns are read from ts, which already holds them as epoch seconds.
+    """
+    columns = TABLE_COLUMNS[table]
+    return {column: columns.index('ts' if encoding == 'timestamp' else column)
+            for column, encoding in column_encodings(table).items()}
+
+
+def month_of(ts: int, cache: Dict[int, str]) -> str:
+    """Formats epoch seconds as the 'YYYY-MM' of their Kigali date."""
+    local_time = ts + KIGALI_OFFSET
+    day = local_time // 86_400
+    if day not in cache:
+        cache[day] = time.strftime('%Y-%m', time.gmtime(local_time))
+    return cache[day]
+
+
+def write_columns(table: str, records: Iterable[Sequence], directory: str = COLUMNAR_DIR) -> int:
+    """
+    Writes the records of a category as typed, fixed-width columns.
+
+    The export is laid out as <directory>/<table>/<YYYY-MM>/<column>.bin, one
+    partition per month of the record date, plus a meta.json holding the
+    column encodings, the row count of each partition and the dictionaries.
+    It is built next to its destination and swapped in once complete.
+
+    Args:
+        table (str): The category (a key of constants.CATEGORIES).
+        records (Iterable[Sequence]): The records, with their values in
+            templates.TABLE_COLUMNS order: templates.RECORD_TYPES tuples or
+            rows of the category table. Records without a ts are skipped.
+        directory (str): The root of the columnar export.
+
+    Returns:
+        int: The number of records written.
+    """
+    encodings = column_encodings(table)
+    positions = column_positions(table)
+    ts_index = TABLE_COLUMNS[table].index('ts')
+    months = {}
+    dictionaries = {column: {} for column, encoding in encodings.items()
+                    if encoding == 'dictionary'}
+    partitions = {}
+    buffers = {}
+    destination = os.path.join(directory, table)
+    temp_destination = destination + '.tmp'
+
+    def encode(column, value):
+        encoding = encodings[column]
+        if value is None:
+            return NULL_CODE if encoding == 'dictionary' else NULL_INT64
+        if encoding == 'dictionary':
+            return dictionaries[column].setdefault(value, len(dictionaries[column]))
+        return int(value)
+
+    def flush(month):
+        os.makedirs(os.path.join(temp_destination, month), exist_ok=True)
+        for column, values in buffers.pop(month).items():
+            if sys.byteorder != 'little':
+                values.byteswap()
+            with open(os.path.join(temp_destination, month, column + '.bin'), 'ab') as f:
+                values.tofile(f)
+
+    shutil.rmtree(temp_destination, ignore_errors=True)
+    os.makedirs(temp_destination)
+
+    count = 0
+    for record in records:
+        if record[ts_index] is None:
+            continue
+        month = month_of(record[ts_index], months)
+        if month not in buffers:
+            buffers[month] = {column: array(ENCODING_TYPES[encoding][0])
+                              for column, encoding in encodings.items()}
+        for column, position in positions.items():
+            buffers[month][column].append(encode(column, record[position]))
+        partitions[month] = partitions.get(month, 0) + 1
+        count += 1
+        if len(buffers[month]['date']) >= FLUSH_ROWS:
+            flush(month)
+
+    for month in list(buffers):
+        flush(month)
+
+    metadata = {
+        'table': table,
+        'columns': [{'name': column, 'encoding': encoding,
+                     'dtype': ENCODING_TYPES[encoding][1]}
+                    for column, encoding in encodings.items()],
+        'partitions': dict(sorted(partitions.items())),
+        'dictionaries': {column: list(values) for column, values in dictionaries.items()},
+    }
+    with open(os.path.join(temp_destination, 'meta.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    shutil.rmtree(destination, ignore_errors=True)
+    os.replace(temp_destination, destination)
+    return count
+
+
+def export_database(database: str = DATABASE_NAME, directory: str = COLUMNAR_DIR) -> Dict[str, int]:
+    """
+    Exports every category table of the database to the columnar format.
+
+    Args:
+        database (str): The database to export.
+        directory (str): The root of the columnar export.
+
+    Returns:
+        Dict[str, int]: Table name -> number of records written.
+    """
+    counts = {}
+    with create_connection(database) as conn:
+        for table in CATEGORIES:
+            columns = ', '.join(TABLE_COLUMNS[table])
+            rows = conn.execute(f"SELECT {columns} FROM {table} ORDER BY ts")
+            counts[table] = write_columns(table, rows, directory)
+            print(f"Exported {counts[table]} records of {table} to "
+                  f"{os.path.join(directory, table)}")
+    return counts
+
+
+def require_numpy():
+    """Raises ImportError when NumPy, needed by the readers, is missing."""
+    if numpy is None:
+        raise ImportError("Reading columnar exports requires NumPy (pip install numpy)")
+
+
+def read_metadata(table: str, directory: str = COLUMNAR_DIR) -> Dict:
+    """Reads the meta.json of a category's columnar export."""
+    with open(os.path.join(directory, table, 'meta.json')) as f:
+        return json.load(f)
+
+
+def read_partition(table: str, month: str, directory: str = COLUMNAR_DIR,
+                   metadata: Dict | None = None) -> Dict[str, 'numpy.ndarray']:
+    """
+    Memory-maps the columns of one month of a category.
+
+    Nothing is copied or parsed: each array is a read-only view of its file.
+    Dictionary columns hold codes; decode them with read_metadata()'s
+    'dictionaries', e.g. numpy.array(dictionary)[codes].
+
+    Args:
+        table (str): The category (a key of constants.CATEGORIES).
+        month (str): The partition, as 'YYYY-MM'.
+        directory (str): The root of the columnar export.
+        metadata (Dict | None): The output of read_metadata(), if already read.
+
+    Returns:
+        Dict[str, numpy.ndarray]: Column name -> values.
+    """
+    require_numpy()
+    metadata = metadata or read_metadata(table, directory)
+    rows = metadata['partitions'].get(month, 0)
+    columns = {}
+    for column in metadata['columns']:
+        path = os.path.join(directory, table, month, column['name'] + '.bin')
+        if rows:
+            columns[column['name']] = numpy.memmap(path, dtype=column['dtype'],
+                                                   mode='r', shape=(rows,))
+        else:
+            columns[column['name']] = numpy.empty(0, dtype=column['dtype'])
+    return columns
+
+
+def read_table(table: str, months: List[str] | None = None,
+               directory: str = COLUMNAR_DIR) -> Dict[str, 'numpy.ndarray']:
+    """
+    Reads several months of a category (by default all of them).
+
+    A single month is returned as its memory maps; several months are
+    concatenated, which copies them into memory.
+
+    Args:
+        table (str): The category (a key of constants.CATEGORIES).
+        months (List[str] | None): The partitions to read, as 'YYYY-MM'.
+        directory (str): The root of the columnar export.
+
+    Returns:
+        Dict[str, numpy.ndarray]: Column name -> values, in date order.
+    """
+    require_numpy()
+    metadata = read_metadata(table, directory)
+    months = sorted(metadata['partitions']) if months is None else months
+    partitions = [read_partition(table, month, directory, metadata) for month in months]
+    if len(partitions) == 1:
+        return partitions[0]
+
+    return {column['name']: numpy.concatenate(
+                [partition[column['name']] for partition in partitions]
+                or [numpy.empty(0, dtype=column['dtype'])])
+            for column in metadata['columns']}
+
+
+def main():
+    export_database()
+
+
+if __name__ == "__main__":
+    main()
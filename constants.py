@@ -1,23 +1,141 @@
-TABLE_CONFIG = {
-    'incoming_money': 'You have received',
-    'payment_to_code_holders': 'Your payment of',
-    'transfers_to_mobile_numbers': 'transferred to',
-    'bank_transfers': 'You have transferred',
-    'internet_voice_bundle': 'Bundles and Packs',
-    'cash_power_bill_payments': 'MTN Cash Power',
-    'transtxns_initiate_by_third_parties': 'Message from debit receiver',
-    'withdrawals_from_agents': 'withdrawn',
-    'airtime': 'to Airtime with token',
+# One entry per message category, keyed by table name. This is the single
+# source for classification, field extraction (see templates.py), the SQLite
+# schema (schema.py) and the read endpoints (app.py).
+#
+#   keyword:   search string that routes a message to the category
+#   templates: message formats, tried in order. Placeholders are written
+#              {field:type} (type defaults to text, see templates.FIELD_TYPES),
+#              {:type} matches without capturing and ... skips any text.
+#              Text after the end of a template is ignored.
+#   key:       column holding the transaction id (type txid)
+#   natural_key: for messages without a transaction id, the columns that
+#              identify a transaction; the key column is then derived from
+#              them (see templates.natural_key). None otherwise.
+#   counterparty: the other party, stored in the counterparties table (see
+#              schema.py): its name and phone columns (phone may be None) and
+#              its kind (person, merchant, agent or biller)
+#   route:     URL of the read endpoint
+#   json_file: JSON export of the category
+#   record:    name of the category's record type (see templates.RECORD_TYPES)
+#
+# Categories are listed in priority order: when a message contains the keywords
+# of several categories, the first one wins. Specific payment targets (Airtime,
+# Cash Power, Bundles) must beat the generic 'Your payment of', bank transfers
+# must beat 'transferred to', and the loose 'withdrawn' is a last resort.
+CATEGORIES = {
+    'airtime_payments': {
+        'keyword': 'to Airtime with token',
+        'templates': [
+            "...TxId:{txid:txid}*S*Your payment of {payment_amount:money} RWF to Airtime with token ... has been completed at {date:timestamp}. Fee was {fee:money} RWF. Your new balance: {new_balance:money} RWF",
+        ],
+        'key': 'txid',
+        'natural_key': None,
+        'counterparty': None,
+        'route': '/airtime-payments',
+        'json_file': 'data/airtime_payments.json',
+        'record': 'AirtimePayment',
+    },
+    'cash_power_bill_payments': {
+        'keyword': 'MTN Cash Power',
+        'templates': [
+            "...TxId:{transaction_id:txid}*S*Your payment of {payment_amount:money} RWF to {provider} with token {token} has been completed at {date:timestamp}. Fee was {fee:money} RWF. Your new balance: {new_balance:money} RWF",
+        ],
+        'key': 'transaction_id',
+        'natural_key': None,
+        'counterparty': {'name': 'provider', 'phone': None, 'kind': 'biller'},
+        'route': '/cash-power-bill-payments',
+        'json_file': 'data/cash_power_bill_payments.json',
+        'record': 'CashPowerBillPayment',
+    },
+    'internet_voice_bundles': {
+        'keyword': 'Bundles and Packs',
+        'templates': [
+            "...TxId:{transaction_id:txid}*S*Your payment of {amount:money} RWF to {service} with token ... has been completed at {date:timestamp}. ... Your new balance: {new_balance:money} RWF",
+        ],
+        'key': 'transaction_id',
+        'natural_key': None,
+        'counterparty': {'name': 'service', 'phone': None, 'kind': 'biller'},
+        'route': '/internet-voice-bundles',
+        'json_file': 'data/internet_voice_bundles.json',
+        'record': 'InternetVoiceBundle',
+    },
+    'payment_to_code_holders': {
+        'keyword': 'Your payment of',
+        'templates': [
+            "TxId: {transaction_id:txid}. Your payment of {amount:money} RWF to {recipient} has been completed at {date:timestamp}. Your new balance: {new_balance:money} RWF. Fee was {fee:money} RWF",
+            "...TxId:{transaction_id:txid}*S*Your payment of {amount:money} RWF to {recipient} with token ... has been completed at {date:timestamp}. Fee was {fee:money} RWF. Your new balance: {new_balance:money} RWF",
+            "Your payment of {amount:money} RWF to {recipient} ({:phone}) has been completed at {date:timestamp}. ... Your new balance: {new_balance:money} RWF. Fee was {fee:money} RWF. ... Financial Transaction Id: {transaction_id:txid}.",
+        ],
+        'key': 'transaction_id',
+        'natural_key': None,
+        'counterparty': {'name': 'recipient', 'phone': None, 'kind': 'merchant'},
+        'route': '/payment-to-code-holders',
+        'json_file': 'data/payment_to_code_holders.json',
+        'record': 'PaymentToCodeHolder',
+    },
+    'bank_transfers': {
+        'keyword': 'You have transferred',
+        'templates': [
+            "You have transferred {amount:money} RWF to {recipient_name} ({recipient_phone:phone}) from your mobile money account {sender_account:id} ... at {date:timestamp}. ... Financial Transaction Id: {transaction_id:txid}.",
+        ],
+        'key': 'transaction_id',
+        'natural_key': None,
+        'counterparty': {'name': 'recipient_name', 'phone': 'recipient_phone', 'kind': 'person'},
+        'route': '/bank-transfers',
+        'json_file': 'data/bank_transfers.json',
+        'record': 'BankTransfer',
+    },
+    'transfers_to_mobile_numbers': {
+        'keyword': 'transferred to',
+        'templates': [
+            "...S*{amount_transferred:money} RWF transferred to {recipient} ({recipient_number:phone}) from {sender_account:id} at {date:timestamp} . Fee was: {fee:money} RWF. New balance: {new_balance:money} RWF",
+        ],
+        'key': 'txid',
+        'natural_key': ('ts', 'amount_transferred', 'recipient_number'),
+        'counterparty': {'name': 'recipient', 'phone': 'recipient_number', 'kind': 'person'},
+        'route': '/transfers-to-mobile_numbers',
+        'json_file': 'data/transfer_to_mobile_numbers.json',
+        'record': 'TransferToMobileNumber',
+    },
+    'incoming_money': {
+        'keyword': 'You have received',
+        'templates': [
+            "You have received {amount_received:money} RWF from {sender} ({sender_phone:phone}) on your mobile money account at {date:timestamp}. ... Your new balance:{new_balance:money} RWF. Financial Transaction Id: {txid:txid}.",
+        ],
+        'key': 'txid',
+        'natural_key': None,
+        'counterparty': {'name': 'sender', 'phone': 'sender_phone', 'kind': 'person'},
+        'route': '/incoming-money',
+        'json_file': 'data/incoming_money_table.json',
+        'record': 'IncomingMoney',
+    },
+    'transactions_initiated_by_third_parties': {
+        'keyword': 'Message from debit receiver',
+        'templates': [
+            "...A transaction of {amount:money} RWF by {sender} on your MOMO account was successfully completed at {date:timestamp}. ... Your new balance:{new_balance:money} RWF. Fee was {fee:money} RWF. Financial Transaction Id: {transaction_id:txid}. External Transaction Id: {external_transaction_id:ref}.",
+        ],
+        'key': 'transaction_id',
+        'natural_key': None,
+        'counterparty': {'name': 'sender', 'phone': None, 'kind': 'merchant'},
+        'route': '/txns-from-third-parties',
+        'json_file': 'data/transactions_initiated_by_third_parties.json',
+        'record': 'ThirdPartyTransaction',
+    },
+    'withdrawals_from_agents': {
+        'keyword': 'withdrawn',
+        'templates': [
+            "You {name} ({:phone}) have via agent: {agent_name} ({agent_number:phone}), withdrawn {amount:money} RWF from your mobile money account: {account:id} at {date:timestamp} and ... Your new balance: {new_balance:money} RWF. Fee paid: {fee:money} RWF. ... Financial Transaction Id: {transaction_id:txid}.",
+        ],
+        'key': 'transaction_id',
+        'natural_key': None,
+        'counterparty': {'name': 'agent_name', 'phone': 'agent_number', 'kind': 'agent'},
+        'route': '/withdrawals-from-agents',
+        'json_file': 'data/withdrawals_from_agents.json',
+        'record': 'AgentWithdrawal',
+    },
 }
 
-TABLE_SCHEMA = {
-    'incoming_money': ['amount_received', 'sender', 'date', 'time', 'new_balance', 'transaction_id'],
-    'payment_to_code_holders': ['amount_paid', 'recipient', 'date', 'time', 'new_balance', 'transaction_id', 'payment_code'],
-    'transfers_to_mobile_numbers': ['amount_transferred', 'recipient', 'recipient_number', 'date', 'time', 'fee', 'new_balance', 'transaction_id'],
-    'bank_transfers': ['amount_transferred', 'recipient', 'date', 'time', 'fee', 'new_balance', 'transaction_id', 'bank_name'],
-    'internet_voice_bundle': ['date', 'time', 'new_balance', 'transaction_id', 'amount'],
-    'cash_power_bill_payments': ['date', 'time', 'new_balance', 'transaction_id', 'amount', 'token'],
-    'transtxns_initiate_by_third_parties': ['date', 'time', 'new_balance', 'transaction_amount', 'transaction_initiator', 'financial_transaction_id', 'external_transaction_id'],
-    'withdrawals_from_agents': ['date', 'time', 'new_balance', 'transaction_id', 'amount', 'agent_name', 'agent_number', 'fee'],
-    'airtime': ['date', 'time', 'new_balance', 'transaction_id', 'amount'],
-}
\ No newline at end of file
+TABLE_CONFIG = {table: category['keyword']
+                for table, category in CATEGORIES.items()}
+
+TABLE_PRIORITY = list(CATEGORIES)
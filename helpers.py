@@ -1,14 +1,125 @@
+import gzip
 import json
+import os
 
-def export_to_json(data, filename="airtime_payments.json"):
+# Separators of the compact and NDJSON formats (no spaces)
+COMPACT_SEPARATORS = (',', ':')
+
+
+def export_filename(filename, ndjson=False, compress=False):
+    """
+    Derives the name of an export in another format.
+
+    Args:
+        filename: The JSON file, e.g. "data/airtime_payments.json".
+        ndjson: Use the .ndjson extension instead of .json.
+        compress: Append .gz.
+
+    Returns:
+        The file name, e.g. "data/airtime_payments.ndjson.gz".
+    """
+    if ndjson:
+        filename = os.path.splitext(filename)[0] + '.ndjson'
+    return filename + '.gz' if compress else filename
+
+
+class JsonWriter:
+    """
+    Writes records to a JSON file one at a time.
+
+    The file is written under a temporary name next to its destination and
+    renamed into place by close(), so readers only ever see complete exports.
+    Used as a context manager, an exception discards the partial file.
+
+    Args:
+        filename: The file to create.
+        compact: Write without indentation or spaces.
+        ndjson: Write one record per line (NDJSON) instead of a JSON array.
+            Defaults to True for .ndjson and .ndjson.gz files.
+        compress: Gzip the output. Defaults to True for .gz files.
     """
-    Exports a list of dictionaries to a JSON file.
+
+    def __init__(self, filename, compact=False, ndjson=None, compress=None):
+        if compress is None:
+            compress = filename.endswith('.gz')
+        if ndjson is None:
+            ndjson = filename.endswith(('.ndjson', '.ndjson.gz'))
+
+        self.filename = filename
+        self.temp_filename = f"{filename}.{os.getpid()}.tmp"
+        self.count = 0
+        self.ndjson = ndjson
+        # Same layout as json.dump(records, f, indent=4) unless compact
+        self.indent = None if compact or ndjson else 4
+        self.separators = COMPACT_SEPARATORS if compact or ndjson else None
+
+        if compress:
+            self.file = gzip.open(self.temp_filename, 'wt', encoding='utf-8')
+        else:
+            self.file = open(self.temp_filename, 'w', encoding='utf-8')
+
+    def write(self, record):
+        """Appends one record (a dictionary or a templates.RECORD_TYPES tuple)."""
+        if hasattr(record, '_asdict'):
+            record = record._asdict()
+        text = json.dumps(record, indent=self.indent, separators=self.separators)
+        if self.ndjson:
+            self.file.write(text + '\n')
+        elif self.indent is None:
+            self.file.write((',' if self.count else '[') + text)
+        else:
+            text = text.replace('\n', '\n' + ' ' * self.indent)
+            self.file.write((',\n' if self.count else '[\n') + ' ' * self.indent + text)
+        self.count += 1
+
+    def write_all(self, records):
+        """Appends every record of an iterable to the file."""
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        """Finishes the file and moves it into place."""
+        if not self.ndjson:
+            if not self.count:
+                self.file.write('[]')
+            else:
+                self.file.write('\n]' if self.indent else ']')
+        self.file.close()
+        os.replace(self.temp_filename, self.filename)
+
+    def abort(self):
+        """Discards the partial file."""
+        self.file.close()
+        os.remove(self.temp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def export_to_json(data, filename="airtime_payments.json", compact=False,
+                   ndjson=None, compress=None, verbose=False):
+    """
+    Exports dictionaries to a JSON file, one at a time.
 
     Args:
-        data: A list of dictionaries to be exported.
+        data: An iterable of records to be exported (a list or a generator), as
+            dictionaries or templates.RECORD_TYPES tuples.
         filename: The name of the JSON file to create (default: "airtime_payments.json").
+        compact, ndjson, compress: The output format, see JsonWriter.
+        verbose: Print a line once the file is written (off by default).
+
+    Returns:
+        The number of records exported.
     """
 
-    with open(filename, "w") as f:  # "w" for write mode
-        json.dump(data, f, indent=4)  # indent for pretty formatting
-    print(f"Data exported to {filename}")
\ No newline at end of file
+    with JsonWriter(filename, compact, ndjson, compress) as writer:
+        writer.write_all(data)
+    if verbose:
+        print(f"Data exported to {filename}")
+    return writer.count
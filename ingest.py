@@ -0,0 +1,564 @@
+import argparse
+import glob
+from collections import deque
+from contextlib import ExitStack
+import heapq
+import mmap
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+from constants import CATEGORIES
+from helpers import JsonWriter, export_filename
+from init_db import (DATABASE_NAME, Counterparties, analyze_transactions, create_connection,
+                     create_indexes, create_table, create_tables)
+from schema import counterparty_columns
+from scraper import SMS_RECORD_START, parse_sms_records
+from templates import TABLE_COLUMNS
+
+# Ranges per worker; more ranges than workers evens out uneven chunks
+RANGES_PER_WORKER = 4
+# Large backups are cut into ranges of at most this size ...
+RANGE_SIZE = 32 * 1024 ** 2
+# ... of which only this many per backup are parsed ahead of the writer
+RANGES_IN_FLIGHT = 8
+BATCH_SIZE = 10_000
+
+BACKUP_HEADER_SIZE = 4096
+BACKUP_HEADER = re.compile(rb"<smses\b([^>]*)>")
+BACKUP_ATTRIBUTE = re.compile(rb'(\w+)="([^"]*)"')
+
+# (table name, record, message hash or None), as yielded by parse_sms_records
+Record = Tuple[str, tuple, int | None]
+
+# message_hash() of every message ingested so far
+SEEN_MESSAGES_SQL = """
+    CREATE TABLE IF NOT EXISTS ingest_seen_messages (
+        hash INTEGER PRIMARY KEY
+    )
+"""
+
+# Newest <sms date=...> ingested per device (source) and SIM (sub_id). The
+# source is the --source of the run, or else the path of the backup
+HIGH_WATER_MARKS_SQL = """
+    CREATE TABLE IF NOT EXISTS ingest_high_water_marks (
+        source TEXT,
+        sub_id TEXT,
+        last_date INTEGER,
+        PRIMARY KEY (source, sub_id)
+    )
+"""
+
+
+def split_ranges(file_path: str, parts: int) -> List[Tuple[int, int]]:
+    """
+    Splits an XML backup into byte ranges that start on an <sms record.
+
+    '<' cannot appear unescaped inside an attribute value, so every occurrence
+    of '<sms ' is the start of a record.
+
+    Args:
+        file_path (str): The path to the XML file.
+        parts (int): The number of ranges to aim for.
+
+    Returns:
+        List[Tuple[int, int]]: (start, end) byte offsets, in file order.
+    """
+    if os.path.getsize(file_path) == 0:
+        return []
+
+    with open(file_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        starts = []
+        for part in range(parts):
+            start = mm.find(SMS_RECORD_START, size * part // parts)
+            if start == -1:
+                break
+            if not starts or start > starts[-1]:
+                starts.append(start)
+
+    return list(zip(starts, starts[1:] + [size]))
+
+
+class SeenMessages:
+    """
+    Read-only view of the dedupe index, for use with `in` from the workers.
+
+    Every lookup is a primary key probe on an INTEGER key, so checking a message
+    costs far less than classifying and parsing it.
+    """
+
+    def __init__(self, database: str):
+        self.conn = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+
+    def __contains__(self, message_hash: int) -> bool:
+        return self.conn.execute(
+            "SELECT 1 FROM ingest_seen_messages WHERE hash = ?",
+            (message_hash,)).fetchone() is not None
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_range(file_path: str, start: int, end: int,
+                high_water_marks: Dict[str, int] | None = None,
+                database: str | None = None) -> Tuple[List[Record], Dict[str, int], Dict[str, int]]:
+    """
+    Classifies and parses the records of a byte range (runs in a worker).
+
+    Args:
+        file_path (str): The path to the XML file.
+        start (int): Offset of the range.
+        end (int): Offset just past the range.
+        high_water_marks (Dict[str, int] | None): sub_id -> epoch (ms) of the
+            newest message already ingested; older messages are skipped.
+        database (str | None): Database holding the dedupe index. Messages
+            found in it are skipped; None turns deduplication off.
+
+    Returns:
+        Tuple[List[Record], Dict[str, int], Dict[str, int]]: The records in
+        file order, sub_id -> epoch (ms) of the newest message in the range,
+        and counters ('duplicates').
+    """
+    latest = {}
+    counts = {}
+    seen = SeenMessages(database) if database else None
+    try:
+        with open(file_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                memoryview(mm) as view:
+            records = list(parse_sms_records(mm, view, start, end,
+                                             high_water_marks, latest, seen, counts))
+    finally:
+        if seen:
+            seen.close()
+    return records, latest, counts
+
+
+def parse_parallel(file_path: str, workers: int = os.cpu_count() or 1) -> Iterator[Record]:
+    """
+    Parses one XML backup across several processes.
+
+    Args:
+        file_path (str): The path to the XML file.
+        workers (int): The number of worker processes.
+
+    Yields:
+        Record: The records, in file order.
+    """
+    ranges = split_backup(file_path, workers)
+
+    if workers <= 1:
+        for start, end in ranges:
+            yield from parse_range(file_path, start, end)[0]
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for records, _, _ in iter_ranges(pool, file_path, ranges):
+            yield from records
+
+
+def split_backup(file_path: str, workers: int) -> List[Tuple[int, int]]:
+    """
+    Splits a backup into enough ranges to keep every worker busy, and into
+    ranges of at most about RANGE_SIZE bytes however large the backup is.
+
+    Args:
+        file_path (str): The path to the XML file.
+        workers (int): The number of worker processes.
+
+    Returns:
+        List[Tuple[int, int]]: See split_ranges().
+    """
+    parts = max(workers * RANGES_PER_WORKER, os.path.getsize(file_path) // RANGE_SIZE)
+    return split_ranges(file_path, parts)
+
+
+def iter_ranges(pool: ProcessPoolExecutor, file_path: str,
+                ranges: List[Tuple[int, int]], *args) -> Iterator[Tuple[List[Record], Dict[str, int], Dict[str, int]]]:
+    """
+    Parses ranges of a backup on the worker pool, in file order.
+
+    At most RANGES_IN_FLIGHT ranges are queued or held at any time, so
+    memory stays bounded however large the backup is.
+
+    Args:
+        pool (ProcessPoolExecutor): The worker pool.
+        file_path (str): The path to the XML file.
+        ranges (List[Tuple[int, int]]): The ranges, from split_ranges().
+        *args: Passed on to parse_range() after the range.
+
+    Yields:
+        Tuple[List[Record], Dict[str, int], Dict[str, int]]: The results of
+        parse_range(), one per range.
+    """
+    ranges = iter(ranges)
+    pending = deque()
+
+    while True:
+        while len(pending) < RANGES_IN_FLIGHT:
+            next_range = next(ranges, None)
+            if next_range is None:
+                break
+            pending.append(pool.submit(parse_range, file_path, *next_range, *args))
+        if not pending:
+            return
+        yield pending.popleft().result()
+
+
+def find_backups(patterns: List[str]) -> List[str]:
+    """
+    Expands directories and glob patterns into a list of backup files.
+
+    Args:
+        patterns (List[str]): Files, directories (all *.xml inside) or globs.
+
+    Returns:
+        List[str]: The backup files, without duplicates.
+    """
+    file_paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            file_paths.extend(sorted(glob.glob(os.path.join(pattern, '*.xml'))))
+        elif glob.has_magic(pattern):
+            file_paths.extend(sorted(glob.glob(pattern)))
+        else:
+            file_paths.append(pattern)
+    return list(dict.fromkeys(file_paths))
+
+
+def read_backup_info(file_path: str) -> Dict[str, str]:
+    """
+    Reads the attributes of the <smses> root (backup_set, backup_date, count).
+
+    Returns:
+        Dict[str, str]: The root attributes, empty if there is no root tag.
+    """
+    with open(file_path, 'rb') as f:
+        head = f.read(BACKUP_HEADER_SIZE)
+    match = BACKUP_HEADER.search(head)
+    if not match:
+        return {}
+    return {name.decode(): value.decode()
+            for name, value in BACKUP_ATTRIBUTE.findall(match.group(1))}
+
+
+def record_time(parsed: Record) -> str:
+    """Sort key of a parsed record: its 'YYYY-MM-DD HH:MM:SS' timestamp."""
+    return parsed[1].date
+
+
+def create_dedupe_index(conn):
+    """Creates the dedupe index so that workers can open it read-only."""
+    create_table(conn, SEEN_MESSAGES_SQL)
+
+
+def backup_source(file_path: str, source: str | None = None) -> str:
+    """Identifies the device of a backup: the source given, or else its path."""
+    return source or os.path.abspath(file_path)
+
+
+def load_high_water_marks(conn, source: str) -> Dict[str, int]:
+    """
+    Loads the high-water marks of a device.
+
+    Returns:
+        Dict[str, int]: sub_id -> epoch (ms) of the newest message ingested.
+    """
+    create_table(conn, HIGH_WATER_MARKS_SQL)
+    rows = conn.execute(
+        "SELECT sub_id, last_date FROM ingest_high_water_marks WHERE source = ?",
+        (source,)).fetchall()
+    return {row['sub_id']: row['last_date'] for row in rows}
+
+
+def save_high_water_marks(conn, source: str, latest: Dict[str, int]):
+    """Raises the high-water marks of a device (they never go down)."""
+    create_table(conn, HIGH_WATER_MARKS_SQL)
+    conn.executemany(
+        """
+        INSERT INTO ingest_high_water_marks (source, sub_id, last_date)
+        VALUES (?, ?, ?)
+        ON CONFLICT (source, sub_id)
+        DO UPDATE SET last_date = MAX(last_date, excluded.last_date)
+        """,
+        [(source, sub_id, date) for sub_id, date in latest.items()])
+    conn.commit()
+
+
+def iter_backup(pool: ProcessPoolExecutor, workers: int, file_path: str,
+                high_water_marks: Dict[str, int] | None, database: str | None,
+                latest: Dict[str, int], counts: Dict[str, int]) -> Iterator[Record]:
+    """
+    Streams the records of one backup from the worker pool, range by range.
+
+    Args:
+        pool (ProcessPoolExecutor): The worker pool.
+        workers (int): The number of worker processes in the pool.
+        file_path (str): The path to the XML file.
+        high_water_marks (Dict[str, int] | None): See parse_range().
+        database (str | None): See parse_range().
+        latest (Dict[str, int]): Filled with sub_id -> epoch (ms) of the newest
+            message in the backup.
+        counts (Dict[str, int]): Incremented with 'records' and 'duplicates'.
+
+    Yields:
+        Record: The records, in file order.
+    """
+    results = iter_ranges(pool, file_path, split_backup(file_path, workers),
+                          high_water_marks, database)
+    for records, range_latest, range_counts in results:
+        for sub_id, date in range_latest.items():
+            latest[sub_id] = max(date, latest.get(sub_id, date))
+        counts['records'] = counts.get('records', 0) + len(records)
+        counts['duplicates'] = counts.get('duplicates', 0) + range_counts.get('duplicates', 0)
+        # Ranges are small, so sorting each one keeps backups that are only
+        # locally out of order mergeable
+        records.sort(key=record_time)
+        yield from records
+
+
+def parse_backups(file_paths: List[str], workers: int = os.cpu_count() or 1,
+                  high_water_marks: Dict[str, Dict[str, int]] | None = None,
+                  latest: Dict[str, Dict[str, int]] | None = None,
+                  database: str | None = None,
+                  counts: Dict[str, int] | None = None) -> Iterator[Record]:
+    """
+    Parses several backups concurrently and merges them in timestamp order.
+
+    Every backup is split into byte ranges and all ranges of all backups share
+    one process pool. Backups are streamed rather than collected, which relies
+    on the backup app writing messages in date order. A line of progress is
+    printed as each backup completes.
+
+    Args:
+        file_paths (List[str]): The backup files.
+        workers (int): The number of worker processes.
+        high_water_marks (Dict[str, Dict[str, int]] | None): file path ->
+            sub_id -> epoch (ms) of the newest message already ingested from
+            the device of the backup.
+        latest (Dict[str, Dict[str, int]] | None): Filled with file path ->
+            sub_id -> epoch (ms) of the newest message in the backup.
+        database (str | None): Database holding the dedupe index (see
+            parse_range()); None turns deduplication off.
+        counts (Dict[str, int] | None): Incremented with the number of
+            'duplicates' skipped by the workers.
+
+    Yields:
+        Record: The records, oldest first.
+    """
+    high_water_marks = high_water_marks or {}
+    latest = {} if latest is None else latest
+    start = time.perf_counter()
+    finished = []
+
+    def report(file_path, file_counts):
+        finished.append(file_path)
+        info = read_backup_info(file_path)
+        print(f"[{len(finished)}/{len(file_paths)}] {file_path}: "
+              f"{file_counts.get('records', 0)} new records, "
+              f"{file_counts.get('duplicates', 0)} already seen "
+              f"(backup_set {info.get('backup_set', 'unknown')}) "
+              f"after {time.perf_counter() - start:.2f}s")
+        if counts is not None:
+            counts['duplicates'] = counts.get('duplicates', 0) + file_counts.get('duplicates', 0)
+
+    def stream(pool, file_path):
+        file_counts = {}
+        yield from iter_backup(pool, max(workers, 1), file_path,
+                               high_water_marks.get(file_path), database, latest.setdefault(file_path, {}), file_counts)
+        report(file_path, file_counts)
+
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as pool:
+        yield from heapq.merge(*(stream(pool, file_path) for file_path in file_paths),
+                               key=record_time)
+
+
+def write_records(conn, records: Iterator[Record], batch_size: int = BATCH_SIZE,
+                  counts: Dict[str, int] | None = None,
+                  exports: Dict[str, JsonWriter] | None = None) -> int:
+    """
+    Writes parsed records to their tables from a single connection.
+
+    Records are buffered per table and written with one executemany() and one
+    commit per batch. Records that already exist are skipped. Counterparties
+    are resolved to their ids in memory (see init_db.Counterparties). Message
+    hashes go into the dedupe index in the same transaction as their records,
+    as they arrive: a message whose hash is already there was seen earlier in
+    the run (overlapping backups) and is written once. No per-run set of
+    hashes is kept, so memory does not grow with the size of the backups.
+
+    Args:
+        conn: The database connection object.
+        records (Iterator[Record]): The records to write.
+        batch_size (int): The number of records per batch.
+        counts (Dict[str, int] | None): Incremented with the number of
+            'duplicates' dropped within the run.
+        exports (Dict[str, JsonWriter] | None): Table name -> a JSON export
+            that also receives the records written.
+
+    Returns:
+        int: The number of records written.
+    """
+    create_tables(conn)
+    create_indexes(conn)
+    create_dedupe_index(conn)
+
+    counterparties = Counterparties(conn)
+    # Table -> (kind, position of the name, position of the phone or None)
+    resolvers = {}
+    statements = {}
+    for table, columns in TABLE_COLUMNS.items():
+        name, phone, kind = counterparty_columns(table)
+        if name:
+            resolvers[table] = (kind, columns.index(name),
+                                columns.index(phone) if phone else None)
+            columns += ('counterparty_id',)
+        statements[table] = (f"INSERT INTO {table} ({', '.join(columns)}) "
+                             f"VALUES ({', '.join(['?'] * len(columns))})")
+
+    def flush(batches):
+        for table, rows in batches.items():
+            conn.executemany(statements[table], rows)
+        conn.commit()
+
+    count = 0
+    batches = {}
+    for table, record, message_hash in records:
+        # No row inserted: the message was already written by this run
+        if message_hash is not None and not conn.execute(
+                "INSERT INTO ingest_seen_messages (hash) VALUES (?) ON CONFLICT DO NOTHING",
+                (message_hash,)).rowcount:
+            if counts is not None:
+                counts['duplicates'] = counts.get('duplicates', 0) + 1
+            continue
+
+        # Records are named tuples in column order, i.e. rows already
+        row = record
+        if table in resolvers:
+            kind, name, phone = resolvers[table]
+            row = (*record, counterparties.resolve(
+                kind, record[name], None if phone is None else record[phone]))
+        batches.setdefault(table, []).append(row)
+        if exports is not None:
+            exports[table].write(record)
+        count += 1
+        if count % batch_size == 0:
+            flush(batches)
+            batches = {}
+    flush(batches)
+
+    return count
+
+
+def ingest(file_paths: List[str], database: str = DATABASE_NAME,
+           workers: int = os.cpu_count() or 1, full: bool = False,
+           dedupe: bool = True, export_json: bool = False,
+           export_options: Dict[str, bool] | None = None,
+           source: str | None = None) -> Dict[str, int]:
+    """
+    Streams SMS backups straight into the database.
+
+    Messages older than the high-water mark of their device and SIM (sub_id)
+    are skipped. A backup carries nothing that identifies its phone (every
+    backup has a backup_set of its own), so without a source each backup
+    file is a device of its own: a backup re-written at the same path keeps
+    its marks, and backups of different phones never share them. A source
+    names the phone of all the backups of the run, so that the marks also
+    carry over to its new backup files.
+
+    Args:
+        file_paths (List[str]): The backup files.
+        database (str): The database to load.
+        workers (int): The number of worker processes.
+        full (bool): Ignore the high-water marks and re-parse everything.
+        dedupe (bool): Check messages against the dedupe index.
+        export_json (bool): Also export the records written by this run to
+            the category JSON files (constants.CATEGORIES json_file).
+        export_options (Dict[str, bool] | None): The export format (compact,
+            ndjson, compress), see helpers.JsonWriter.
+        source (str | None): The device all the backups come from.
+
+    Returns:
+        Dict[str, int]: Counters: 'records' written and 'duplicates' skipped.
+    """
+    counts = {}
+    export_options = export_options or {}
+
+    with ExitStack() as stack, create_connection(database) as conn:
+        exports = {
+            table: stack.enter_context(JsonWriter(export_filename(
+                category['json_file'], export_options.get('ndjson', False),
+                export_options.get('compress', False)), **export_options))
+            for table, category in CATEGORIES.items()} if export_json else None
+
+        sources = {file_path: backup_source(file_path, source) for file_path in file_paths}
+        high_water_marks = {} if full else {
+            file_path: load_high_water_marks(conn, file_source)
+            for file_path, file_source in sources.items()}
+        latest = {}
+
+        create_dedupe_index(conn)
+        conn.commit()
+        counts['records'] = write_records(conn, parse_backups(
+            file_paths, workers, high_water_marks, latest,
+            database if dedupe else None, counts),
+            counts=counts, exports=exports)
+
+        # Only raised once everything up to them has been written
+        for file_path, file_latest in latest.items():
+            save_high_water_marks(conn, sources[file_path], file_latest)
+        # The statistics were gathered before this run's rows
+        analyze_transactions(conn)
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Parse SMS backups and load them into the database.")
+    parser.add_argument('backups', nargs='*', default=['sms.xml'],
+                        help="backup files, directories or glob patterns")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--database', default=DATABASE_NAME)
+    parser.add_argument('--source',
+                        help="the phone all the backups come from, so that they share its "
+                             "high-water marks (default: each backup file on its own)")
+    parser.add_argument('--full', action='store_true',
+                        help="ignore the high-water marks and re-parse everything")
+    parser.add_argument('--no-dedupe', action='store_true',
+                        help="do not check messages against the dedupe index")
+    parser.add_argument('--export-json', action='store_true',
+                        help="also export the new records to the data/*.json files")
+    parser.add_argument('--compact', action='store_true',
+                        help="export without indentation")
+    parser.add_argument('--ndjson', action='store_true',
+                        help="export one record per line to data/*.ndjson")
+    parser.add_argument('--gzip', action='store_true',
+                        help="gzip the exports")
+    args = parser.parse_args()
+
+    file_paths = find_backups(args.backups)
+    if not file_paths:
+        print("No backups found.")
+        return
+
+    start = time.perf_counter()
+    counts = ingest(file_paths, args.database, args.workers, args.full,
+                    not args.no_dedupe, args.export_json,
+                    {'compact': args.compact, 'ndjson': args.ndjson, 'compress': args.gzip},
+                    args.source)
+    elapsed = time.perf_counter() - start
+
+    size = sum(os.path.getsize(file_path) for file_path in file_paths)
+    print(f"Ingested {counts['records']} records ({counts.get('duplicates', 0)} duplicates skipped) "
+          f"from {len(file_paths)} backup(s) in "
+          f"{elapsed:.2f}s with {args.workers} worker(s): "
+          f"{counts['records'] / elapsed:,.0f} records/s, {size / elapsed / 1024 ** 2:,.1f} MB/s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,41 @@
+import argparse
+import gzip
 import sqlite3
 import json
+import os
+import re
+import time
+from constants import CATEGORIES
+from helpers import export_filename
+from migrations import Migration, apply_migrations
+from schema import (DETAIL_TYPES, FACT_COLUMNS, TRANSACTION_INDEXES, category_id,
+                    counterparty_columns, counterparty_totals_ddl, index_ddl, schema_ddl,
+                    transaction_details_ddl, transactions_ddl, view_ddl)
+from templates import (COLUMN_TYPES, DERIVED_COLUMNS, INTEGER_COLUMNS, TABLE_COLUMNS,
+                       coerce_integers, derive_columns, natural_key)
 
 DATABASE_NAME = 'momo_data.db'
 
+# Rows written per executemany() call and per transaction
+BATCH_SIZE = 10_000
+
+# Characters read at a time by the streaming JSON reader
+JSON_CHUNK_SIZE = 1024 * 1024
+
+# Records that could not be stored as typed rows, kept for inspection
+REJECTS_SQL = """
+CREATE TABLE IF NOT EXISTS rejected_records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT,
+    record TEXT,
+    reason TEXT,
+    rejected_at INTEGER
+)
+"""
+
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+JSON_SEPARATOR = re.compile(r"[ \t\n\r]*([,\]])[ \t\n\r]*")
+
 
 def create_connection(db_name):
     """Creates and returns a database connection."""
@@ -27,202 +60,916 @@ def create_table(conn, table_creation_sql):
         print(f"Error creating table: {e}")
 
 
+def add_derived_columns(conn, table_name):
+    """Adds the derived columns (e.g. ts) missing from an existing table.
+
+    Tables created before a derived column existed get it added and back-filled
+    from its source column, e.g. ts from date. Runs in the caller's transaction.
+
+    Args:
+        conn: The database connection object.
+        table_name: The name of the table.
+    """
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+    for column, (source, convert, column_type) in DERIVED_COLUMNS.items():
+        if column in existing or column not in COLUMN_TYPES[table_name]:
+            continue
+
+        def derive(value, convert=convert):
+            try:
+                return convert(value)
+            except (TypeError, ValueError):  # e.g. dates mangled by older parsers
+                return None
+
+        conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {column_type}")
+        conn.create_function(f"derive_{column}", 1, derive, deterministic=True)
+        conn.execute(f"UPDATE {table_name} SET {column} = derive_{column}({source})")
+        missing = conn.execute(
+            f"SELECT COUNT(*) FROM {table_name} WHERE {column} IS NULL").fetchone()[0]
+        print(f"Added column {column} to {table_name}"
+              + (f" ({missing} rows could not be converted)." if missing else "."))
+
+
+def log_rejects(conn, table_name, rejects):
+    """Records rejected records in the rejected_records table, in the caller's
+    transaction.
+
+    Args:
+        conn: The database connection object.
+        table_name: The table the records were meant for.
+        rejects: (record, reason) pairs; records are dictionaries.
+    """
+    if not rejects:
+        return
+    now = int(time.time())
+    conn.executemany(
+        "INSERT INTO rejected_records (table_name, record, reason, rejected_at) "
+        "VALUES (?, ?, ?, ?)",
+        [(table_name, json.dumps(record, default=str), reason, now)
+         for record, reason in rejects])
+    print(f"Rejected {len(rejects)} records of {table_name} (see rejected_records).")
+
+
+def coerce_stored_integers(conn, table_name):
+    """Rewrites integer columns stored as text (e.g. '50,000') as integers.
+
+    Rows whose values cannot be coerced are moved to rejected_records. Runs in
+    the caller's transaction.
+
+    Args:
+        conn: The database connection object.
+        table_name: The name of the table.
+    """
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+    # Columns added to the category since (e.g. fee) are not there to coerce
+    columns = [column for column in INTEGER_COLUMNS[table_name] if column in existing]
+    if not columns:
+        return
+    untyped = ' OR '.join(f"typeof({column}) NOT IN ('integer', 'null')" for column in columns)
+    rows = conn.execute(f"SELECT rowid AS _rowid, * FROM {table_name} WHERE {untyped}").fetchall()
+    if not rows:
+        return
+
+    updates, rejects = [], []
+    for row in rows:
+        record = dict(row)
+        rowid = record.pop('_rowid')
+        try:
+            coerce_integers(table_name, record)
+            updates.append([record[column] for column in columns] + [rowid])
+        except ValueError as e:
+            rejects.append((record, str(e)))
+            updates.append(None)
+
+    assignments = ', '.join(f"{column} = ?" for column in columns)
+    conn.executemany(f"UPDATE {table_name} SET {assignments} WHERE rowid = ?",
+                     [update for update in updates if update])
+    conn.executemany(f"DELETE FROM {table_name} WHERE rowid = ?",
+                     [(row['_rowid'],) for row, update in zip(rows, updates) if not update])
+    log_rejects(conn, table_name, rejects)
+    print(f"Coerced {len(rows) - len(rejects)} rows of {table_name} to integer amounts.")
+
+
+def unstorable(table_name):
+    """SQL condition matching the rows of a category the transactions table
+    cannot hold: rows without a ts, or without an integer transaction id
+    (unless it is derived from a natural key).
+
+    Args:
+        table_name: The name of the table.
+    """
+    conditions = ["ts IS NULL"]
+    key = CATEGORIES[table_name]['key']
+    if not CATEGORIES[table_name]['natural_key']:
+        conditions.append(f"ifnull({key}, '') = '' OR CAST({key} AS TEXT) GLOB '*[^0-9]*'")
+    return ' OR '.join(conditions)
+
+
+def reject_unstorable(conn, table_name, source):
+    """Copies the rows of a category the transactions table cannot hold to
+    rejected_records, in the caller's transaction.
+
+    Args:
+        conn: The database connection object.
+        table_name: The name of the table.
+        source: The table or view holding the rows.
+
+    Returns:
+        The number of rows rejected.
+    """
+    existing = [row[1] for row in conn.execute(f"PRAGMA table_info({source})")]
+    record = ', '.join(f"'{column}', {column}" for column in existing
+                       if column in TABLE_COLUMNS[table_name])
+    rejected = conn.execute(
+        "INSERT INTO rejected_records (table_name, record, reason, rejected_at) "
+        f"SELECT ?, json_object({record}), 'no timestamp or transaction id', ? "
+        f"FROM {source} WHERE {unstorable(table_name)}",
+        (table_name, int(time.time()))).rowcount
+    if rejected:
+        print(f"Rejected {rejected} records of {table_name} (see rejected_records).")
+    return rejected
+
+
+def count_transactions(conn, table_name):
+    """Counts the rows of a category in the transactions table."""
+    return conn.execute(
+        "SELECT COUNT(*) FROM transactions "
+        "WHERE category = (SELECT id FROM categories WHERE name = ?)",
+        (table_name,)).fetchone()[0]
+
+
+def move_to_transactions(conn, table_name, position=None):
+    """Moves the rows of a category table into the transactions table, in
+    batches (see migrations.py).
+
+    Databases created before the transactions table hold each category in a
+    table of its own. The first batch renames it to <table>_legacy, creates
+    the category's view in its place (new rows go straight to the transactions
+    table from then on) and moves the rows the transactions table cannot hold
+    (see unstorable()) to rejected_records. Each batch then inserts the next
+    BATCH_SIZE rows through the view, in rowid order, and the last one drops
+    the old table.
+
+    Args:
+        conn: The database connection object.
+        table_name: The name of the table.
+        position: The last rowid moved by an interrupted run, or None.
+
+    Yields:
+        (position, done, total) after each batch: the last rowid moved, and
+        the same as progress through the rowids of the old table.
+    """
+    legacy = f"{table_name}_legacy"
+    if position is None:
+        conn.execute(f"ALTER TABLE {table_name} RENAME TO {legacy}")
+        for sql in view_ddl(table_name):
+            conn.execute(sql)
+        reject_unstorable(conn, table_name, legacy)
+        position = 0
+
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({legacy})")}
+    # Columns added to the category since (e.g. sender_phone) are left empty
+    columns = [column for column in TABLE_COLUMNS[table_name] if column in existing]
+    values = list(columns)
+    key, natural = CATEGORIES[table_name]['key'], CATEGORIES[table_name]['natural_key']
+    if natural and key not in existing:
+        conn.create_function('natural_key', -1, natural_key, deterministic=True)
+        columns.append(key)
+        sources = ', '.join(column if column in existing else 'NULL' for column in natural)
+        values.append(f"natural_key({sources})")
+
+    while True:
+        yield position, position, conn.execute(
+            f"SELECT ifnull(max(rowid), 0) FROM {legacy}").fetchone()[0]
+        last = conn.execute(f"SELECT max(rowid) FROM (SELECT rowid FROM {legacy} "
+                            f"WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                            (position, BATCH_SIZE)).fetchone()[0]
+        if last is None:
+            break
+        conn.execute(f"INSERT INTO {table_name} ({', '.join(columns)}) "
+                     f"SELECT {', '.join(values)} FROM {legacy} "
+                     f"WHERE rowid > ? AND rowid <= ? AND NOT ({unstorable(table_name)}) "
+                     f"ORDER BY rowid", (position, last))
+        position = last
+
+    conn.execute(f"DROP TABLE {legacy}")
+    print(f"Moved {table_name} to the transactions table "
+          f"({count_transactions(conn, table_name)} rows).")
+
+
+def add_counterparty_kinds(conn):
+    """Adds the kind column to a counterparties table created without it.
+
+    Each counterparty gets the kind its category gives it (see
+    constants.CATEGORIES), and the table is keyed on (kind, name, phone).
+    Runs in the caller's transaction.
+
+    Args:
+        conn: The database connection object.
+    """
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(counterparties)")}
+    if not existing or 'kind' in existing:
+        return
+    conn.execute("ALTER TABLE counterparties ADD COLUMN kind TEXT")
+    conn.executemany(
+        "UPDATE counterparties SET kind = ? WHERE id IN (SELECT counterparty_id "
+        "FROM transactions WHERE category = (SELECT id FROM categories WHERE name = ?))",
+        [(counterparty_columns(table_name)[2], table_name)
+         for table_name in CATEGORIES if counterparty_columns(table_name)[0]])
+    conn.execute("DROP INDEX IF EXISTS idx_counterparties_name_phone")
+    print("Added column kind to counterparties.")
+
+
+def cluster_transactions(conn, position=None):
+    """Rebuilds transactions tables created with a rowid as WITHOUT ROWID
+    tables clustered on (category, ts, txid), in batches (see migrations.py).
+
+    The first batch moves the rows without a ts or a usable transaction id to
+    rejected_records and creates the new tables next to the old ones. Each
+    batch then copies the next BATCH_SIZE rows in id order: transaction ids
+    stored as text become integers, and categories without one get negative
+    ids in insertion order. The old tables keep serving the category views
+    (and taking new rows) until the last batch, which copies what is left
+    and swaps the tables and views in.
+
+    Args:
+        conn: The database connection object.
+        position: The last id copied by an interrupted run, or None.
+
+    Yields:
+        (position, done, total) after each batch: the last id copied, and
+        the same as progress through the ids of the old table.
+    """
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(transactions)")}
+    if 'id' not in existing:
+        return
+    facts = [column for column in FACT_COLUMNS
+             if column in existing and column not in ('ts', 'txid')]
+    details = [row[1] for row in conn.execute("PRAGMA table_info(transaction_details)")
+               if row[1] != 'transaction_id']
+
+    if position is None:
+        for table_name in CATEGORIES:
+            if reject_unstorable(conn, table_name, table_name):
+                conn.execute(f"DELETE FROM transactions WHERE id IN "
+                             f"(SELECT id FROM {table_name} WHERE {unstorable(table_name)})")
+        conn.execute("DROP TABLE IF EXISTS transaction_details_clustered")
+        conn.execute("DROP TABLE IF EXISTS transactions_clustered")
+        conn.execute(transactions_ddl('transactions_clustered'))
+        conn.execute(transaction_details_ddl('transaction_details_clustered',
+                                             'transactions_clustered'))
+        position = 0
+
+    while True:
+        yield position, position, conn.execute(
+            "SELECT ifnull(max(id), 0) FROM transactions").fetchone()[0]
+        conn.execute("DROP TABLE IF EXISTS temp.cluster_batch")
+        conn.execute(
+            "CREATE TEMP TABLE cluster_batch AS SELECT id, category, ts, "
+            "ifnull(CAST(txid AS INTEGER), "
+            "(SELECT ifnull(min(n.txid), 0) FROM transactions_clustered n "
+            "WHERE n.category = t.category AND n.txid < 0) "
+            "- row_number() OVER (PARTITION BY category, txid IS NULL ORDER BY id)) AS txid "
+            "FROM (SELECT id, category, ts, txid FROM transactions "
+            "WHERE id > ? ORDER BY id LIMIT ?) t", (position, BATCH_SIZE))
+        last = conn.execute("SELECT max(id) FROM cluster_batch").fetchone()[0]
+        if last is None:
+            break
+        conn.execute(
+            f"INSERT INTO transactions_clustered (category, ts, txid, {', '.join(facts)}) "
+            f"SELECT b.category, b.ts, b.txid, {', '.join('t.' + column for column in facts)} "
+            f"FROM cluster_batch b JOIN transactions t ON t.id = b.id")
+        if details:
+            conn.execute(
+                f"INSERT INTO transaction_details_clustered "
+                f"(category, txid, {', '.join(details)}) "
+                f"SELECT b.category, b.txid, {', '.join('d.' + column for column in details)} "
+                f"FROM cluster_batch b JOIN transaction_details d ON d.transaction_id = b.id")
+        position = last
+
+    conn.execute("DROP TABLE temp.cluster_batch")
+    # Views would be rewritten by the renames; they are created anew
+    for table_name in CATEGORIES:
+        conn.execute(f"DROP VIEW IF EXISTS {table_name}")
+    conn.execute("DROP TABLE transaction_details")
+    conn.execute("DROP TABLE transactions")
+    conn.execute("ALTER TABLE transactions_clustered RENAME TO transactions")
+    conn.execute("ALTER TABLE transaction_details_clustered RENAME TO transaction_details")
+    for sql in index_ddl() + [sql for table_name in CATEGORIES for sql in view_ddl(table_name)]:
+        conn.execute(sql)
+    moved = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    print(f"Clustered {moved} rows of the transactions table on (category, ts, txid).")
+
+
+def legacy_tables(conn):
+    """Lists the categories still stored in a table of their own."""
+    return [table_name for table_name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN "
+        f"({', '.join('?' * len(CATEGORIES))})", list(CATEGORIES))]
+
+
+def add_ts_columns(conn):
+    """Migration: adds the ts column to category tables created without it."""
+    for table_name in legacy_tables(conn):
+        add_derived_columns(conn, table_name)
+
+
+def coerce_amounts(conn):
+    """Migration: rewrites text amounts of category tables as integers."""
+    for table_name in legacy_tables(conn):
+        coerce_stored_integers(conn, table_name)
+
+
+def unify_tables(conn, position=None):
+    """Migration: moves the category tables into the transactions table, one
+    table after the other, in batches (see move_to_transactions()).
+
+    Args:
+        conn: The database connection object.
+        position: The last rowid moved by an interrupted run, or None.
+
+    Yields:
+        (position, done, total) after each batch of the table being moved.
+    """
+    if position is None:
+        if not legacy_tables(conn):
+            return
+        for table_sql in schema_ddl():
+            conn.execute(table_sql)
+        seed_categories(conn)
+    else:
+        # An interrupted run stopped inside the table it had renamed
+        moving = [table_name for table_name, in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN "
+            f"({', '.join('?' * len(CATEGORIES))})",
+            [f"{table_name}_legacy" for table_name in CATEGORIES])]
+        for legacy in moving:
+            yield from move_to_transactions(conn, legacy[:-len('_legacy')], position)
+    for table_name in legacy_tables(conn):
+        yield from move_to_transactions(conn, table_name)
+
+
+def rekey_natural_keys(conn, position=None):
+    """Keys the transactions of categories with a natural key by
+    templates.natural_key(), in batches (see migrations.py).
+
+    Copies of a transaction, i.e. rows with the same natural key, are
+    removed, keeping the one stored first. The first batch adds the detail
+    columns added since (e.g. sender_account) to transaction_details. Each
+    batch then rekeys the rows of the next BATCH_SIZE or so timestamps. The
+    natural key includes the timestamp, so all the copies of a transaction are
+    in the same batch.
+
+    Args:
+        conn: The database connection object.
+        position: The last timestamp rekeyed by an interrupted run, or None.
+
+    Yields:
+        (position, done, total) after each batch: the last timestamp rekeyed,
+        and the number of rows of those categories rekeyed or checked so far
+        out of all of them.
+
+    Returns:
+        Two dictionaries, category -> number of rows rekeyed and of copies
+        removed.
+    """
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(transaction_details)")}
+    tables = [table_name for table_name, category in CATEGORIES.items()
+              if category['natural_key']]
+    rekeyed, copies = dict.fromkeys(tables, 0), dict.fromkeys(tables, 0)
+    if not existing or not tables:
+        return rekeyed, copies
+    categories = f"category IN ({', '.join(category_id(table_name) for table_name in tables)})"
+    conn.create_function('natural_key', -1, natural_key, deterministic=True)
+    if position is None:
+        for column, column_type in DETAIL_TYPES.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE transaction_details ADD COLUMN {column} {column_type}")
+        # Views hold no data; the current ones expose the natural key columns
+        for table_name in tables:
+            for sql in view_ddl(table_name):
+                conn.execute(sql)
+        position = conn.execute(
+            f"SELECT min(ts) - 1 FROM transactions WHERE {categories}").fetchone()[0]
+        if position is None:
+            return rekeyed, copies
+
+    done = conn.execute(f"SELECT COUNT(*) FROM transactions WHERE {categories} AND ts <= ?",
+                        (position,)).fetchone()[0]
+    total = conn.execute(f"SELECT COUNT(*) FROM transactions WHERE {categories}").fetchone()[0]
+    while True:
+        yield position, done, total
+        # The batch ends where the first category's next BATCH_SIZE rows do
+        ends = [end for end, in (conn.execute(
+            f"SELECT max(ts) FROM (SELECT ts FROM transactions "
+            f"WHERE category = {category_id(table_name)} AND ts > ? ORDER BY ts LIMIT ?)",
+            (position, BATCH_SIZE)).fetchone() for table_name in tables) if end is not None]
+        if not ends:
+            break
+        last = min(ends)
+        conn.execute("DROP TABLE IF EXISTS temp.rekey")
+        conn.execute("CREATE TEMP TABLE rekey (old INTEGER PRIMARY KEY, new INTEGER, copy INTEGER)")
+        for table_name in tables:
+            category = CATEGORIES[table_name]
+            conn.execute("DELETE FROM temp.rekey")
+            conn.execute(
+                f"INSERT INTO rekey SELECT old, new, row_number() OVER "
+                f"(PARTITION BY new ORDER BY old = new DESC, old DESC) "
+                f"FROM (SELECT {category['key']} AS old, "
+                f"natural_key({', '.join(category['natural_key'])}) AS new FROM {table_name} "
+                f"WHERE ts > ? AND ts <= ?)", (position, last))
+            # Rows written with their natural key while the migration runs
+            conn.execute(
+                f"UPDATE rekey SET copy = 2 WHERE copy = 1 AND old != new AND EXISTS "
+                f"(SELECT 1 FROM transactions WHERE category = {category_id(table_name)} "
+                f"AND txid = rekey.new)")
+            for table in ('transaction_details', 'transactions'):
+                conn.execute(f"DELETE FROM {table} WHERE category = {category_id(table_name)} "
+                             f"AND txid IN (SELECT old FROM rekey WHERE copy > 1)")
+                batch_rekeyed = conn.execute(
+                    f"UPDATE {table} SET txid = (SELECT new FROM rekey WHERE old = txid) "
+                    f"WHERE category = {category_id(table_name)} "
+                    f"AND txid IN (SELECT old FROM rekey WHERE copy = 1 AND old != new)").rowcount
+            rekeyed[table_name] += batch_rekeyed
+            copies[table_name] += conn.execute(
+                "SELECT COUNT(*) FROM rekey WHERE copy > 1").fetchone()[0]
+            done += conn.execute("SELECT COUNT(*) FROM rekey").fetchone()[0]
+        conn.execute("DROP TABLE rekey")
+        position = last
+    return rekeyed, copies
+
+
+def derive_natural_keys(conn, position=None):
+    """Migration: keys the transactions of categories with a natural key by it,
+    in batches (see rekey_natural_keys()).
+
+    They used to be numbered in insertion order, so a transfer ingested twice
+    was stored twice; the copies are removed.
+
+    Args:
+        conn: The database connection object.
+        position: The last timestamp rekeyed by an interrupted run, or None.
+
+    Yields:
+        See rekey_natural_keys().
+    """
+    rekeyed, copies = yield from rekey_natural_keys(conn, position)
+    for table_name in rekeyed:
+        if rekeyed[table_name] or copies[table_name]:
+            print(f"Keyed {rekeyed[table_name]} rows of {table_name} by their natural key "
+                  f"({copies[table_name]} copies removed).")
+
+
+def shorten_natural_keys(conn, position=None):
+    """Migration: rekeys transactions keyed by a 63-bit natural key with the
+    52-bit one, in batches (see rekey_natural_keys()).
+
+    JavaScript numbers only hold integers exactly up to 53 bits, so the
+    longer keys came back from the API rounded.
+
+    Args:
+        conn: The database connection object.
+        position: The last timestamp rekeyed by an interrupted run, or None.
+
+    Yields:
+        See rekey_natural_keys().
+    """
+    rekeyed, copies = yield from rekey_natural_keys(conn, position)
+    for table_name in rekeyed:
+        if rekeyed[table_name] or copies[table_name]:
+            print(f"Shortened the natural keys of {rekeyed[table_name]} rows of {table_name} "
+                  f"({copies[table_name]} copies removed).")
+
+
+def count_counterparty_totals(conn):
+    """Migration: totals the transactions of each counterparty in
+    counterparty_totals, which the triggers on transactions keep current from
+    then on.
+
+    Totals already there are counted again: unify_tables() may have started
+    them, and cluster_transactions() rebuilt transactions without the
+    triggers.
+
+    Args:
+        conn: The database connection object.
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                        "AND name = 'transactions'").fetchone():
+        return
+    for sql in counterparty_totals_ddl():
+        conn.execute(sql)
+    conn.execute("DELETE FROM counterparty_totals")
+    counted = conn.execute(
+        "INSERT INTO counterparty_totals (category, counterparty_id, total, count) "
+        "SELECT category, counterparty_id, ifnull(SUM(amount), 0), COUNT(*) FROM transactions "
+        "WHERE counterparty_id IS NOT NULL GROUP BY category, counterparty_id").rowcount
+    print(f"Totalled the transactions of {counted} counterparties.")
+
+
+# Every schema change since the category tables, in order (see migrations.py).
+# Append new ones with the next version; never renumber or edit applied ones.
+MIGRATIONS = [
+    Migration(1, 'ts columns', add_ts_columns, batched=False),
+    Migration(2, 'integer amounts', coerce_amounts, batched=False),
+    Migration(3, 'transactions table', unify_tables, batched=True),
+    Migration(4, 'counterparty kinds', add_counterparty_kinds, batched=False),
+    Migration(5, 'clustered transactions', cluster_transactions, batched=True),
+    Migration(6, 'natural keys', derive_natural_keys, batched=True),
+    Migration(7, '52-bit natural keys', shorten_natural_keys, batched=True),
+    Migration(8, 'counterparty totals', count_counterparty_totals, batched=False),
+]
+
+
+def seed_categories(conn):
+    """Adds the categories missing from the categories table."""
+    conn.executemany("INSERT INTO categories (name) VALUES (?) ON CONFLICT DO NOTHING",
+                     [(table_name,) for table_name in CATEGORIES])
+
+
+def create_tables(conn):
+    """Creates the transactions tables and category views, bringing existing
+    databases up to date (see MIGRATIONS).
+
+    Pending migrations are applied before it returns, however long they take.
+    Large ones run in resumable batches, between which other connections can
+    use the database.
+    """
+    create_table(conn, REJECTS_SQL)
+    apply_migrations(conn, MIGRATIONS)
+    for table_sql in schema_ddl():
+        create_table(conn, table_sql)
+    with conn:
+        seed_categories(conn)
+    # Views hold no data: they always follow the category definitions
+    for table_name in CATEGORIES:
+        for view_sql in view_ddl(table_name):
+            create_table(conn, view_sql)
+
+
+def analyze_transactions(conn):
+    """Gathers the statistics the query planner weighs the indexes of the
+    transactions table by. Without them it cannot tell a counterparty or an
+    amount range from the whole category (see queries.py)."""
+    with conn:
+        # Sampled, so it takes milliseconds on any size of table
+        conn.execute("PRAGMA analysis_limit = 1000")
+        conn.execute("ANALYZE transactions")
+
+
+def create_indexes(conn):
+    """Creates the secondary indexes of the transactions table, and drops the
+    ones no longer listed."""
+    for index_sql in index_ddl():
+        create_table(conn, index_sql)
+    names = [f"idx_transactions_{'_'.join(columns)}" for columns in TRANSACTION_INDEXES]
+    with conn:
+        for name, in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'transactions' "
+                f"AND name LIKE 'idx_%' AND name NOT IN ({', '.join('?' * len(names))})",
+                names).fetchall():
+            conn.execute(f"DROP INDEX {name}")
+    analyze_transactions(conn)
+
+
 def insert_data(conn, table_name, data, column_names):
     """Inserts data into the specified table.
 
+    A record whose key is already stored is skipped, see bulk_insert().
+
     Args:
         conn: The database connection object.
         table_name: The name of the table to insert data into.
         data: A dictionary containing the data to insert.
         column_names: A tuple of column names for the table.
     """
-    placeholders = ', '.join(['?'] * len(column_names)
-                             )  # dynamically create placeholders
-    columns = ', '.join(column_names)
-    sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
-
     try:
-        c = conn.cursor()
-        # Use data.get() for safer access
-        c.execute(sql, [data.get(col) for col in column_names])
-        conn.commit()
-        # flexible id
-        print(
-            f"Data inserted successfully into {table_name} with id {data.get('txid') or data.get('transaction_id')}")
-    except sqlite3.IntegrityError:
-        print(
-            f"Record with  id {data.get('txid') or data.get('transaction_id')} already exists in {table_name}. Skipping.")
+        inserted = bulk_insert(conn, table_name, [data], column_names, staging=False)
+        key = data.get(CATEGORIES[table_name]['key'])
+        if inserted:
+            print(f"Data inserted successfully into {table_name} with id {key}")
+        else:
+            print(f"Record with id {key} already exists in {table_name}. Skipping.")
     except sqlite3.Error as e:
         print(f"Error inserting data into {table_name}: {e}")
 
 
-def load_and_insert_data(conn, table_name, json_file_path, column_names):
-    """Loads data from a JSON file and inserts it into the database.
+def iter_batches(records, batch_size):
+    """Groups an iterable of records into lists of at most batch_size."""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Counterparties:
+    """Interns counterparties: maps (kind, name, phone) to their id.
+
+    The counterparties table is read once; a counterparty met for the first
+    time is inserted in the caller's current transaction. Rows are then written
+    with their counterparty_id, which spares the insert triggers a lookup.
+
+    Args:
+        conn: The database connection object.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.ids = {(kind, name, phone): counterparty_id for counterparty_id, kind, name, phone
+                    in conn.execute("SELECT id, kind, name, phone FROM counterparties")}
+
+    def resolve(self, kind, name, phone=None):
+        """Returns the id of a counterparty, inserting it if it is new.
+
+        Args:
+            kind: The kind of counterparty, e.g. 'agent'.
+            name: Its name; None if the message had none.
+            phone: Its phone number, if known.
+
+        Returns:
+            The counterparty id, or None without a name.
+        """
+        if name is None:
+            return None
+        key = (kind, name, phone or None)
+        counterparty_id = self.ids.get(key)
+        if counterparty_id is None:
+            counterparty_id = self.ids[key] = self.conn.execute(
+                "INSERT INTO counterparties (kind, name, phone) VALUES (?, ?, ?)", key).lastrowid
+        return counterparty_id
+
+
+def bulk_insert(conn, table_name, records, column_names, batch_size=BATCH_SIZE,
+                staging=None):
+    """Inserts many records, one executemany() and one transaction per batch.
+
+    Records whose key already exists are skipped by the category's insert
+    trigger (ON CONFLICT DO NOTHING), so loading the same records twice is
+    harmless and costs no exception per row. When the category already
+    holds rows, the batches are first written to an index-free temporary table
+    and merged in one INSERT ... SELECT, so readers see the load all at once.
+
+    Args:
+        conn: The database connection object.
+        table_name: The name of the table to insert data into.
+        records: An iterable of dictionaries, one per row.
+        column_names: A tuple of column names for the table.
+        batch_size: The number of rows per batch.
+        staging: Whether to go through a temporary table; by default only when
+            the table is not empty.
+
+    Returns:
+        The number of rows inserted.
+    """
+    name, phone, kind = counterparty_columns(table_name)
+    if name:
+        counterparties = Counterparties(conn)
+        column_names = tuple(column_names) + ('counterparty_id',)
+
+    def row(record):
+        if name:
+            record['counterparty_id'] = counterparties.resolve(
+                kind, record.get(name), record.get(phone) if phone else None)
+        return [record.get(col) for col in column_names]
+
+    columns = ', '.join(column_names)
+    placeholders = ', '.join(['?'] * len(column_names))
+    if staging is None:
+        staging = conn.execute(f"SELECT 1 FROM {table_name} LIMIT 1").fetchone() is not None
+
+    target = f"temp.staging_{table_name}" if staging else table_name
+    if staging:
+        conn.execute(f"DROP TABLE IF EXISTS {target}")
+        conn.execute(f"CREATE TABLE {target} ({columns})")
+    sql = f"INSERT INTO {target} ({columns}) VALUES ({placeholders})"
+
+    # Inserts through a view's trigger are not counted by total_changes
+    before = count_transactions(conn, table_name)
+    for batch in iter_batches(records, batch_size):
+        with conn:  # One transaction per batch
+            conn.executemany(sql, [row(record) for record in batch])
+
+    if staging:
+        with conn:
+            conn.execute(f"INSERT INTO {table_name} ({columns}) "
+                         f"SELECT {columns} FROM {target}")
+        conn.execute(f"DROP TABLE {target}")
+    return count_transactions(conn, table_name) - before
+
+
+def iter_json_array(f, chunk_size=JSON_CHUNK_SIZE):
+    """Reads a top-level JSON array one element at a time.
+
+    Only the element being decoded and one chunk of text are held in memory,
+    whatever the size of the file.
+
+    Args:
+        f: A text file object positioned at the start of the array.
+        chunk_size: The number of characters to read at a time.
+
+    Yields:
+        The decoded elements, in order.
+
+    Raises:
+        json.JSONDecodeError: If the file is not a JSON array, or if anything
+            but whitespace follows it.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def skip_whitespace():
+        nonlocal position
+        while True:
+            position = JSON_WHITESPACE.match(buffer, position).end()
+            if position < len(buffer) or eof:
+                return
+            fill()
+
+    def expect_end():
+        skip_whitespace()
+        if position < len(buffer):
+            raise json.JSONDecodeError("Extra data", buffer, position)
+
+    skip_whitespace()
+    if not buffer.startswith('[', position):
+        raise json.JSONDecodeError("Expected '['", buffer, position)
+    position += 1
+    skip_whitespace()
+    if buffer.startswith(']', position):
+        position += 1
+        expect_end()
+        return
+
+    while True:
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+
+        separator = JSON_SEPARATOR.match(buffer, end)
+        # The element (a number, say) or its separator may continue in the
+        # next chunk: read on and decode it again
+        if not eof and (separator is None or separator.end() == len(buffer)):
+            fill()
+            continue
+        if separator is None:
+            raise json.JSONDecodeError("Expected ',' or ']'", buffer, end)
+
+        yield element
+        position = separator.end()
+        if separator.group(1) == ']':
+            expect_end()
+            return
+
+
+def iter_json_records(json_file_path, chunk_size=JSON_CHUNK_SIZE):
+    """Streams the records of a JSON export.
+
+    The other formats written by helpers.JsonWriter are picked up in their
+    place: for data/bank_transfers.json, the first of bank_transfers.ndjson,
+    bank_transfers.ndjson.gz, bank_transfers.json and bank_transfers.json.gz
+    that exists is read.
+
+    Args:
+        json_file_path: The path to the JSON (array) or NDJSON file.
+        chunk_size: See iter_json_array().
+
+    Yields:
+        The records, one dictionary at a time.
+    """
+    candidates = [export_filename(json_file_path, ndjson, compress)
+                  for ndjson in (True, False) for compress in (False, True)]
+    json_file_path = next(
+        (path for path in candidates if os.path.exists(path)), json_file_path)
+
+    opener = gzip.open if json_file_path.endswith('.gz') else open
+    with opener(json_file_path, 'rt') as f:
+        if json_file_path.endswith(('.ndjson', '.ndjson.gz')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(f, chunk_size)
+
+
+def upgrade_record(table_name, record):
+    """Moves the fields of records exported by older scrapers to their columns.
+
+    The first scraper exported transfers to mobile numbers with the sender
+    account in date and the timestamp in time.
+
+    Args:
+        table_name: The table the record is meant for.
+        record: The record, updated in place.
+
+    Returns:
+        The same record.
+    """
+    if table_name == 'transfers_to_mobile_numbers' and 'time' in record \
+            and 'sender_account' not in record:
+        record['sender_account'] = record.pop('date', None)
+        record['date'] = record.pop('time')
+    return record
+
+
+def load_and_insert_data(conn, table_name, json_file_path, column_names,
+                         batch_size=BATCH_SIZE):
+    """Streams data from a JSON file and bulk inserts it into the database.
+
+    Records are read incrementally (see iter_json_records()), so memory stays
+    bounded by the batch size rather than the file size.
 
     Args:
         conn: The database connection object.
         table_name: The name of the table to insert data into.
-        json_file_path: The path to the JSON file containing the data.
+        json_file_path: The path to the JSON or NDJSON file containing the data.
         column_names: A tuple of column names for the table.
+        batch_size: The number of rows per batch, see bulk_insert().
+
+    Returns:
+        The number of rows inserted.
     """
     try:
-        with open(json_file_path, 'r') as f:
-            data = json.load(f)
-            for record in data:
-                insert_data(conn, table_name, record, column_names)
+        start = time.perf_counter()
+        rejects = []
+
+        required = ['ts', CATEGORIES[table_name]['key']]
+
+        def typed_records():
+            for record in iter_json_records(json_file_path):
+                try:
+                    # Exports written before a derived column existed lack it
+                    record = coerce_integers(table_name, derive_columns(
+                        table_name, upgrade_record(table_name, record)))
+                except ValueError as e:
+                    rejects.append((record, str(e)))
+                    continue
+                # The transactions table is keyed on both
+                missing = [column for column in required if record.get(column) is None]
+                if missing:
+                    rejects.append((record, f"{', '.join(missing)}: missing"))
+                else:
+                    yield record
+
+        inserted = bulk_insert(conn, table_name, typed_records(), column_names, batch_size)
+        with conn:
+            log_rejects(conn, table_name, rejects)
+        elapsed = time.perf_counter() - start
+        print(f"Loaded {inserted} new rows into {table_name} in {elapsed:.2f}s "
+              f"({inserted / elapsed if elapsed else 0:,.0f} rows/s).")
+        return inserted
     except FileNotFoundError:
         print(f"Error: File not found: {json_file_path}")
     except json.JSONDecodeError:
         print(f"Error: Invalid JSON format in file: {json_file_path}")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
+    return 0
 
 
 def main():
     """Main function to create tables and load data."""
+    parser = argparse.ArgumentParser(
+        description="Create the database and load the JSON exports into it.")
+    parser.add_argument('--database', default=DATABASE_NAME)
+    parser.add_argument('--migrate', action='store_true',
+                        help="only bring the schema up to date; large migrations run "
+                             "in resumable batches, and the app can read the database "
+                             "between them")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    inserted = 0
+    with create_connection(args.database) as conn:
+        create_tables(conn)
+        if args.migrate:
+            create_indexes(conn)
+            return
+        for table_name, category in CATEGORIES.items():
+            inserted += load_and_insert_data(
+                conn, table_name, category['json_file'], TABLE_COLUMNS[table_name])
+        # Secondary indexes are built after the load, in one pass
+        create_indexes(conn)
+
+    elapsed = time.perf_counter() - start
+    print(f"Data loading complete: {inserted} rows in {elapsed:.2f}s "
+          f"({inserted / elapsed if elapsed else 0:,.0f} rows/s).")
+
 
-    table_schemas = {
-        'airtime_payments': {
-            'sql': """
-                CREATE TABLE IF NOT EXISTS airtime_payments (
-                    date TEXT,
-                    txid TEXT PRIMARY KEY, 
-                    payment_amount INTEGER,
-                    fee INTEGER,
-                    new_balance INTEGER
-                )
-            """,
-            'columns': ('date', 'txid', 'payment_amount', 'fee', 'new_balance')
-        },
-        'incoming_money': {
-            'sql': """
-                CREATE TABLE IF NOT EXISTS incoming_money (
-                    date TEXT,
-                    txid TEXT PRIMARY KEY, 
-                    amount_received INTEGER,
-                    sender TEXT ,
-                    new_balance INTEGER
-                )
-            """,
-            'columns': ('date', 'txid', 'amount_received', 'sender', 'new_balance')
-        },
-        'transfers_to_mobile_numbers': {
-            'sql': """
-                CREATE TABLE IF NOT EXISTS transfers_to_mobile_numbers (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                    date TEXT,
-                    amount_transferred INTEGER,
-                    new_balance INTEGER,
-                    fee INTEGER,
-                    recipient TEXT,
-                    recipient_number TEXT
-                )
-            """,
-            'columns': ('date', 'recipient_number', 'amount_transferred', 'recipient', 'new_balance', 'fee')
-        },
-        'cash_power_bill_payments': {
-            'sql': """
-                CREATE TABLE IF NOT EXISTS cash_power_bill_payments (
-                    transaction_id TEXT PRIMARY KEY, 
-                    date TEXT,
-                    payment_amount INTEGER,
-                    new_balance INTEGER,
-                    fee INTEGER,
-                    token TEXT,
-                    provider TEXT
-                )
-            """,
-            'columns': ('transaction_id', 'date', 'payment_amount', 'new_balance', 'fee', 'token', 'provider')
-        },
-        'withdrawals_from_agents': {
-            'sql': """
-                CREATE TABLE IF NOT EXISTS withdrawals_from_agents (
-                    transaction_id TEXT PRIMARY KEY, 
-                    date TEXT,
-                    name TEXT,
-                    agent_name TEXT,
-                    agent_number TEXT,
-                    account TEXT,
-                    amount INTEGER,
-                    new_balance INTEGER,
-                    fee INTEGER
-                )
-            """,
-            'columns': ('transaction_id', 'date', 'name', 'agent_name', 'agent_number', 'account', 'amount', 'new_balance', 'fee')
-        },
-        'internet_voice_bundles': {
-            'sql': """
-                CREATE TABLE IF NOT EXISTS internet_voice_bundles (
-                    transaction_id TEXT PRIMARY KEY, 
-                    date TEXT,
-                    amount INTEGER,
-                    new_balance INTEGER,
-                    service TEXT
-                )
-            """,
-            'columns': ('transaction_id', 'date', 'amount', 'new_balance', 'service')
-        },
-        'payment_to_code_holders': {
-            'sql': """
-                CREATE TABLE IF NOT EXISTS payment_to_code_holders (
-                    transaction_id TEXT PRIMARY KEY, 
-                    date TEXT,
-                    amount INTEGER,
-                    new_balance INTEGER,
-                    recipient TEXT
-                )
-            """,
-            'columns': ('transaction_id', 'date', 'amount', 'new_balance', 'recipient')
-        },
-        'bank_transfers': {
-            'sql': """
-                CREATE TABLE IF NOT EXISTS bank_transfers (
-                    transaction_id TEXT PRIMARY KEY, 
-                    date TEXT,
-                    amount INTEGER,
-                    recipient_name TEXT,
-                    recipient_phone TEXT,
-                    sender_account TEXT
-                )
-            """,
-            'columns': ('transaction_id', 'date', 'amount', 'recipient_name', 'recipient_phone', 'sender_account')
-        },
-        'transactions_initiated_by_third_parties': {
-            'sql': """
-                CREATE TABLE IF NOT EXISTS transactions_initiated_by_third_parties (
-                    transaction_id TEXT PRIMARY KEY, 
-                    external_transaction_id TEXT,
-                    date TEXT,
-                    amount INTEGER,
-                    sender TEXT,
-                    fee INTEGER,
-                    new_balance INTEGER
-                )
-            """,
-            'columns': ('transaction_id', 'external_transaction_id', 'date', 'amount', 'sender', 'fee', 'new_balance')
-        },
-    }
-
-    data_files = {
-        'airtime_payments': './data/airtime_payments.json',
-        'incoming_money': './data/incoming_money_table.json',
-        'transfers_to_mobile_numbers': './data/transfer_to_mobile_numbers.json',
-        'cash_power_bill_payments': './data/cash_power_bill_payments.json',
-        'withdrawals_from_agents': './data/withdrawals_from_agents.json',
-        'internet_voice_bundles': './data/internet_voice_bundles.json',
-        'payment_to_code_holders': './data/payment_to_code_holders.json',
-        'bank_transfers': './data/bank_transfers.json',
-        'transactions_initiated_by_third_parties': './data/transactions_initiated_by_third_parties.json',
-    }
-
-    with create_connection(DATABASE_NAME) as conn:
-        for table_name, schema in table_schemas.items():
-            create_table(conn, schema['sql'])
-            load_and_insert_data(
-                conn, table_name, data_files[table_name], schema['columns'])
-
-    print("Data loading complete.")
-
-
-if _name_ == "_main_":
-    main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
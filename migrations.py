@@ -0,0 +1,122 @@
+import sqlite3
+import time
+from collections import namedtuple
+from typing import Iterator, List, Sequence, Tuple
+
+# Migrations applied to a database, one row per version
+SCHEMA_VERSION_SQL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at INTEGER NOT NULL
+)
+"""
+
+# Batched migrations under way: where the next batch starts, and how far along
+# they are (in the migration's own units, e.g. row ids)
+MIGRATION_PROGRESS_SQL = """
+CREATE TABLE IF NOT EXISTS migration_progress (
+    version INTEGER PRIMARY KEY,
+    position INTEGER,
+    done INTEGER,
+    total INTEGER,
+    updated_at INTEGER
+)
+"""
+
+# A schema change. step(conn) runs in one transaction, together with the
+# schema_version row recording it. A batched step is a generator function
+# step(conn, position) instead: each batch, i.e. the code up to its next
+# yield of (position, done, total), is a transaction of its own, so other
+# connections (the app reading, say) get the database back between batches.
+# The migration still blocks the process applying it, which waits for the last
+# batch; the version is recorded with it. An interrupted batched migration
+# resumes from the position of its last batch.
+#
+# Databases created before schema_version start at version 0, whatever state
+# they are in, so every step checks whether it applies and does nothing if
+# not.
+Migration = namedtuple('Migration', ['version', 'name', 'step', 'batched'])
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    """The version of a database: its last applied migration, or 0."""
+    conn.execute(SCHEMA_VERSION_SQL)
+    return conn.execute("SELECT ifnull(max(version), 0) FROM schema_version").fetchone()[0]
+
+
+def pending_migrations(conn: sqlite3.Connection,
+                       migrations: Sequence[Migration]) -> List[Migration]:
+    """Lists the migrations not applied to a database yet, in order."""
+    current = schema_version(conn)
+    return sorted((migration for migration in migrations if migration.version > current),
+                  key=lambda migration: migration.version)
+
+
+def record_version(conn: sqlite3.Connection, migration: Migration) -> None:
+    """Marks a migration as applied, in the caller's transaction."""
+    conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                 (migration.version, migration.name, int(time.time())))
+
+
+def run_batches(conn: sqlite3.Connection, migration: Migration) -> None:
+    """Runs a batched migration one transaction per batch, printing progress."""
+    conn.execute(MIGRATION_PROGRESS_SQL)
+    saved = conn.execute("SELECT position FROM migration_progress WHERE version = ?",
+                         (migration.version,)).fetchone()
+    batches: Iterator[Tuple[int, int, int]] = migration.step(conn, saved[0] if saved else None)
+    while True:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                position, done, total = next(batches)
+            except StopIteration:
+                conn.execute("DELETE FROM migration_progress WHERE version = ?",
+                             (migration.version,))
+                record_version(conn, migration)
+                return
+            conn.execute(
+                "INSERT INTO migration_progress "
+                "(version, position, done, total, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (version) DO UPDATE SET position = excluded.position, "
+                "done = excluded.done, total = excluded.total, updated_at = excluded.updated_at",
+                (migration.version, position, done, total, int(time.time())))
+        if total:
+            print(f"  {migration.name}: {done:,} of {total:,} ({done / total:.0%})")
+
+
+def apply_migrations(conn: sqlite3.Connection, migrations: Sequence[Migration]) -> int:
+    """
+    Brings a database up to date with its migrations.
+
+    Returns once every pending migration is applied, batched ones included:
+    their batches only let other connections in between.
+
+    Args:
+        conn: The database connection object.
+        migrations (Sequence[Migration]): Every migration of the schema.
+
+    Returns:
+        int: The version the database is at.
+
+    Raises:
+        sqlite3.Error: If a migration fails. Its transaction (or current
+            batch) is rolled back, and later migrations are not attempted.
+    """
+    for migration in pending_migrations(conn, migrations):
+        start = time.perf_counter()
+        try:
+            if migration.batched:
+                run_batches(conn, migration)
+            else:
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    migration.step(conn)
+                    record_version(conn, migration)
+        except sqlite3.Error as e:
+            print(f"Migration {migration.version} ({migration.name}) failed, "
+                  f"rolled back: {e}")
+            raise
+        print(f"Applied migration {migration.version} ({migration.name}) "
+              f"in {time.perf_counter() - start:.2f}s.")
+    return schema_version(conn)
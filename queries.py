@@ -0,0 +1,337 @@
+import argparse
+import itertools
+import re
+import sqlite3
+import sys
+from typing import Dict, List, Mapping, Sequence, Tuple
+from constants import CATEGORIES
+from init_db import DATABASE_NAME, create_connection, create_indexes, create_tables
+from schema import amount_column, category_id, counterparty_columns
+from templates import epoch_seconds
+
+# Filter parameters of the read endpoints -> (fact column, SQL operator).
+# Dates are Kigali time, 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'; to is
+# exclusive. Amounts are inclusive. counterparty is an id, as listed by the
+# /counterparties endpoints.
+FILTERS = {
+    'from': ('ts', '>='),
+    'to': ('ts', '<'),
+    'min_amount': ('amount', '>='),
+    'max_amount': ('amount', '<='),
+    'counterparty': ('counterparty_id', '='),
+}
+
+# Values SQLite can bind as an INTEGER
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+# Sort parameters of the category endpoints ('-' for descending) -> the fact
+# column leading the order. Ties are broken by (ts, txid), so every order is
+# a range of an index (see schema.TRANSACTION_INDEXES).
+SORTS = {'ts': 'ts', '-ts': 'ts', 'amount': 'amount', '-amount': 'amount'}
+
+# Sort parameters of the counterparty endpoints -> the total ordered by
+COUNTERPARTY_SORTS = {'-total': 'total', 'total': 'total', '-count': 'count', 'count': 'count'}
+
+# Fact columns of the transactions table, for the filters of the counterparty
+# endpoints
+TRANSACTION_COLUMNS = {'ts': 'ts', 'amount': 'amount', 'counterparty_id': 'counterparty_id'}
+
+# A query plan step reading the fact table (t in the category views), and the
+# constraints of its index search
+FACT_TABLE_STEP = re.compile(r"^(SCAN|SEARCH) (?:t|transactions)\b[^(]*(?:\((.*)\))?$")
+
+
+def hidden(column: str, filters: Dict[str, int], ordered_by: Tuple[str, ...]) -> str:
+    """
+    Hides a column of an ORDER BY or GROUP BY from the query planner when the
+    filters narrow the query down by other indexes.
+
+    Left to itself, the planner prefers an index that is already in the
+    requested order (no sort) to one that matches the filters: it reads the
+    whole category and filters it, however few rows match. A unary + keeps
+    the column out of the index choice, so the filtered index is searched
+    and only the rows it selects are sorted.
+
+    Args:
+        column (str): The SQL column.
+        filters (Dict[str, int]): Filters, see parse_filters().
+        ordered_by (Tuple[str, ...]): The fact columns of the filters whose
+            index is already in the requested order.
+
+    Returns:
+        str: The column, or +column.
+    """
+    filtered = {FILTERS[name][0] for name in filters}
+    return f"+{column}" if filtered and not filtered & set(ordered_by) else column
+
+
+def view_columns(table: str) -> Dict[str, str]:
+    """Maps the fact columns the endpoints filter and sort on to the columns
+    of a category view."""
+    columns = {'ts': 'ts', 'txid': CATEGORIES[table]['key'], 'amount': amount_column(table)}
+    if counterparty_columns(table)[0]:
+        columns['counterparty_id'] = 'counterparty_id'
+    return columns
+
+
+def parse_filters(args: Mapping[str, str]) -> Dict[str, int]:
+    """
+    Reads the filter parameters of a request (see FILTERS).
+
+    Args:
+        args (Mapping[str, str]): The query string parameters.
+
+    Returns:
+        Dict[str, int]: The filters given, with their values as integers
+        (dates as epoch seconds).
+
+    Raises:
+        ValueError: If a value is not a date or a 64-bit integer.
+    """
+    filters = {}
+    for name, (column, _) in FILTERS.items():
+        value = args.get(name)
+        if not value:
+            continue
+        try:
+            filters[name] = epoch_seconds(value) if column == 'ts' else int(value)
+        except ValueError:
+            filters[name] = None
+        if filters[name] is None or not INT64_MIN <= filters[name] <= INT64_MAX:
+            expected = "a date (YYYY-MM-DD[ HH:MM:SS])" if column == 'ts' else "a 64-bit integer"
+            raise ValueError(f"{name} must be {expected}")
+    return filters
+
+
+def filter_conditions(filters: Dict[str, int],
+                      columns: Dict[str, str]) -> Tuple[List[str], List[int]]:
+    """
+    Translates filters to SQL conditions, with their parameters.
+
+    Args:
+        filters (Dict[str, int]): Filters, see parse_filters().
+        columns (Dict[str, str]): Fact column -> column of the queried table.
+
+    Returns:
+        Tuple[List[str], List[int]]: The conditions and their parameters.
+
+    Raises:
+        ValueError: If the table has no column for a filter, e.g. a
+            counterparty filter on a category without counterparties.
+    """
+    conditions = []
+    params = []
+    for name, value in filters.items():
+        column, operator = FILTERS[name]
+        if column not in columns:
+            raise ValueError(f"{name} is not supported by this endpoint")
+        conditions.append(f"{columns[column]} {operator} ?")
+        params.append(value)
+    return conditions, params
+
+
+def keyset_page(select: str, conditions: List[str], params: List, order: Sequence[str],
+                descending: bool, after: List[int] | None, limit: int) -> Tuple[str, List]:
+    """
+    Completes a query to read one page of its rows in a given order.
+
+    The page starts after the sort key of the last row of the previous page
+    (a row value comparison), so reading page n costs the same as page 1.
+
+    Args:
+        select (str): The SELECT ... FROM ... part of the query.
+        conditions (List[str]): Conditions on its rows.
+        params (List): Their parameters.
+        order (Sequence[str]): The expressions of the sort key. Together
+            they must be unique.
+        descending (bool): Whether the order is descending.
+        after (List[int] | None): The sort key to start after, or None.
+        limit (int): The most rows to read.
+
+    Returns:
+        Tuple[str, List]: The query and its parameters.
+    """
+    conditions = list(conditions)
+    params = list(params)
+    if after is not None:
+        conditions.append(f"({', '.join(order)}) {'<' if descending else '>'} "
+                          f"({', '.join('?' * len(order))})")
+        params += after
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ''
+    direction = ' DESC' if descending else ''
+    return (f"{select} {where}ORDER BY {', '.join(column + direction for column in order)} "
+            f"LIMIT ?", params + [limit])
+
+
+def category_query(table: str, filters: Dict[str, int], sort: str = 'ts',
+                   after: List[int] | None = None,
+                   limit: int = 100) -> Tuple[str, List, List[str]]:
+    """
+    Builds the query of one page of a category endpoint.
+
+    Args:
+        table (str): The category (a key of constants.CATEGORIES).
+        filters (Dict[str, int]): Filters, see parse_filters().
+        sort (str): A key of SORTS. Sorting by amount leaves out the rows
+            without one.
+        after (List[int] | None): The sort key to start after, or None.
+        limit (int): The most rows to read.
+
+    Returns:
+        Tuple[str, List, List[str]]: The query, its parameters, and the
+        columns of the sort key in its rows (the cursor of the next page).
+
+    Raises:
+        ValueError: If the sort or a filter is not supported.
+    """
+    if sort not in SORTS:
+        raise ValueError(f"sort must be one of {', '.join(SORTS)}")
+    columns = view_columns(table)
+    conditions, params = filter_conditions(filters, columns)
+    key = [columns['ts'], columns['txid']]
+    # The indexes whose order serves the sort (see schema.TRANSACTION_INDEXES)
+    ordered_by = ('ts', 'counterparty_id')
+    if SORTS[sort] == 'amount':
+        key = [columns['amount']] + key
+        ordered_by = ('amount',)
+        conditions.append(f"{columns['amount']} IS NOT NULL")
+    order = [hidden(column, filters, ordered_by) for column in key]
+    sql, params = keyset_page(f"SELECT * FROM {table}", conditions, params, order,
+                              sort.startswith('-'), after, limit)
+    return sql, params, key
+
+
+def counterparties_query(table: str, filters: Dict[str, int], sort: str = '-total',
+                         after: List[int] | None = None,
+                         limit: int = 100) -> Tuple[str, List, List[str]]:
+    """
+    Builds the query of one page of a counterparty endpoint: the
+    transactions of a category matching the filters, totalled per
+    counterparty.
+
+    Without filters on the transactions themselves (a counterparty filter
+    aside), the page is a range of the counterparty_totals index in the
+    requested order, whatever the size of the category. Date and amount
+    filters need totals of just the matching transactions: those are
+    computed for every page, over the rows the filters select.
+
+    Args:
+        table (str): The category (a key of constants.CATEGORIES).
+        filters (Dict[str, int]): Filters on the transactions, see
+            parse_filters().
+        sort (str): A key of COUNTERPARTY_SORTS.
+        after (List[int] | None): The sort key to start after, or None.
+        limit (int): The most rows to read.
+
+    Returns:
+        Tuple[str, List, List[str]]: The query, its parameters, and the
+        columns of the sort key in its rows.
+
+    Raises:
+        ValueError: If the sort is not supported.
+    """
+    if sort not in COUNTERPARTY_SORTS:
+        raise ValueError(f"sort must be one of {', '.join(COUNTERPARTY_SORTS)}")
+    if set(filters) <= {'counterparty'}:
+        conditions, params = filter_conditions(filters, {'counterparty_id': 'g.counterparty_id'})
+        select = ("SELECT c.id, c.kind, c.name, c.phone, g.total, g.count "
+                  "FROM counterparty_totals g JOIN counterparties c ON c.id = g.counterparty_id")
+        sql, params = keyset_page(select, [f"g.category = {category_id(table)}"] + conditions,
+                                  params,
+                                  [f"g.{COUNTERPARTY_SORTS[sort]}", 'g.counterparty_id'],
+                                  sort.startswith('-'), after, limit)
+        return sql, params, [COUNTERPARTY_SORTS[sort], 'id']
+
+    conditions, params = filter_conditions(filters, TRANSACTION_COLUMNS)
+    # Grouped on the integer counterparty_id; names are joined once per group
+    select = (f"SELECT c.id, c.kind, c.name, c.phone, g.total, g.count "
+              f"FROM (SELECT counterparty_id, ifnull(SUM(amount), 0) AS total, "
+              f"COUNT(*) AS count FROM transactions "
+              f"WHERE {' AND '.join([f'category = {category_id(table)}'] + conditions)} "
+              f"GROUP BY {hidden('counterparty_id', filters, ('counterparty_id',))}) g "
+              f"JOIN counterparties c ON c.id = g.counterparty_id")
+    sql, params = keyset_page(select, [], params, [f"g.{COUNTERPARTY_SORTS[sort]}", 'c.id'],
+                              sort.startswith('-'), after, limit)
+    return sql, params, [COUNTERPARTY_SORTS[sort], 'id']
+
+
+def full_scans(conn: sqlite3.Connection) -> List[str]:
+    """
+    Lists the filter and sort combinations of the endpoints whose query
+    plan reads a whole category, with the offending plan step.
+
+    A query with filters must search an index on one of the filtered columns
+    (the primary key for dates). A query without filters reads the category,
+    or its counterparty totals, in the requested order, so it may not need a
+    sort. Plans depend on the
+    statistics of the table (see init_db.analyze_transactions()), so check
+    a database holding data.
+
+    Args:
+        conn: A connection to a database with the current schema and indexes.
+
+    Returns:
+        List[str]: A description of each full scan; empty if there is none.
+    """
+    problems = []
+    values = {'from': '2024-01-01', 'to': '2025-01-01', 'min_amount': 1000,
+              'max_amount': 5000, 'counterparty': 1}
+    for table in CATEGORIES:
+        names = [name for name in FILTERS if FILTERS[name][0] in view_columns(table)]
+        combinations = [combination for size in range(len(names) + 1)
+                        for combination in itertools.combinations(names, size)]
+        queries = []
+        for combination, after in itertools.product(combinations, (False, True)):
+            filters = parse_filters({name: str(values[name]) for name in combination})
+            for sort in SORTS:
+                sql, params, key = category_query(table, filters, sort,
+                                                  [0] * (3 if SORTS[sort] == 'amount' else 2)
+                                                  if after else None)
+                queries.append((f"{table}?sort={sort}", combination, after, sql, params))
+            if counterparty_columns(table)[0]:
+                for sort in COUNTERPARTY_SORTS:
+                    sql, params, key = counterparties_query(table, filters, sort,
+                                                            [0, 0] if after else None)
+                    queries.append((f"{table}/counterparties?sort={sort}", combination,
+                                    after, sql, params))
+
+        for endpoint, combination, after, sql, params in queries:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            filtered = {FILTERS[name][0] for name in combination}
+            if not filtered and 'USE TEMP B-TREE FOR ORDER BY' in plan:
+                problems.append(f"{endpoint} with no filters{' (next page)' if after else ''}: "
+                                f"USE TEMP B-TREE FOR ORDER BY")
+            for step in plan:
+                match = FACT_TABLE_STEP.match(step)
+                if not match:
+                    continue
+                searched = set(re.findall(r"\w+", match.group(2) or '')) & filtered
+                if match.group(1) == 'SCAN' or (filtered and not searched):
+                    problems.append(f"{endpoint} with {', '.join(combination) or 'no filters'}"
+                                    f"{' (next page)' if after else ''}: {step}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that every filter of the read endpoints is served by an index.")
+    parser.add_argument('--database', default=DATABASE_NAME)
+    args = parser.parse_args()
+
+    with create_connection(args.database) as conn:
+        create_tables(conn)
+        create_indexes(conn)
+        if not conn.execute("SELECT 1 FROM transactions LIMIT 1").fetchone():
+            print(f"{args.database} holds no transactions: the query planner has "
+                  f"no statistics to choose indexes by. Load some data first.")
+            sys.exit(2)
+        problems = full_scans(conn)
+    for problem in problems:
+        print(f"Full scan: {problem}")
+    print(f"{len(problems)} filter combination(s) fall back to a full scan.")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+from typing import Dict, List, Tuple
+from constants import CATEGORIES
+from templates import COLUMN_TYPES, KIGALI_OFFSET, MATCHERS, TABLE_COLUMNS
+
+# Every category is stored in one fact table, transactions, which holds the
+# columns all categories share and the id of the category (see categories).
+# What is specific to a category goes to the transaction_details sidecar, and
+# names and phone numbers to counterparties.
+#
+# Both tables are WITHOUT ROWID and clustered on (category, ts, txid): a
+# category's transactions are stored in date order, so date ranges and the
+# read endpoints scan one contiguous stretch of the table, and the key is not
+# stored a second time in a rowid table. txid is the transaction id as an
+# integer; messages without one (transfers to mobile numbers) get one derived
+# from their natural key (see constants.CATEGORIES).
+#
+# Each category table name (e.g. incoming_money) is a view over the three with
+# the category's original columns and its counterparty_id. Views get an
+# INSTEAD OF INSERT trigger, so the category "tables" are still written with
+# INSERT INTO <category> (<columns>) VALUES (...). A transaction that is
+# already stored is skipped (ON CONFLICT DO NOTHING), so writing the same
+# records again changes nothing. Writers that already know the
+# counterparty_id (see init_db.Counterparties) pass it along and the trigger
+# skips the lookup.
+
+# Fact column -> SQLite column type (category aside)
+FACT_COLUMNS = {
+    'ts': 'INTEGER NOT NULL',
+    'txid': 'INTEGER NOT NULL',
+    'amount': 'INTEGER',
+    'fee': 'INTEGER',
+    'balance_after': 'INTEGER',
+    'counterparty_id': 'INTEGER REFERENCES counterparties (id)',
+}
+
+# Detail columns that usually restate a fact column, and the SQL rendering them
+# from it ({ts} stands for the ts column). They are only stored when they say
+# something else, e.g. dates written differently by older parsers, and a
+# transaction with nothing else to add gets no transaction_details row at all.
+IMPLIED_COLUMNS = {
+    'date': f"datetime({{ts}} + {KIGALI_OFFSET}, 'unixepoch')",  # Same format as strftime, faster
+}
+
+# Category ids, so the fact table and its indexes store a small integer
+# rather than the category name in every row
+CATEGORIES_SQL = """
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+)
+"""
+
+# Every sender, recipient, agent and biller, stored once. phone is the number
+# as the message shows it: in full, or masked down to a suffix (*********013)
+COUNTERPARTIES_SQL = """
+CREATE TABLE IF NOT EXISTS counterparties (
+    id INTEGER PRIMARY KEY,
+    kind TEXT,
+    name TEXT,
+    phone TEXT
+)
+"""
+
+# Looked up by the insert triggers, so it is created with the table
+COUNTERPARTY_KEY_SQL = """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_counterparties_key
+ON counterparties (kind, name, ifnull(phone, ''))
+"""
+
+# Per counterparty of a category, the sum of the amounts of its transactions
+# (NULL amounts count as 0) and their number. The counterparty endpoints page
+# over it rather than totalling the whole category for every page. Triggers on
+# transactions keep it current; a migration that rebuilds transactions drops
+# them, and must total the table again (see init_db.count_counterparty_totals()).
+COUNTERPARTY_TOTALS_SQL = """
+CREATE TABLE IF NOT EXISTS counterparty_totals (
+    category INTEGER NOT NULL,
+    counterparty_id INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (category, counterparty_id)
+) WITHOUT ROWID
+"""
+
+# A category's counterparties in the orders of the endpoints, ties broken by
+# counterparty_id (the primary key, which every index ends with)
+COUNTERPARTY_TOTALS_INDEXES_SQL = [
+    "CREATE INDEX IF NOT EXISTS idx_counterparty_totals_total "
+    "ON counterparty_totals (category, total)",
+    "CREATE INDEX IF NOT EXISTS idx_counterparty_totals_count "
+    "ON counterparty_totals (category, count)",
+]
+
+# Adds a transaction (of the NEW row) to its counterparty's totals, or takes
+# one (of the OLD row) off them
+_ADD_TO_TOTALS = """INSERT INTO counterparty_totals (category, counterparty_id, total, count)
+        SELECT NEW.category, NEW.counterparty_id, ifnull(NEW.amount, 0), 1
+        WHERE NEW.counterparty_id IS NOT NULL
+        ON CONFLICT DO UPDATE SET total = total + excluded.total, count = count + 1;"""
+_TAKE_FROM_TOTALS = """UPDATE counterparty_totals
+        SET total = total - ifnull(OLD.amount, 0), count = count - 1
+        WHERE category = OLD.category AND counterparty_id = OLD.counterparty_id;
+    DELETE FROM counterparty_totals
+        WHERE category = OLD.category AND counterparty_id = OLD.counterparty_id AND count = 0;"""
+
+COUNTERPARTY_TOTALS_TRIGGERS_SQL = [
+    "CREATE TRIGGER IF NOT EXISTS total_inserted_transaction AFTER INSERT ON transactions\n"
+    f"BEGIN\n    {_ADD_TO_TOTALS}\nEND",
+    "CREATE TRIGGER IF NOT EXISTS total_deleted_transaction AFTER DELETE ON transactions\n"
+    f"BEGIN\n    {_TAKE_FROM_TOTALS}\nEND",
+    "CREATE TRIGGER IF NOT EXISTS total_updated_transaction "
+    "AFTER UPDATE OF category, amount, counterparty_id ON transactions\n"
+    f"BEGIN\n    {_TAKE_FROM_TOTALS}\n    {_ADD_TO_TOTALS}\nEND",
+]
+
+# Secondary indexes of the fact table, for the filters and sorts of the read
+# endpoints (see queries.py): a category's transactions with a counterparty,
+# in date order, and by amount. A category in date order is the table's own
+# (clustered) order. Each index ends with the primary key, so (ts, txid)
+# breaks ties and pages are ranges of the index.
+TRANSACTION_INDEXES: List[Tuple[str, ...]] = [
+    ('category', 'counterparty_id', 'ts'),
+    ('category', 'amount'),
+]
+
+
+def category_id(table: str) -> str:
+    """SQL for the id of a category (a constant subquery, evaluated once)."""
+    return f"(SELECT id FROM categories WHERE name = '{table}')"
+
+
+def amount_column(table: str) -> str:
+    """The money column holding a category's transaction amount."""
+    for _, fields in MATCHERS[table]:
+        for field, field_type in fields:
+            if field_type == 'money' and field not in ('fee', 'new_balance'):
+                return field
+    raise ValueError(f"No amount column in {table}")
+
+
+def fact_columns(table: str) -> Dict[str, str]:
+    """Maps the fact columns a category fills to its own columns."""
+    columns = COLUMN_TYPES[table]
+    sources = {
+        'txid': CATEGORIES[table]['key'],
+        'ts': 'ts',
+        'amount': amount_column(table),
+        'fee': 'fee',
+        'balance_after': 'new_balance',
+    }
+    return {fact: column for fact, column in sources.items() if column in columns}
+
+
+def counterparty_columns(table: str) -> Tuple[str | None, str | None, str | None]:
+    """The name and phone columns of a category's counterparty, and its kind."""
+    counterparty = CATEGORIES[table]['counterparty'] or {}
+    return counterparty.get('name'), counterparty.get('phone'), counterparty.get('kind')
+
+
+def detail_columns(table: str) -> List[str]:
+    """Lists the columns of a category kept in transaction_details."""
+    shared = set(fact_columns(table).values()) | set(counterparty_columns(table)[:2])
+    return [column for column in TABLE_COLUMNS[table] if column not in shared]
+
+
+def _detail_types() -> Dict[str, str]:
+    """Collects the sidecar columns of every category, with their types."""
+    types = {}
+    for table in CATEGORIES:
+        for column in detail_columns(table):
+            column_type = types.setdefault(column, COLUMN_TYPES[table][column])
+            if column_type != COLUMN_TYPES[table][column]:
+                raise ValueError(f"Column {column} of {table} is {COLUMN_TYPES[table][column]}, "
+                                 f"but {column_type} in another category")
+    return types
+
+
+DETAIL_TYPES = _detail_types()
+
+def transactions_ddl(table: str = 'transactions') -> str:
+    """Generates the CREATE statement of the fact table (under another name
+    while a migration builds a new one)."""
+    return (f"CREATE TABLE IF NOT EXISTS {table} (\n"
+            "    category INTEGER NOT NULL REFERENCES categories (id),\n"
+            + ''.join(f"    {column} {column_type},\n" for column, column_type in FACT_COLUMNS.items())
+            + "    PRIMARY KEY (category, ts, txid),\n"
+            "    UNIQUE (category, txid)\n"
+            ") WITHOUT ROWID")
+
+
+def transaction_details_ddl(table: str = 'transaction_details',
+                            transactions: str = 'transactions') -> str:
+    """Generates the CREATE statement of the sidecar of a fact table."""
+    return (f"CREATE TABLE IF NOT EXISTS {table} (\n"
+            "    category INTEGER NOT NULL,\n"
+            "    txid INTEGER NOT NULL,\n"
+            + ''.join(f"    {column} {column_type},\n" for column, column_type in DETAIL_TYPES.items())
+            + "    PRIMARY KEY (category, txid),\n"
+            f"    FOREIGN KEY (category, txid) REFERENCES {transactions} (category, txid)\n"
+            ") WITHOUT ROWID")
+
+
+def counterparty_totals_ddl() -> List[str]:
+    """Generates the CREATE statements of counterparty_totals, its indexes and
+    the triggers on transactions that keep it current."""
+    return ([COUNTERPARTY_TOTALS_SQL] + COUNTERPARTY_TOTALS_INDEXES_SQL
+            + COUNTERPARTY_TOTALS_TRIGGERS_SQL)
+
+
+def schema_ddl() -> List[str]:
+    """Generates the CREATE statements of the tables behind the category views."""
+    return ([CATEGORIES_SQL, COUNTERPARTIES_SQL, COUNTERPARTY_KEY_SQL,
+             transactions_ddl(), transaction_details_ddl()] + counterparty_totals_ddl())
+
+
+def view_ddl(table: str) -> List[str]:
+    """
+    Generates the view standing in for a category table, and its insert trigger.
+
+    Views hold no data, so they are dropped and created again whenever the
+    schema is brought up to date, and always match the category definition.
+
+    Args:
+        table (str): The category (a key of constants.CATEGORIES).
+
+    Returns:
+        List[str]: The DROP VIEW, CREATE VIEW and CREATE TRIGGER statements.
+    """
+    facts = fact_columns(table)
+    name, phone, kind = counterparty_columns(table)
+    details = detail_columns(table)
+
+    sources = {column: f"t.{fact}" for fact, column in facts.items()}
+    for column in details:
+        implied = IMPLIED_COLUMNS.get(column)
+        sources[column] = f"ifnull(d.{column}, {implied.format(ts='t.ts')})" if implied \
+            else f"d.{column}"
+    joins = "LEFT JOIN transaction_details d ON d.category = t.category AND d.txid = t.txid"
+    if name:
+        sources[name] = 'c.name'
+        joins += "\nLEFT JOIN counterparties c ON c.id = t.counterparty_id"
+    if phone:
+        sources[phone] = 'c.phone'
+
+    selected = [f"{sources[column]} AS {column}" for column in TABLE_COLUMNS[table]]
+    if name:
+        selected.append('t.counterparty_id AS counterparty_id')
+    view = (f"CREATE VIEW {table} AS\n"
+            f"SELECT {', '.join(selected)}\n"
+            f"FROM transactions t\n{joins}\n"
+            f"WHERE t.category = {category_id(table)}")
+
+    new_phone = f"NEW.{phone}" if phone else 'NULL'
+    phone_key = f"ifnull(NEW.{phone}, '')" if phone else "''"
+    counterparty = (f"ifnull(NEW.counterparty_id, (SELECT id FROM counterparties "
+                    f"WHERE kind = '{kind}' AND name IS NEW.{name} "
+                    f"AND ifnull(phone, '') = {phone_key}))") if name else 'NULL'
+    values = {fact: f"NEW.{column}" for fact, column in facts.items()}
+    values['counterparty_id'] = counterparty
+
+    statements = []
+    if name:
+        statements.append(f"INSERT INTO counterparties (kind, name, phone)\n"
+                          f"    SELECT '{kind}', NEW.{name}, {new_phone} "
+                          f"WHERE NEW.counterparty_id IS NULL AND NEW.{name} IS NOT NULL\n"
+                          f"    ON CONFLICT DO NOTHING")
+    statements.append(
+        f"INSERT INTO transactions (category, {', '.join(FACT_COLUMNS)})\n"
+        f"    VALUES ({category_id(table)}, "
+        + ', '.join(values.get(fact, 'NULL') for fact in FACT_COLUMNS) + ")\n"
+        "    ON CONFLICT DO NOTHING")
+    # Skipped when the transaction already existed, or when there is nothing
+    # to store
+    stored = ', '.join(
+        f"nullif(NEW.{column}, {IMPLIED_COLUMNS[column].format(ts='NEW.ts')}) AS {column}"
+        if column in IMPLIED_COLUMNS else f"NEW.{column} AS {column}"
+        for column in details)
+    statements.append(
+        f"INSERT INTO transaction_details (category, txid, {', '.join(details)})\n"
+        f"    SELECT {category_id(table)}, NEW.{CATEGORIES[table]['key']}, {', '.join(details)} "
+        f"FROM (SELECT {stored})\n"
+        f"    WHERE changes() = 1 AND ("
+        + ' OR '.join(f"{column} IS NOT NULL" for column in details) + ")")
+
+    # Dropped with the view
+    trigger = (f"CREATE TRIGGER insert_{table} INSTEAD OF INSERT ON {table}\n"
+               "BEGIN\n"
+               + ''.join(f"    {statement};\n" for statement in statements)
+               + "END")
+    return [f"DROP VIEW IF EXISTS {table}", view, trigger]
+
+
+def index_ddl() -> List[str]:
+    """Generates the CREATE INDEX statements of the transactions table."""
+    return [f"CREATE INDEX IF NOT EXISTS idx_transactions_{'_'.join(columns)} "
+            f"ON transactions ({', '.join(columns)})"
+            for columns in TRANSACTION_INDEXES]
@@ -1,13 +1,30 @@
-from typing import Dict, List
-from datetime import datetime
-import xml.etree.ElementTree as ET
-from typing import List, Dict
+from typing import Container, Dict, List, Iterable, Iterator
+import hashlib
+import mmap
+import os
 import re
-from helpers import export_to_json
-from constants import TABLE_CONFIG
+import xml.etree.ElementTree as ET
+from contextlib import ExitStack
+from helpers import JsonWriter, export_filename, export_to_json
+from constants import CATEGORIES, TABLE_CONFIG
+from classifier import classify, classify_span
+from templates import parse_message
 
 TABLES = list(TABLE_CONFIG.keys())  # Dynamically generate TABLES
 SMS_TAG = 'sms'
+SMS_RECORD_START = b'<sms '
+SMS_RECORD_END = b'</sms>'
+SMS_ATTRIBUTES = ('body', 'date')
+HASHED_ATTRIBUTES = ('address', 'date', 'body')
+
+# Attribute values as written by SMS Backup & Restore: double quoted, with no
+# raw '<' or '"' inside. Anything else goes through ElementTree instead.
+ATTRIBUTE_PATTERNS: Dict[str, re.Pattern] = {}
+XML_ENTITY = re.compile(r"&(#x[0-9a-fA-F]+|#\d+|\w+);")
+XML_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+XML_WHITESPACE = str.maketrans('\t\n\r', '   ')
+# Raw values holding one of these differ from their decoded value
+NEEDS_DECODING = re.compile(rb"[&\t\n\r]")
 
 
 def parse_xml(file_path: str) -> ET.Element | None:
@@ -28,364 +45,486 @@ def parse_xml(file_path: str) -> ET.Element | None:
         return None
 
 
-def extract_sms_data(root: ET.Element) -> Dict[str, List[str]]:
+def iter_sms(file_path: str) -> Iterator[Dict[str, str]]:
     """
-    Extracts SMS data from the XML root element based on predefined search strings.
+    Streams the <sms> elements of an XML backup without building the whole tree.
+
+    Each element is cleared (and detached from the root) as soon as it has been
+    yielded, so memory stays flat regardless of the size of the backup.
 
     Args:
-        root (ET.Element): The root element of the XML tree.
+        file_path (str): The path to the XML file.
 
-    Returns:
-        Dict[str, List[str]]: A dictionary where keys are table names and values are lists of SMS bodies.
+    Yields:
+        Dict[str, str]: The attributes of each <sms> element.
     """
-    sms_data = {table: []
-                for table in TABLES}  # Initialize dictionary for SMS data
+    try:
+        context = ET.iterparse(file_path, events=('start', 'end'))
+        _, root = next(context)  # The first event is the start of <smses>
+
+        for event, elem in context:
+            if event == 'end' and elem.tag == SMS_TAG:
+                yield dict(elem.attrib)
+                elem.clear()
+                root.clear()  # Drop the processed children from the root
+    except ET.ParseError as e:
+        print(f"Error parsing XML: {e}")
+
 
-    for sms in root.findall(SMS_TAG):
+def iter_sms_bodies(file_path: str) -> Iterator[str]:
+    """
+    Streams the non-empty SMS bodies of an XML backup.
+
+    Args:
+        file_path (str): The path to the XML file.
+
+    Yields:
+        str: The body of each <sms> element.
+    """
+    for sms in iter_sms(file_path):
         body = sms.get('body')
         if body:
-            for table, search_string in TABLE_CONFIG.items():
-                if search_string in body:
-                    sms_data[table].append(body)
+            yield body
 
-    return sms_data
 
+def classify_sms(bodies: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """
+    Assigns each SMS body to a single table as it arrives.
+
+    Args:
+        bodies (Iterable[str]): SMS bodies, e.g. from iter_sms_bodies().
 
-def populate_airtime_table(sms_data: Dict[str, List[str]]):
-    # Get airtime table
-    airtime_table = sms_data['airtime']
+    Yields:
+        tuple[str, str]: (table name, SMS body) for every body that matches a
+        table. See constants.TABLE_PRIORITY for how ties are broken.
+    """
+    for body in bodies:
+        table = classify(body)
+        if table:
+            yield table, body
 
-    categorized_payments = []
-    for payment_string in airtime_table:
-        # Use regex to extract the relevant information from the string
-        match = re.search(
-            r"TxId:(\d+).?Your payment of (\d+) RWF.?at ([\d-]+ [\d:]+).?Fee was (\d+) RWF.?Your new balance: (\d+) RWF", payment_string)
 
-        if match:
-            txid = match.group(1)
-            payment_amount = int(match.group(2))  # Convert to integer
-            date = match.group(3)
-            fee = int(match.group(4))  # Convert to integer
-            new_balance = int(match.group(5))  # Convert to integer
+def attribute_span(buffer, start: int, end: int, name: str) -> tuple[int, int] | None:
+    """
+    Locates the value of an attribute inside an <sms> record without copying.
 
-            payment_data = {
-                "date": date,
-                "txid": txid,
-                "payment_amount": payment_amount,
-                "fee": fee,
-                "new_balance": new_balance
-            }
-            categorized_payments.append(payment_data)
+    Args:
+        buffer: The backup contents (bytes or mmap).
+        start (int): Offset of the record.
+        end (int): Offset just past the record.
+        name (str): The attribute name.
 
-    print(categorized_payments)
-    export_to_json(categorized_payments, "data/airtime_payments.json")
+    Returns:
+        tuple[int, int] | None: (start, end) offsets of the raw value, or None
+        if the attribute is missing or not double quoted.
+    """
+    pattern = ATTRIBUTE_PATTERNS.get(name)
+    if pattern is None:
+        pattern = ATTRIBUTE_PATTERNS[name] = re.compile(
+            rb'\s' + name.encode() + rb'="([^"<]*)"')
+    match = pattern.search(buffer, start, end)
+    return match.span(1) if match else None
 
-    return categorized_payments
 
+def _replace_entity(match: re.Match) -> str:
+    entity = match.group(1)
+    if entity.startswith('#x'):
+        return chr(int(entity[2:], 16))
+    if entity.startswith('#'):
+        return chr(int(entity[1:]))
+    return XML_ENTITIES.get(entity, match.group())
 
-def populate_received_money_table(sms_data: Dict[str, List[str]]):
-    received_money_table = sms_data.get('incoming_money', [])
-    categorized_received_money = []
-
-    for message in received_money_table:
-        match = re.search(
-            r"You have received (\d+) RWF from ([\w\s]+) \(\{9}\d{3}\).?at ([\d-]+ [\d:]+).?Your new balance:(\d+) RWF.?Financial Transaction Id: (\d+)",
-            message
-        )
-
-        if match:
-            amount_received = int(match.group(1))
-            sender = match.group(2)
-            date_str = match.group(3)
-            new_balance = int(match.group(4))
-            txid = match.group(5)
-
-            # Convert date string to datetime
-            try:
-                date = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
-            except ValueError:
-                date = date_str  # Keep it as a string if parsing fails
-
-            received_money_data = {
-                "txid": txid,
-                "amount_received": amount_received,
-                "sender": sender,
-                "date": date.isoformat() if isinstance(date, datetime) else date,
-                "new_balance": new_balance,
-            }
-
-            categorized_received_money.append(received_money_data)
-
-    # Ensure this function exists
-    export_to_json(categorized_received_money,
-                   'data/incoming_money_table.json')
-    return categorized_received_money
 
+def decode_attribute(view: memoryview) -> str:
+    """
+    Turns a raw attribute value into the string an XML parser would return.
 
-def transfer_to_mobile_numbers(sms_data: Dict[str, List[str]]):
-    transfer_to_mobile_numbers_table = sms_data['transfers_to_mobile_numbers']
+    Literal tabs and newlines become spaces (attribute value normalisation),
+    then character and entity references are resolved.
+    """
+    value = str(view, 'utf-8').translate(XML_WHITESPACE)
+    if '&' in value:
+        value = XML_ENTITY.sub(_replace_entity, value)
+    return value
 
-    categorized_transfers = []
-    for transfer_string in transfer_to_mobile_numbers_table:
 
-        pattern = r"\165\*S\(\d+) RWF transferred to ([A-Za-z\s]+) \((\d+)\) from (\d+) at ([\d-]+ [\d:]+) \. Fee was: (\d+) RWF\. New balance: (\d+) RWF"
+def scan_sms_records(buffer, start: int = 0, end: int | None = None) -> Iterator[tuple[int, int]]:
+    """
+    Finds the <sms> records that start within a range of a backup.
 
-        match = re.search(pattern, transfer_string)
+    '<' cannot appear unescaped inside an attribute value, so every '<sms ' is
+    the start of a record. A self-closing record (as the backup app writes
+    them) runs until the next tag; any other one until its </sms>.
 
-        if match:
-            amount_transferred = int(match.group(1))  # Convert to integer
-            recipient = match.group(2)
-            recipient_number = match.group(3)
-            date = match.group(4)
-            time = match.group(5)
-            fee = int(match.group(6))  # Convert to integer
-            new_balance = int(match.group(7))
+    Yields:
+        tuple[int, int]: (start, end) offsets of each record.
+    """
+    end = len(buffer) if end is None else end
+    position = buffer.find(SMS_RECORD_START, start, end)
+    while position != -1:
+        record_end = buffer.find(b'<', position + 1, end)
+        if record_end == -1:
+            record_end = end
+        tag_end = buffer.rfind(b'>', position, record_end)
+        if tag_end > 0 and buffer[tag_end - 1:tag_end] != b'/':
+            # <sms ...></sms>: the record includes its end tag (and content).
+            # A record never reaches into the next one, even if malformed.
+            next_record = buffer.find(SMS_RECORD_START, record_end, end)
+            closing = buffer.find(SMS_RECORD_END, record_end,
+                                  end if next_record == -1 else next_record)
+            if closing != -1:
+                record_end = closing + len(SMS_RECORD_END)
+        yield position, record_end
+        position = buffer.find(SMS_RECORD_START, record_end, end)
+
+
+def _parse_record(buffer, start: int, end: int) -> Dict[str, str] | None:
+    """Parses a record with ElementTree; the fallback for unusual records."""
+    try:
+        return ET.fromstring(buffer[start:end].rstrip()).attrib
+    except ET.ParseError as e:
+        print(f"Error parsing record at byte {start}: {e}")
+        return None
 
-            transfer_data = {
-                "amount_transferred": amount_transferred,
-                "recipient": recipient,
-                "recipient_number": recipient_number,
-                "date": date,
-                "time": time,
-                "fee": fee,
-                "new_balance": new_balance
-            }
 
-            categorized_transfers.append(transfer_data)
+def read_sms_attributes(buffer, view: memoryview, start: int, end: int,
+                        attributes: Iterable[str] = SMS_ATTRIBUTES) -> Dict[str, str] | None:
+    """
+    Decodes only the requested attributes of an <sms> record.
 
-    export_to_json(categorized_transfers,
-                   "data/transfer_to_mobile_numbers.json")
+    Args:
+        buffer: The backup contents (bytes or mmap).
+        view (memoryview): A memoryview of the buffer.
+        start (int): Offset of the record.
+        end (int): Offset just past the record.
+        attributes (Iterable[str]): The attributes to decode.
 
+    Returns:
+        Dict[str, str] | None: The attribute values, or None if the record is
+        malformed.
+    """
+    if buffer.rfind(b'/>', start, end) == -1:
+        # Not a self-closing record as written by the backup app
+        sms = _parse_record(buffer, start, end)
+        return sms and {name: sms[name] for name in attributes if name in sms}
+
+    values = {}
+    for name in attributes:
+        span = attribute_span(buffer, start, end, name)
+        if span is None:
+            sms = _parse_record(buffer, start, end)
+            return sms and {name: sms[name] for name in attributes if name in sms}
+        values[name] = decode_attribute(view[span[0]:span[1]])
+    return values
+
+
+def iter_sms_fast(file_path: str, attributes: Iterable[str] = SMS_ATTRIBUTES) -> Iterator[Dict[str, str]]:
+    """
+    Streams selected <sms> attributes from a memory-mapped backup.
 
-def cash_power_bill_payments(sms_data: Dict[str, List[str]]):
-    cash_power_bill_payments_table = sms_data['cash_power_bill_payments']
-    print(cash_power_bill_payments_table)
-
-    categorized_cash_power_payments = []
-
-    for message in cash_power_bill_payments_table:
-
-        transaction_id = message.split("TxId:")[1].split("*")[0]
-        amount = message.split("payment of ")[1].split(" RWF")[0]
-        provider = message.split(" to ")[1].split(" with")[0]
-        token = message.split("token ")[1].split(" has")[0]
-        date_time = message.split("completed at ")[1].split(". Fee")[0]
-        fee = message.split("Fee was ")[1].split(" RWF")[0]
-        balance = message.split("new balance: ")[1].split(" RWF")[0]
-        # units = message.split("Electricity units: ")[1].split("kwH")[0]
-
-        # try:
-        #     date = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
-        # except ValueError:
-        #     date = date
-
-        categorized_cash_power_payments.append({
-            "transaction_id": transaction_id,
-            "payment_amount": amount,
-            "token": token,
-            "date": date_time,
-            # "date": date.isoformat() if isinstance(date, datetime) else date,
-            "fee": fee,
-            # "units": units,
-            "new_balance": balance,
-            "provider": provider
-        })
-
-    export_to_json(categorized_cash_power_payments,
-                   "data/cash_power_bill_payments.json")
+    The fast counterpart of iter_sms(): no element objects are built and the
+    other attributes of each record are never decoded.
 
+    Args:
+        file_path (str): The path to the XML file.
+        attributes (Iterable[str]): The attributes to read.
 
-def withdrawals_from_agents(sms_data: Dict[str, List[str]]):
-    withdrawals_from_agents_table = sms_data['withdrawals_from_agents']
-
-    categorized_withdrawals_from_agents = []
-
-    for message in withdrawals_from_agents_table:
-
-        name = message.split("You ")[1].split(" have")[0].strip()
-        agent_info = message.split("via agent: ")[1].split(",")[0].strip()
-        agent_name = agent_info.split("(")[0].strip()
-        agent_number = agent_info.split("(")[1].strip().strip(")")
-        amount = message.split("withdrawn ")[1].split(" RWF")[0]
-        account = message.split("account: ")[1].split(" at")[0].strip()
-        date_time = message.split("at ")[1].split(" and")[0].strip()
-        new_balance = message.split("Your new balance: ")[1].split(" RWF")[0]
-        fee = message.split("Fee paid: ")[1].split(" RWF")[0]
-        transaction_id = message.split("Id: ")[1].strip().split(".")[0]
-
-        categorized_withdrawals_from_agents.append({
-            "name": name,
-            "agent_name": agent_name,
-            "agent_number": agent_number,
-            "account": account,
-            "amount": amount,
-            "date": date_time,
-            "fee": fee,
-            "new_balance": new_balance,
-            "transaction_id": transaction_id
-        })
-
-    export_to_json(categorized_withdrawals_from_agents,
-                   "data/withdrawals_from_agents.json")
+    Yields:
+        Dict[str, str]: The requested attributes of each <sms> element.
+    """
+    if os.path.getsize(file_path) == 0:
+        return
 
+    with open(file_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            memoryview(mm) as view:
+        for start, end in scan_sms_records(mm):
+            sms = read_sms_attributes(mm, view, start, end, attributes)
+            if sms is not None:
+                yield sms
 
-def internet_voice_bundles(sms_data: Dict[str, List[str]]):
-    internet_voice_bundles_table = sms_data['internet_voice_bundle']
-    pattern = re.compile(
-        r"TxId:(\d+).?payment of (\d+) RWF to (.?) with token.?at ([\d-]+ [\d:]+).?Fee was (\d+) RWF.*?balance: (\d+) RWF",
-        re.DOTALL
-    )
 
-    internet_voice_bundles = []
+def sms_date_and_sub_id(buffer, start: int, end: int) -> tuple[int | None, str]:
+    """
+    Reads the epoch (ms) 'date' and the 'sub_id' of a record without decoding it.
 
-    for message in internet_voice_bundles_table:
-        match = pattern.search(message)
+    Returns:
+        tuple[int | None, str]: The date (None if missing or not a number) and
+        the sub_id ('' if missing).
+    """
+    span = attribute_span(buffer, start, end, 'date')
+    value = buffer[span[0]:span[1]] if span else b''
+    date = int(value) if value.isdigit() else None
 
-        if match:
-            transaction_id = match.group(1)
-            amount = match.group(2)
-            service = match.group(3)
-            date_time = match.group(4)
-            new_balance = match.group(6)
+    span = attribute_span(buffer, start, end, 'sub_id')
+    sub_id = buffer[span[0]:span[1]].decode() if span else ''
+    return date, sub_id
 
-            internet_voice_bundles.append({
-                "transaction_id": transaction_id,
-                "amount": amount,
-                "service": service,
-                "date": date_time,
-                "new_balance": new_balance
-            })
 
-    export_to_json(internet_voice_bundles,
-                   "data/internet_voice_bundles.json")
+def message_hash(*values) -> int:
+    """
+    Hashes the (address, date, body) of a message for the dedupe index.
 
+    Args:
+        *values: The decoded attribute values, UTF-8 encoded (bytes-like).
 
+    Returns:
+        int: A 64-bit signed hash, so it fits an SQLite INTEGER.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for value in values:
+        digest.update(value)
+        digest.update(b'\x1f')
+    return int.from_bytes(digest.digest(), 'big', signed=True)
 
-def payment_to_code_holders(sms_data: Dict[str, List[str]]):
-    payment_to_code_holders_table = sms_data['payment_to_code_holders']
-    pattern = re.compile(
-        r"TxId:\s*(\d+).?payment of ([\d,]+) RWF to (.?) has been completed at ([\d-]+ [\d:]+).?balance:\s([\d,]+) RWF.*?Fee was (\d+) RWF",
-        re.DOTALL
-    )
-
-    payment_to_code_holders = []
-
-    for message in payment_to_code_holders_table:
-        match = pattern.search(message)
-
-        if match:
-            transaction_id = match.group(1)
-            amount = match.group(2).replace(",", "")
-            recipient = match.group(3)
-            date_time = match.group(4)
-            new_balance = match.group(5).replace(",", "")
-            fee = match.group(6)
-
-            payment_to_code_holders.append({
-                "transaction_id": transaction_id,
-                "amount": amount,
-                "date": date_time,
-                "new_balance": new_balance,
-                "fee": fee,
-                "recipient": recipient
-            })
-
-    export_to_json(payment_to_code_holders,
-                   "data/payment_to_code_holders.json")
 
+def _raw_message_hash(buffer, view: memoryview, start: int, end: int,
+                      body_span: tuple[int, int]) -> int:
+    """
+    Hashes a record from its raw attribute values, as message_hash() of the
+    decoded ones. A value is only decoded when it holds an entity or a
+    character that decoding changes, so the hash does not depend on how the
+    backup escaped it (&amp; or &#38;, say).
+    """
+    values = []
+    for name in HASHED_ATTRIBUTES:
+        span = body_span if name == 'body' else attribute_span(buffer, start, end, name)
+        if span is None:
+            values.append(b'')
+        elif NEEDS_DECODING.search(buffer, *span):
+            values.append(decode_attribute(view[span[0]:span[1]]).encode())
+        else:
+            values.append(view[span[0]:span[1]])
+    return message_hash(*values)
+
+
+def parse_sms_records(buffer, view: memoryview, start: int = 0, end: int | None = None,
+                      high_water_marks: Dict[str, int] | None = None,
+                      latest: Dict[str, int] | None = None,
+                      seen: Container[int] | None = None,
+                      counts: Dict[str, int] | None = None) -> Iterator[tuple[str, tuple, int | None]]:
+    """
+    Classifies and parses the <sms> records within a range of a backup.
 
-def bank_transfers(sms_data: Dict[str, List[str]]):
-    bank_transfers_table = sms_data['bank_transfers']
-    pattern = re.compile(
-        r"You have transferred (\d+) RWF to ([A-Za-z\s]+) \((\d+)\) from your mobile money account (\d+).?at ([\d-]+ [\d:]+).?Financial Transaction Id:\s*(\d+)",
-        re.DOTALL
-    )
-    bank_transfers = []
-
-    for message in bank_transfers_table:
-        match = pattern.search(message)
-
-        if match:
-            amount = match.group(1)
-            recipient_name = match.group(2)
-            recipient_phone = match.group(3)
-            sender_account = match.group(4)
-            date_time = match.group(5)
-            transaction_id = match.group(6)
-            print(amount)
-
-            bank_transfers.append({
-                "transaction_id": transaction_id,
-                "amount": amount,
-                "date": date_time,
-                "recipient_name": recipient_name,
-                "recipient_phone": recipient_phone,
-                "sender_account": sender_account
-            })
-
-    export_to_json(bank_transfers,
-                   "data/bank_transfers.json")
+    Bodies are classified in place, so only messages that belong to a category
+    are ever decoded into strings.
 
+    Args:
+        buffer: The backup contents (bytes or mmap).
+        view (memoryview): A memoryview of the buffer.
+        start (int): Offset to start scanning at.
+        end (int | None): Offset to stop scanning at (default: the end).
+        high_water_marks (Dict[str, int] | None): sub_id -> epoch (ms) of the
+            newest message already ingested. Older or equal messages are
+            skipped before any classification or parsing.
+        latest (Dict[str, int] | None): Filled with sub_id -> epoch (ms) of the
+            newest message seen, to become the next high-water marks.
+        seen (Container[int] | None): message_hash() values of messages that
+            were already ingested. Matching messages are skipped before any
+            classification or parsing. Setting this also turns on hashing.
+        counts (Dict[str, int] | None): Incremented with the number of
+            'duplicates' skipped because of `seen`.
+
+    Yields:
+        tuple[str, tuple, int | None]: (table name, record, message hash) in
+        file order. The hash is None unless `seen` is given.
+    """
+    for record_start, record_end in scan_sms_records(buffer, start, end):
+        date = None
+        if high_water_marks is not None or latest is not None:
+            date, sub_id = sms_date_and_sub_id(buffer, record_start, record_end)
+            if high_water_marks and date is not None \
+                    and date <= high_water_marks.get(sub_id, -1):
+                continue
+
+        parsed = None
+        digest = None
+        span = attribute_span(buffer, record_start, record_end, 'body')
+        raw = span is not None and buffer.rfind(b'/>', record_start, record_end) != -1
+
+        if not raw:
+            sms = _parse_record(buffer, record_start, record_end)
+            if sms is None:
+                continue  # Malformed, so it must not move the high-water mark
+            if seen is not None:
+                digest = message_hash(*(sms.get(name, '').encode()
+                                        for name in HASHED_ATTRIBUTES))
+        elif seen is not None:
+            digest = _raw_message_hash(buffer, view, record_start, record_end, span)
+
+        if digest is not None and digest in seen:
+            if counts is not None:
+                counts['duplicates'] = counts.get('duplicates', 0) + 1
+        elif not raw:
+            parsed = sms.get('body') and parse_sms(sms['body'])
+        else:
+            table = classify_span(buffer, *span)
+            if table:
+                fields = parse_message(
+                    table, decode_attribute(view[span[0]:span[1]]))
+                if fields:
+                    parsed = table, fields
+
+        if latest is not None and date is not None and date > latest.get(sub_id, -1):
+            latest[sub_id] = date
+        if parsed:
+            yield parsed[0], parsed[1], digest
+
+
+def parse_sms(body: str) -> tuple[str, tuple] | None:
+    """
+    Classifies an SMS body and extracts the fields of its category.
 
-def txns_intitiated_by_third_parties(sms_data: Dict[str, List[str]]):
-    transfers_from_third_parties_table = sms_data['transtxns_initiate_by_third_parties']
-    pattern = re.compile(
-        r"A transaction of (\d+) RWF by (.+?) on your MOMO account was successfully completed at (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}).*?Your new balance:(\d+) RWF\. Fee was (\d+) RWF\. Financial Transaction Id: (\d+)\. External Transaction Id: (\d+)",
-        re.DOTALL
-    )
+    Args:
+        body (str): The SMS body.
 
-    transfers_from_third_parties = []
+    Returns:
+        tuple[str, tuple] | None: (table name, record), or None if the body
+        belongs to no category or could not be parsed.
+    """
+    table = classify(body)
+    if table:
+        fields = parse_message(table, body)
+        if fields:
+            return table, fields
+    return None
 
-    for message in transfers_from_third_parties_table:
-        match = pattern.search(message)
 
-        if match:
-            amount = match.group(1)
-            sender = match.group(2)
-            date = match.group(3)
-            new_balance = match.group(4)
-            fee = match.group(5)
-            transaction_id = match.group(6)
-            external_transaction_id = match.group(7)
+def extract_sms_data(root: ET.Element | Iterable[str]) -> Dict[str, List[str]]:
+    """
+    Extracts SMS data based on predefined search strings.
 
-            transfers_from_third_parties.append({
-                "transaction_id": transaction_id,
-                "amount": amount,
-                "date": date,
-                "sender": sender,
-                "new_balance": new_balance,
-                "fee": fee,
-                "external_transaction_id": external_transaction_id
+    Args:
+        root (ET.Element | Iterable[str]): The root element of the XML tree, or
+            a stream of SMS bodies such as iter_sms_bodies().
 
-            })
+    Returns:
+        Dict[str, List[str]]: A dictionary where keys are table names and values are lists of SMS bodies.
+    """
+    sms_data = {table: []
+                for table in TABLES}  # Initialize dictionary for SMS data
 
-    export_to_json(transfers_from_third_parties,
-                   "data/transactions_initiated_by_third_parties.json")
+    if isinstance(root, ET.Element):
+        root = (sms.get('body') for sms in root.findall(SMS_TAG)
+                if sms.get('body'))
 
+    for table, body in classify_sms(root):
+        sms_data[table].append(body)
 
-def main():
-    xml_file = 'sms.xml'
-    root = parse_xml(xml_file)
+    return sms_data
+
+
+def iter_records(messages: Iterable[str], table: str) -> Iterator[tuple]:
+    """
+    Extracts the fields of each message of a category.
+
+    Args:
+        messages (Iterable[str]): SMS bodies of the category.
+        table (str): The category (a key of constants.CATEGORIES).
+
+    Yields:
+        tuple: The records (see templates.RECORD_TYPES). Messages that do not
+        carry every field of the category (e.g. failed payments) are skipped.
+    """
+    for message in messages:
+        record = parse_message(table, message)
+        if record:
+            yield record
+
+
+def populate_table(sms_data: Dict[str, Iterable[str]], table: str, json_file: str | None = None,
+                   **options) -> int:
+    """
+    Extracts the fields of every message in a category and streams them to JSON.
+
+    Args:
+        sms_data (Dict[str, Iterable[str]]): The output of extract_sms_data().
+        table (str): The category (a key of constants.CATEGORIES).
+        json_file (str | None): The JSON file to export the records to
+            (default: the category's json_file).
+        **options: The output format (compact, ndjson, compress), see
+            helpers.JsonWriter.
+
+    Returns:
+        int: The number of records exported.
+    """
+    return export_to_json(iter_records(sms_data.get(table, []), table),
+                          json_file or CATEGORIES[table]['json_file'], **options)
+
+
+def export_sms(bodies: Iterable[str], compact: bool = False, ndjson: bool = False,
+               compress: bool = False) -> Dict[str, int]:
+    """
+    Classifies, parses and exports a stream of SMS bodies in a single pass.
+
+    Records go straight to their category's file as they are parsed, without
+    collecting the messages of each category first.
+
+    Args:
+        bodies (Iterable[str]): SMS bodies, such as iter_sms_bodies().
+        compact, ndjson, compress (bool): The output format, see
+            helpers.JsonWriter. The file names follow helpers.export_filename().
+
+    Returns:
+        Dict[str, int]: Table name -> number of records exported.
+    """
+    with ExitStack() as stack:
+        writers = {
+            table: stack.enter_context(JsonWriter(
+                export_filename(category['json_file'], ndjson, compress), compact, ndjson, compress))
+            for table, category in CATEGORIES.items()}
+
+        for table, body in classify_sms(bodies):
+            fields = parse_message(table, body)
+            if fields:
+                writers[table].write(fields)
+
+    for writer in writers.values():
+        print(f"Exported {writer.count} records to {writer.filename}")
+    return {table: writer.count for table, writer in writers.items()}
 
-    if root is not None:
-        sms_data = extract_sms_data(root)
 
-        for table, messages in sms_data.items():
-            print(f"Table: {table}")
-            for message in messages:
-                print(f"- {message}")
-            print("-" * 30)
+def populate_airtime_table(sms_data: Dict[str, List[str]]):
+    return populate_table(sms_data, 'airtime_payments')
+
+
+def populate_received_money_table(sms_data: Dict[str, List[str]]):
+    return populate_table(sms_data, 'incoming_money')
 
-        # populate_received_money_table(sms_data)
-        # transfer_to_mobile_numbers(sms_data)
-        # populate_airtime_table(sms_data)
-        # cash_power_bill_payments(sms_data)
-        # withdrawals_from_agents(sms_data)
-        # internet_voice_bundles(sms_data)
-        # payment_to_code_holders(sms_data)
-        bank_transfers(sms_data)
-        # txns_intitiated_by_third_parties(sms_data)
+
+def transfer_to_mobile_numbers(sms_data: Dict[str, List[str]]):
+    return populate_table(sms_data, 'transfers_to_mobile_numbers')
+
+
+def cash_power_bill_payments(sms_data: Dict[str, List[str]]):
+    return populate_table(sms_data, 'cash_power_bill_payments')
+
+
+def withdrawals_from_agents(sms_data: Dict[str, List[str]]):
+    return populate_table(sms_data, 'withdrawals_from_agents')
+
+
+def internet_voice_bundles(sms_data: Dict[str, List[str]]):
+    return populate_table(sms_data, 'internet_voice_bundles')
+
+
+def payment_to_code_holders(sms_data: Dict[str, List[str]]):
+    return populate_table(sms_data, 'payment_to_code_holders')
+
+
+def bank_transfers(sms_data: Dict[str, List[str]]):
+    return populate_table(sms_data, 'bank_transfers')
+
+
+def txns_intitiated_by_third_parties(sms_data: Dict[str, List[str]]):
+    return populate_table(sms_data, 'transactions_initiated_by_third_parties')
+
+
+def main():
+    xml_file = 'sms.xml'
+    # Stream the backup into the category files; nothing is held per category
+    export_sms(iter_sms_bodies(xml_file))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
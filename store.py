@@ -0,0 +1,249 @@
+import threading
+from typing import Dict, Iterable, List, Sequence, Tuple
+from columnar import ENCODING_TYPES, NULL_CODE, NULL_INT64, column_encodings, column_positions
+from constants import CATEGORIES
+from schema import amount_column, category_id
+from templates import KIGALI_OFFSET, TABLE_COLUMNS, epoch_seconds
+
+try:
+    import numpy
+except ImportError:  # The store is optional; nothing else depends on it
+    numpy = None
+
+SECONDS_PER_DAY = 86_400
+
+PERIODS = ('day', 'month')
+
+
+class TransactionStore:
+    """
+    In-memory columnar copy of the category views, for dashboard aggregates.
+
+    Every column is a NumPy array: the date as int64 epoch seconds (from the
+    ts column), ids and
+    amounts as int64, and counterparties (names, phones, refs) as int32 codes
+    into a per-column dictionary. Aggregations are vectorised over those
+    arrays instead of looping over rows in Python.
+
+    refresh() only reads the rows after the last one it read, in the (ts,
+    key) order the table is clustered in, so the store can be kept up to date
+    cheaply; append() feeds it from the ingest stream.
+    """
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("TransactionStore requires NumPy (pip install numpy)")
+        self.encodings = {table: column_encodings(table) for table in CATEGORIES}
+        self.positions = {table: column_positions(table) for table in CATEGORIES}
+        self.columns = {table: {column: numpy.empty(0, ENCODING_TYPES[encoding][1])
+                                for column, encoding in encodings.items()}
+                        for table, encodings in self.encodings.items()}
+        # table -> column -> value -> code, and the values in code order
+        self.codes = {table: {column: {} for column, encoding in encodings.items()
+                              if encoding == 'dictionary'}
+                      for table, encodings in self.encodings.items()}
+        self.values = {table: {column: [] for column in codes}
+                       for table, codes in self.codes.items()}
+        # table -> (ts, key) of the last row read by refresh()
+        self.last_key = {table: None for table in CATEGORIES}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return sum(len(columns['date']) for columns in self.columns.values())
+
+    def append(self, table: str, records: Iterable[Sequence]) -> int:
+        """
+        Adds records to a category.
+
+        Args:
+            table (str): The category (a key of constants.CATEGORIES).
+            records (Iterable[Sequence]): Values in templates.TABLE_COLUMNS
+                order, e.g. templates.RECORD_TYPES tuples or table rows.
+
+        Returns:
+            int: The number of records added.
+        """
+        rows = list(records)
+        if not rows:
+            return 0
+
+        with self.lock:
+            columns = self.columns[table]
+            for column, encoding in self.encodings[table].items():
+                position = self.positions[table][column]
+                values = [row[position] for row in rows]
+                if encoding == 'dictionary':
+                    codes = self.codes[table][column]
+                    decoded = self.values[table][column]
+                    new = numpy.empty(len(values), dtype=ENCODING_TYPES[encoding][1])
+                    for position, value in enumerate(values):
+                        if value is None:
+                            new[position] = NULL_CODE
+                            continue
+                        code = codes.get(value)
+                        if code is None:
+                            code = codes[value] = len(decoded)
+                            decoded.append(value)
+                        new[position] = code
+                else:
+                    new = numpy.array([NULL_INT64 if value is None else int(value)
+                                       for value in values], dtype='int64')
+                columns[column] = numpy.concatenate([columns[column], new])
+        return len(rows)
+
+    def clear(self, table: str) -> None:
+        """Empties a category (its dictionaries are kept)."""
+        with self.lock:
+            for column, values in self.columns[table].items():
+                self.columns[table][column] = values[:0]
+            self.last_key[table] = None
+
+    def read(self, conn, table: str, columns: Sequence[str],
+             after: Tuple[int, int] | None = None) -> List:
+        """Reads the (ts, key, *columns) rows of a category after a (ts, key)."""
+        key = CATEGORIES[table]['key']
+        where, params = (f"WHERE (ts, {key}) > (?, ?) ", after) if after else ('', ())
+        return conn.execute(f"SELECT ts, {key}, {', '.join(columns)} FROM {table} "
+                            f"{where}ORDER BY ts, {key}", params).fetchall()
+
+    def refresh(self, conn) -> int:
+        """
+        Loads the rows added to the category views since the last refresh.
+
+        Rows come in (ts, key) order, after the last one read. A row dated
+        before it (a backfilled message, say) would be missed, so a category
+        whose new rows do not add up to its row count is read again in full.
+
+        Args:
+            conn: The database connection object.
+
+        Returns:
+            int: The number of rows loaded.
+        """
+        loaded = 0
+        with self.lock:
+            for table, columns in TABLE_COLUMNS.items():
+                stored = len(self.columns[table]['date'])
+                count = conn.execute(f"SELECT COUNT(*) FROM transactions "
+                                     f"WHERE category = {category_id(table)}").fetchone()[0]
+                if count == stored:
+                    continue
+                rows = self.read(conn, table, columns, self.last_key[table])
+                if stored + len(rows) != count:
+                    self.clear(table)
+                    rows = self.read(conn, table, columns)
+                if rows:
+                    loaded += self.append(table, (row[2:] for row in rows))
+                    self.last_key[table] = tuple(rows[-1][:2])
+        return loaded
+
+    def decode(self, table: str, column: str, codes) -> List[str | None]:
+        """Maps the codes of a dictionary column back to their values."""
+        values = self.values[table][column]
+        return [values[code] if code != NULL_CODE else None for code in codes]
+
+    def mask(self, table: str, start: int | None = None, end: int | None = None,
+             **equals) -> 'numpy.ndarray':
+        """
+        Selects the rows of a category matching some filters.
+
+        Args:
+            table (str): The category (a key of constants.CATEGORIES).
+            start (int | None): Keep rows at or after this time (epoch
+                seconds, see templates.epoch_seconds()).
+            end (int | None): Keep rows before this time.
+            **equals: column=value filters. Counterparty columns take the
+                decoded value, e.g. sender='Jane Smith'.
+
+        Returns:
+            numpy.ndarray: A boolean mask over the rows of the category.
+        """
+        columns = self.columns[table]
+        selected = numpy.ones(len(columns['date']), dtype=bool)
+        if start is not None:
+            selected &= columns['date'] >= start
+        if end is not None:
+            selected &= columns['date'] < end
+        for column, value in equals.items():
+            encoding = self.encodings[table][column]
+            if encoding == 'dictionary':
+                # Values never seen get a code that matches no row
+                value = self.codes[table][column].get(value, NULL_CODE - 1)
+            elif encoding == 'timestamp':
+                value = epoch_seconds(value)
+            else:
+                value = int(value)
+            selected &= columns[column] == value
+        return selected
+
+    def totals(self, table: str, column: str | None = None,
+               mask: 'numpy.ndarray | None' = None) -> Tuple[int, int]:
+        """
+        Sums a money column of a category. NULL values are left out of both
+        the sum and the count.
+
+        Args:
+            table (str): The category (a key of constants.CATEGORIES).
+            column (str | None): The column (default: the amount, see
+                amount_column()).
+            mask (numpy.ndarray | None): The rows to include (see mask()).
+
+        Returns:
+            Tuple[int, int]: (sum, count of non-NULL values).
+        """
+        values = self.columns[table][column or amount_column(table)]
+        if mask is not None:
+            values = values[mask]
+        values = values[values != NULL_INT64]
+        return int(values.sum()), len(values)
+
+    def group_by(self, table: str, period: str = 'day', column: str | None = None,
+                 mask: 'numpy.ndarray | None' = None) -> Dict[str, Tuple[int, int]]:
+        """
+        Sums and counts a money column of a category per day or month. Rows
+        without a date or a value are left out.
+
+        Args:
+            table (str): The category (a key of constants.CATEGORIES).
+            period (str): 'day' or 'month' (Kigali time).
+            column (str | None): The column (default: the amount).
+            mask (numpy.ndarray | None): The rows to include (see mask()).
+
+        Returns:
+            Dict[str, Tuple[int, int]]: 'YYYY-MM-DD' or 'YYYY-MM' -> (sum,
+            count), in time order.
+        """
+        if period not in PERIODS:
+            raise ValueError(f"Unknown period '{period}', expected one of {PERIODS}")
+
+        columns = self.columns[table]
+        values = columns[column or amount_column(table)]
+        kept = (columns['date'] != NULL_INT64) & (values != NULL_INT64)
+        if mask is not None:
+            kept &= mask
+        local_time = columns['date'][kept] + KIGALI_OFFSET
+        values = values[kept]
+
+        if not len(values):
+            return {}
+
+        # Bin by day number (linear, no sort), then fold the few non-empty
+        # days into months if needed. Sums stay int64: bincount weights are
+        # float64 and would round large totals.
+        days = local_time // SECONDS_PER_DAY
+        first = days.min()
+        counts = numpy.bincount(days - first)
+        sums = numpy.zeros(len(counts), dtype='int64')
+        numpy.add.at(sums, days - first, values)
+        present = counts.nonzero()[0]
+        groups = (present + first).astype('datetime64[D]')
+        sums, counts = sums[present], counts[present]
+        if period == 'month':
+            groups, inverse = numpy.unique(groups.astype('datetime64[M]'), return_inverse=True)
+            month_sums = numpy.zeros(len(groups), dtype='int64')
+            month_counts = numpy.zeros(len(groups), dtype='int64')
+            numpy.add.at(month_sums, inverse, sums)
+            numpy.add.at(month_counts, inverse, counts)
+            sums, counts = month_sums, month_counts
+        return {str(group): (int(total), int(count))
+                for group, total, count in zip(groups, sums, counts)}
@@ -0,0 +1,325 @@
+import hashlib
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Callable, Dict, List, Tuple
+from constants import CATEGORIES
+from tokenizer import extract_fields
+
+
+try:
+    from zoneinfo import ZoneInfo
+    KIGALI = ZoneInfo('Africa/Kigali')
+except Exception:  # No tz database (e.g. Windows without tzdata)
+    KIGALI = timezone(timedelta(hours=2), 'CAT')  # Rwanda has no DST
+
+# Rwanda has kept UTC+2 without DST, so one fixed offset converts every
+# timestamp without a time zone lookup per message
+KIGALI_OFFSET = int(datetime(2000, 1, 1, tzinfo=KIGALI).utcoffset().total_seconds())
+LOCAL_EPOCH = datetime(1970, 1, 1) + timedelta(seconds=KIGALI_OFFSET)
+UTC_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_SECOND = timedelta(seconds=1)
+
+
+def money(value: str) -> int:
+    """Converts an amount such as '1,000' to an integer."""
+    return int(value.replace(',', ''))
+
+
+def epoch_seconds(value: str) -> int:
+    """
+    Converts a message timestamp (Kigali local time) to Unix epoch seconds.
+
+    Accepts 'YYYY-MM-DD HH:MM:SS' as well as the ISO 'YYYY-MM-DDTHH:MM:SS',
+    and an explicit UTC offset ('+02:00', 'Z') instead of Kigali time.
+    """
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        return (moment - UTC_EPOCH) // ONE_SECOND
+    return (moment - LOCAL_EPOCH) // ONE_SECOND
+
+
+def natural_key(*values) -> int:
+    """
+    Derives a transaction id from the values identifying a transaction.
+
+    The id is the first 52 bits of a BLAKE2b hash of the values, negated, so
+    it is the same in every run and process and never collides with the
+    (positive) ids of messages that have one. 52 bits keep it exact as a
+    JSON number in a browser (within +/-2**53).
+
+    Args:
+        *values: The values of the category's natural_key columns, in order.
+
+    Returns:
+        int: A negative integer.
+    """
+    text = '\x1f'.join('' if value is None else str(value) for value in values)
+    digest = hashlib.blake2b(text.encode(), digest_size=8).digest()
+    return -(int.from_bytes(digest, 'big') >> 12) - 1
+
+
+# Placeholder type -> (regex, converter, SQLite column type)
+FIELD_TYPES: Dict[str, Tuple[str, Callable, str]] = {
+    'txid': (r"\d+", int, 'INTEGER'),  # Transaction ids, the key of the fact table
+    'id': (r"\d+", str, 'TEXT'),
+    'int': (r"\d+", int, 'INTEGER'),
+    'money': (r"\d[\d,]*", money, 'INTEGER'),
+    'timestamp': (r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}", str, 'TEXT'),
+    'phone': (r"[\d*]+", str, 'TEXT'),
+    'ref': (r"[\w-]+", str, 'TEXT'),
+    'text': (r".*?", str.strip, 'TEXT'),
+}
+
+# Columns computed from another field of the record rather than captured:
+# column -> (source field, converter, SQLite column type)
+DERIVED_COLUMNS: Dict[str, Tuple[str, Callable, str]] = {
+    'ts': ('date', epoch_seconds, 'INTEGER'),  # Indexed, for range queries
+}
+
+# Placeholders, skips and runs of spaces; everything else is literal text
+TEMPLATE_SYNTAX = re.compile(r"\{(\w*)(?::(\w+))?\}|\.\.\.| +")
+
+Matcher = Tuple[re.Pattern, Tuple[Tuple[str, str], ...]]
+
+
+@lru_cache(maxsize=None)
+def compile_template(template: str) -> Matcher:
+    """
+    Compiles a message template into a regex.
+
+    A skip (...) or text field stops at the first place where the rest of the
+    template, up to its next skip or text field, matches. A lazy .*? could
+    try every later place instead, and the several skips of a template would
+    then backtrack into each other: quadratic or worse on a long message that
+    does not match.
+
+    Args:
+        template (str): The template, see constants.CATEGORIES for the syntax.
+
+    Returns:
+        Matcher: The compiled regex (to be used with .match()) and the
+        (field, type) pairs it captures, in order.
+    """
+    # (regex, the same without groups, the characters it can start with as
+    # the inside of a [], or None if any); skips and text fields have a %s
+    # where the text they skip goes instead
+    parts = []
+    fields = []
+    position = 0
+
+    for token in TEMPLATE_SYNTAX.finditer(template):
+        literal = template[position:token.start()]
+        parts.append((re.escape(literal), re.escape(literal), re.escape(literal[:1])))
+        position = token.end()
+
+        if token.group() == '...':
+            parts.append(('%s', '%s', None))
+        elif token.group().startswith(' '):
+            parts.append((r"\s+", r"\s+", r"\s"))  # Messages are not consistent about spacing
+        else:
+            field, field_type = token.group(1), token.group(2) or 'text'
+            if field_type not in FIELD_TYPES:
+                raise ValueError(
+                    f"Unknown type '{field_type}' in template: {template}")
+            pattern = '%s' if field_type == 'text' else FIELD_TYPES[field_type][0]
+            if field:
+                fields.append((field, field_type))
+            parts.append((f"(?P<{field}>{pattern})" if field else f"(?:{pattern})",
+                          f"(?:{pattern})", None))
+    literal = template[position:]
+    parts.append((re.escape(literal), re.escape(literal), re.escape(literal[:1])))
+
+    regex = []
+    for index, (pattern, _, _) in enumerate(parts):
+        if '%s' in pattern:
+            rest, first = '', ''
+            for _, plain, starts in parts[index + 1:]:
+                if '%s' in plain:
+                    break
+                if not rest:
+                    first = starts
+                rest += plain
+            if not rest:
+                skip = FIELD_TYPES['text'][0]
+            elif first:
+                # The lookahead only runs where the rest can start
+                skip = f"(?:[^{first}]|(?!{rest})[{first}])*"
+            else:
+                skip = f"(?:(?!{rest}).)*"
+            pattern %= skip
+        regex.append(pattern)
+    return re.compile(''.join(regex), re.DOTALL), tuple(fields)
+
+
+# Compiled once at import; a message is only ever tried against the templates
+# of the category it was classified into.
+MATCHERS: Dict[str, List[Matcher]] = {
+    table: [compile_template(template) for template in category['templates']]
+    for table, category in CATEGORIES.items()
+}
+
+
+def _column_types(table: str) -> Dict[str, str]:
+    """Collects the columns of a table: captured fields first, then derived
+    ones, then a key derived from the natural key."""
+    columns = {}
+    for _, fields in MATCHERS[table]:
+        for field, field_type in fields:
+            columns.setdefault(field, FIELD_TYPES[field_type][2])
+    for column, (source, _, column_type) in DERIVED_COLUMNS.items():
+        if source in columns:
+            columns[column] = column_type
+    if CATEGORIES[table]['natural_key']:
+        columns[CATEGORIES[table]['key']] = FIELD_TYPES['txid'][2]
+    return columns
+
+
+COLUMN_TYPES = {table: _column_types(table) for table in CATEGORIES}
+
+# Columns written by the scraper, i.e. everything but autoincrement ids
+TABLE_COLUMNS = {table: tuple(columns)
+                 for table, columns in COLUMN_TYPES.items()}
+
+# Captured INTEGER columns (ids, amounts, fees, balances) and their converters
+INTEGER_COLUMNS = {
+    table: {field: FIELD_TYPES[field_type][1]
+            for _, fields in MATCHERS[table] for field, field_type in fields
+            if FIELD_TYPES[field_type][2] == 'INTEGER'}
+    for table in CATEGORIES
+}
+
+
+def coerce_integers(table: str, fields: Dict) -> Dict:
+    """
+    Coerces the integer columns of a record that did not come from the parser.
+
+    The parser already converts amounts; records loaded from elsewhere (JSON
+    exports, old rows) may hold strings such as '50000' or '1,000', or floats.
+
+    Args:
+        table (str): The category (a key of constants.CATEGORIES).
+        fields (Dict): The record, updated in place.
+
+    Returns:
+        Dict: The same record.
+
+    Raises:
+        ValueError: If a value is not a whole number.
+    """
+    for column, convert in INTEGER_COLUMNS[table].items():
+        value = fields.get(column)
+        if value is None or type(value) is int:
+            continue
+        try:
+            if isinstance(value, float) and value.is_integer():
+                fields[column] = int(value)
+            else:
+                fields[column] = convert(str(value).strip())
+        except ValueError:
+            raise ValueError(f"{column}: {value!r} is not an integer") from None
+    return fields
+
+
+def _none(_) -> None:
+    return None
+
+
+# One record type per category (e.g. AirtimePayment) with the table's columns
+# as fields. A named tuple has no per-instance dict, and its values are in
+# column order, so a record doubles as a row for executemany().
+RECORD_TYPES = {
+    table: namedtuple(CATEGORIES[table]['record'], columns,
+                      defaults=(None,) * len(columns), module=__name__)
+    for table, columns in TABLE_COLUMNS.items()
+}
+# Module level, so records can be imported by name and pickled across processes
+globals().update({record_type.__name__: record_type
+                  for record_type in RECORD_TYPES.values()})
+
+
+def _record_plan(table: str, fields: Tuple[Tuple[str, str], ...]) -> Tuple[Tuple, Tuple]:
+    """Lists the groups and converters that fill each column of a record."""
+    captured = dict(fields)
+    groups = []
+    converters = []
+    for column in TABLE_COLUMNS[table]:
+        if column in captured:
+            groups.append(column)
+            converters.append(FIELD_TYPES[captured[column]][1])
+        elif column in DERIVED_COLUMNS and DERIVED_COLUMNS[column][0] in captured:
+            groups.append(DERIVED_COLUMNS[column][0])
+            converters.append(DERIVED_COLUMNS[column][1])
+        else:
+            groups.append(0)
+            converters.append(_none)
+    return tuple(groups), tuple(converters)
+
+
+def derive_columns(table: str, fields: Dict) -> Dict:
+    """
+    Fills in the derived columns (see DERIVED_COLUMNS) missing from a record,
+    and its key if it is derived from a natural key.
+
+    Args:
+        table (str): The category (a key of constants.CATEGORIES).
+        fields (Dict): The record, updated in place.
+
+    Returns:
+        Dict: The same record.
+    """
+    for column, (source, convert, _) in DERIVED_COLUMNS.items():
+        if fields.get(column) is None and column in COLUMN_TYPES[table] \
+                and fields.get(source) is not None:
+            fields[column] = convert(fields[source])
+    natural = CATEGORIES[table]['natural_key']
+    if natural and fields.get(CATEGORIES[table]['key']) is None:
+        fields[CATEGORIES[table]['key']] = natural_key(*(fields.get(column) for column in natural))
+    return fields
+
+
+# Per template: (regex, groups, converters) to build a record from a match
+RECORD_MATCHERS = {
+    table: [(pattern, *_record_plan(table, fields)) for pattern, fields in matchers]
+    for table, matchers in MATCHERS.items()
+}
+
+# Categories with a natural key -> (position of the key, positions of the
+# natural key columns) in their records
+NATURAL_KEY_POSITIONS = {
+    table: (TABLE_COLUMNS[table].index(CATEGORIES[table]['key']),
+            tuple(TABLE_COLUMNS[table].index(column)
+                  for column in CATEGORIES[table]['natural_key']))
+    for table in CATEGORIES if CATEGORIES[table]['natural_key']
+}
+
+
+def parse_message(table: str, body: str) -> tuple | None:
+    """
+    Extracts the fields of a message with the templates of its category.
+
+    Messages that match none of the templates fall back to the tokenizer, which
+    copes with small format changes.
+
+    Args:
+        table (str): The category (a key of constants.CATEGORIES).
+        body (str): The SMS body.
+
+    Returns:
+        tuple | None: The category's record (see RECORD_TYPES), or None if the
+        message could not be parsed.
+    """
+    record_type = RECORD_TYPES[table]
+    for pattern, groups, converters in RECORD_MATCHERS[table]:
+        match = pattern.match(body)
+        if match:
+            values = [convert(value) for convert, value in zip(converters, match.group(*groups))]
+            if table in NATURAL_KEY_POSITIONS:
+                key, natural = NATURAL_KEY_POSITIONS[table]
+                values[key] = natural_key(*(values[position] for position in natural))
+            return record_type._make(values)
+
+    fields = extract_fields(table, body)
+    return record_type(**derive_columns(table, fields)) if fields else None
+
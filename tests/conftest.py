@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules live at the top level of the repository, next to this directory
+sys.path.insert(0, ROOT)
+
+# The sample backup shipped with the repository
+SAMPLE_XML = os.path.join(ROOT, 'sms.xml')
+
+
+@pytest.fixture(scope='session')
+def sample_database(tmp_path_factory):
+    """A database holding the sample backup, shared by the tests that only read it."""
+    # Imported here, once the modules are on the path
+    from ingest import ingest
+
+    database = str(tmp_path_factory.mktemp('sample') / 'momo_data.db')
+    ingest([SAMPLE_XML], database, workers=1)
+    return database
@@ -0,0 +1,107 @@
+import sqlite3
+import pytest
+from constants import CATEGORIES
+from init_db import bulk_insert, create_connection, create_tables
+from queries import parse_filters, view_columns
+from templates import TABLE_COLUMNS
+from test_init_db import bank_transfer
+
+pytest.importorskip('flask')
+import app  # noqa: E402
+
+
+def make_client(database, monkeypatch):
+    def get_db_connection():
+        conn = sqlite3.connect(database)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    monkeypatch.setattr(app, 'get_db_connection', get_db_connection)
+    return app.app.test_client()
+
+
+@pytest.fixture
+def client(sample_database, monkeypatch):
+    return make_client(sample_database, monkeypatch)
+
+
+def walk(client, path, **args):
+    """Reads every page of a list endpoint."""
+    results, after = [], None
+    while True:
+        response = client.get(path, query_string=dict(args, after=after) if after else args)
+        assert response.status_code == 200, response.get_json()
+        body = response.get_json()
+        results.extend(body['results'])
+        after = body['next']
+        if after is None:
+            return results
+
+
+COUNTERPARTY_TABLES = [table for table in CATEGORIES if CATEGORIES[table]['counterparty']]
+
+
+@pytest.mark.parametrize('filters, condition', [
+    ({}, ''),
+    ({'min_amount': 1000, 'to': '2024-10-01'}, "AND t.amount >= :min_amount AND t.ts < :to"),
+])
+@pytest.mark.parametrize('table', COUNTERPARTY_TABLES)
+def test_counterparties_endpoint_totals_each_counterparty(client, sample_database, table,
+                                                          filters, condition):
+    conn = sqlite3.connect(sample_database)
+    expected = {row[0]: row[1:] for row in conn.execute(
+        "SELECT c.id, c.kind, c.name, c.phone, ifnull(SUM(t.amount), 0), COUNT(*) "
+        "FROM transactions t JOIN counterparties c ON c.id = t.counterparty_id "
+        f"WHERE t.category = (SELECT id FROM categories WHERE name = :table) {condition} "
+        "GROUP BY c.id",
+        dict(parse_filters(filters), table=table))}
+    conn.close()
+    assert expected or filters
+
+    for sort in ('-total', 'total', '-count', 'count'):
+        results = walk(client, CATEGORIES[table]['route'] + '/counterparties', sort=sort, limit=7,
+                       **filters)
+
+        assert {row['id']: (row['kind'], row['name'], row['phone'], row['total'], row['count'])
+                for row in results} == expected
+        assert len(results) == len(expected)
+        keys = [(row[sort.lstrip('-')], row['id']) for row in results]
+        assert keys == sorted(keys, reverse=sort.startswith('-'))
+
+
+@pytest.mark.parametrize('args', [{}, {'min_amount': 1000, 'to': '2024-10-01'}])
+@pytest.mark.parametrize('sort', ['ts', '-ts'])
+@pytest.mark.parametrize('table', sorted(CATEGORIES))
+def test_pages_of_a_category_hold_every_row_once(client, sample_database, table, sort, args):
+    columns = view_columns(table)
+    conditions, params = ['1'], {}
+    for name, value in parse_filters(args).items():
+        column, operator = {'min_amount': ('amount', '>='), 'to': ('ts', '<')}[name]
+        conditions.append(f"{columns[column]} {operator} :{name}")
+        params[name] = value
+    conn = sqlite3.connect(sample_database)
+    conn.row_factory = sqlite3.Row
+    rows = [dict(row) for row in conn.execute(
+        f"SELECT * FROM {table} WHERE {' AND '.join(conditions)}", params)]
+    conn.close()
+    # Rows sharing a timestamp are ordered by transaction id
+    rows.sort(key=lambda row: (row[columns['ts']], row[columns['txid']]),
+              reverse=sort.startswith('-'))
+
+    assert walk(client, CATEGORIES[table]['route'], sort=sort, limit=3, **args) == rows
+
+
+@pytest.mark.parametrize('sort', ['ts', '-ts'])
+def test_pages_split_rows_sharing_a_timestamp(tmp_path, monkeypatch, sort):
+    database = str(tmp_path / 'momo_data.db')
+    with create_connection(database) as conn:
+        create_tables(conn)
+        # All at the same time
+        bulk_insert(conn, 'bank_transfers', [bank_transfer(txid) for txid in range(1, 11)],
+                    TABLE_COLUMNS['bank_transfers'])
+    conn.close()
+
+    results = walk(make_client(database, monkeypatch), CATEGORIES['bank_transfers']['route'],
+                   sort=sort, limit=3)
+    assert [row['transaction_id'] for row in results] \
+        == sorted(range(1, 11), reverse=sort.startswith('-'))
@@ -0,0 +1,83 @@
+import pytest
+from classifier import classify, classify_span
+from scraper import iter_sms_bodies
+from conftest import SAMPLE_XML
+
+# One body per category, as found in sms.xml
+BODIES = {
+    'airtime_payments':
+        "*162*TxId:13913173274*S*Your payment of 2000 RWF to Airtime with token  has been "
+        "completed at 2024-05-12 11:41:28. Fee was 0 RWF. Your new balance: 25280 RWF . "
+        "Message: - -. *EN#",
+    'cash_power_bill_payments':
+        "*162*TxId:14103506143*S*Your payment of 4000 RWF to MTN Cash Power with token "
+        "72962-79980-44699-06073 has been completed at 2024-05-26 13:31:00. Fee was 0 RWF. "
+        "Your new balance: 800 RWF . Message: - -. *EN#",
+    'internet_voice_bundles':
+        "*162*TxId:14324965479*S*Your payment of 2000 RWF to Bundles and Packs with token  has "
+        "been completed at 2024-06-11 06:26:11. Fee was 0 RWF. Your new balance: 350 RWF . "
+        "Message: - -. *EN#",
+    'payment_to_code_holders':
+        "TxId: 73214484437. Your payment of 1,000 RWF to Jane Smith 12845 has been completed at "
+        "2024-05-10 16:31:39. Your new balance: 1,000 RWF. Fee was 0 RWF.",
+    'bank_transfers':
+        "You have transferred 50000 RWF to Linda Green (250795963036) from your mobile money "
+        "account 20077201001 imbank.bank at 2024-10-23 09:59:01. Your new balance:  . Message "
+        "from sender: . Message to receiver: . Financial Transaction Id: 16664315282.",
+    'transfers_to_mobile_numbers':
+        "*165*S*10000 RWF transferred to Samuel Carter (250791666666) from 36521838 at "
+        "2024-05-11 20:34:47 . Fee was: 100 RWF. New balance: 28300 RWF.",
+    'incoming_money':
+        "You have received 2000 RWF from Jane Smith (*********013) on your mobile money account "
+        "at 2024-05-10 16:30:51. Message from sender: . Your new balance:2000 RWF. Financial "
+        "Transaction Id: 76662021700.",
+    'transactions_initiated_by_third_parties':
+        "*164*S*Y'ello,A transaction of 25000 RWF by DIRECT PAYMENT LTD  on your MOMO account "
+        "was successfully completed at 2024-05-14 21:01:00. Message from debit receiver: . "
+        "Your new balance:4060 RWF. Fee was 0 RWF. Financial Transaction Id: 14009802297.",
+    'withdrawals_from_agents':
+        "You Abebe Chala CHEBUDIE (*********036) have via agent: Agent Sophia (250790777777), "
+        "withdrawn 20000 RWF from your mobile money account: 36521838 at 2024-05-26 02:10:27 and "
+        "you can now collect your money in cash. Your new balance: 6400 RWF. Fee paid: 350 RWF. "
+        "Financial Transaction Id: 14098463509.",
+}
+
+
+@pytest.mark.parametrize('table', BODIES)
+def test_each_category_wins_its_own_bodies(table):
+    body = BODIES[table]
+
+    assert classify(body) == table
+    # The raw-bytes classifier used by the fast scanner agrees
+    raw = body.encode()
+    assert classify_span(raw, 0, len(raw)) == table
+
+
+@pytest.mark.parametrize('table', ['airtime_payments', 'cash_power_bill_payments',
+                                   'internet_voice_bundles'])
+def test_specific_payments_beat_your_payment_of(table):
+    assert 'Your payment of' in BODIES[table]
+    assert classify(BODIES[table]) == table
+
+
+def test_bank_transfers_beat_transferred_to():
+    # A bank transfer whose message repeats the mobile transfer wording
+    body = BODIES['bank_transfers'].replace("Message to receiver: .",
+                                            "Message to receiver: rent transferred to bank.")
+
+    assert 'transferred to' in body
+    assert classify(body) == 'bank_transfers'
+
+
+def test_withdrawn_is_a_last_resort():
+    # A body mentioning a withdrawal belongs to any other category it matches
+    for table, body in BODIES.items():
+        if table != 'withdrawals_from_agents':
+            assert classify(body + " Amount withdrawn: 0 RWF.") == table
+    assert classify("5000 RWF withdrawn from your account.") == 'withdrawals_from_agents'
+
+
+def test_sample_backup_has_bodies_of_every_category():
+    found = {classify(body) for body in iter_sms_bodies(SAMPLE_XML)}
+
+    assert found - {None} == set(BODIES)
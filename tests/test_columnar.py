@@ -0,0 +1,38 @@
+import os
+import sqlite3
+from array import array
+from columnar import export_database, read_metadata, write_columns
+from ingest import ingest
+from templates import TABLE_COLUMNS, epoch_seconds
+from conftest import SAMPLE_XML
+
+
+def test_account_ids_keep_their_text(tmp_path):
+    table = 'bank_transfers'
+    values = {'transaction_id': 1, 'amount': 5000, 'recipient_name': 'Jane Smith',
+              'recipient_phone': '250791666666', 'date': '2024-05-10 16:30:51',
+              'ts': epoch_seconds('2024-05-10 16:30:51')}
+    accounts = ['00123', '12345678901234567890123', 'RW-4411']
+    records = [tuple(dict(values, sender_account=account).get(column)
+                     for column in TABLE_COLUMNS[table]) for account in accounts]
+
+    assert write_columns(table, records, str(tmp_path)) == len(accounts)
+    assert read_metadata(table, str(tmp_path))['dictionaries']['sender_account'] == accounts
+
+
+def test_transfers_export_their_key(tmp_path):
+    database = str(tmp_path / 'momo_data.db')
+    directory = str(tmp_path / 'columnar')
+    ingest([SAMPLE_XML], database, workers=1)
+    export_database(database, directory)
+
+    table = 'transfers_to_mobile_numbers'
+    metadata = read_metadata(table, directory)
+    assert 'txid' in [column['name'] for column in metadata['columns']]
+    exported = array('q')
+    for month, rows in metadata['partitions'].items():
+        with open(os.path.join(directory, table, month, 'txid.bin'), 'rb') as f:
+            exported.fromfile(f, rows)
+    with sqlite3.connect(database) as conn:
+        stored = [txid for txid, in conn.execute(f"SELECT txid FROM {table}")]
+    assert sorted(exported) == sorted(stored)
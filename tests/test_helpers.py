@@ -0,0 +1,53 @@
+import gzip
+import json
+import os
+import pytest
+from helpers import JsonWriter, export_to_json
+
+RECORDS = [
+    {'txid': 1, 'amount': 2000, 'sender': 'Jane Smith', 'date': '2024-05-10 16:30:51'},
+    {'txid': 2, 'amount': None, 'sender': 'Ségolène "S" Uwase', 'date': '2024-05-11 08:00:00'},
+]
+
+
+@pytest.mark.parametrize('records', [RECORDS, RECORDS[:1], []])
+def test_json_writer_writes_what_json_dump_writes(tmp_path, records):
+    file_path = str(tmp_path / 'records.json')
+    with JsonWriter(file_path) as writer:
+        writer.write_all(records)
+
+    with open(file_path, encoding='utf-8') as f:
+        assert f.read() == json.dumps(records, indent=4)
+
+
+def test_json_writer_compact_ndjson_and_gzip(tmp_path):
+    compact = str(tmp_path / 'records.json')
+    ndjson = str(tmp_path / 'records.ndjson.gz')
+    export_to_json(RECORDS, compact, compact=True)
+    export_to_json(RECORDS, ndjson)
+
+    with open(compact, encoding='utf-8') as f:
+        assert f.read() == json.dumps(RECORDS, separators=(',', ':'))
+    with gzip.open(ndjson, 'rt', encoding='utf-8') as f:
+        assert [json.loads(line) for line in f] == RECORDS
+
+
+def test_aborted_write_leaves_the_previous_file(tmp_path):
+    file_path = str(tmp_path / 'records.json')
+    export_to_json(RECORDS, file_path)
+
+    def failing():
+        yield RECORDS[0]
+        raise ValueError('parse error')
+
+    with pytest.raises(ValueError):
+        export_to_json(failing(), file_path)
+
+    with open(file_path, encoding='utf-8') as f:
+        assert json.load(f) == RECORDS
+    assert os.listdir(tmp_path) == ['records.json']
+
+
+def test_export_to_json_is_quiet_by_default(tmp_path, capsys):
+    assert export_to_json(RECORDS, str(tmp_path / 'records.json')) == len(RECORDS)
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,85 @@
+import shutil
+import sqlite3
+from concurrent.futures import Future
+import ingest as ingest_module
+from ingest import find_backups, ingest, iter_ranges, parse_parallel, parse_range, split_ranges
+from scraper import scan_sms_records
+from conftest import SAMPLE_XML
+
+
+def test_overlapping_backups_are_written_once(tmp_path):
+    once = ingest([SAMPLE_XML], str(tmp_path / 'once.db'), workers=1)
+    copy = str(tmp_path / 'copy.xml')
+    shutil.copy(SAMPLE_XML, copy)
+
+    database = str(tmp_path / 'twice.db')
+    twice = ingest([SAMPLE_XML, copy], database, workers=1)
+
+    assert twice['records'] == once['records']
+    assert twice['duplicates'] == once['records'] + once.get('duplicates', 0)
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0] == once['records']
+
+
+def test_high_water_marks_follow_the_source_across_backup_files(tmp_path):
+    database = str(tmp_path / 'momo_data.db')
+    ingest([SAMPLE_XML], database, workers=1, source='phone')
+
+    # The next backup of the same phone, with a backup_set of its own
+    with open(SAMPLE_XML, 'rb') as f:
+        content = f.read()
+    newer = tmp_path / 'newer.xml'
+    newer.write_bytes(content.replace(b'backup_set="', b'backup_set="newer-', 1))
+
+    same_phone = ingest([str(newer)], database, workers=1, source='phone')
+    other_phone = ingest([str(newer)], database, workers=1, source='other phone')
+
+    # Skipped by the high-water marks, without a lookup in the dedupe index
+    assert same_phone == {'records': 0, 'duplicates': 0}
+    assert other_phone['records'] == 0 and other_phone['duplicates'] > 0
+
+
+def test_backups_of_two_phones_keep_their_own_high_water_marks(tmp_path):
+    with open(SAMPLE_XML, 'rb') as f:
+        content = f.read()
+    records = list(scan_sms_records(content))
+    header, footer = content[:records[0][0]], content[records[-1][1]:]
+    middle = records[len(records) // 2][0]
+
+    # Phone A's messages are all newer than phone B's, on the same SIM slot
+    backups = tmp_path / 'backups'
+    backups.mkdir()
+    (backups / 'phone_a.xml').write_bytes(header + content[middle:records[-1][1]] + footer)
+    database = str(tmp_path / 'momo_data.db')
+    first = ingest(find_backups([str(backups)]), database, workers=1)
+
+    (backups / 'phone_b.xml').write_bytes(header + content[records[0][0]:middle] + footer)
+    second = ingest(find_backups([str(backups)]), database, workers=1)
+
+    whole = ingest([SAMPLE_XML], str(tmp_path / 'whole.db'), workers=1)
+    assert second['records'] > 0
+    assert first['records'] + second['records'] == whole['records']
+
+
+def test_parse_parallel_matches_a_single_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_module, 'RANGE_SIZE', 64 * 1024)
+    assert list(parse_parallel(SAMPLE_XML, 2)) == list(parse_parallel(SAMPLE_XML, 1))
+
+
+def test_iter_ranges_keeps_only_a_few_ranges_in_flight(monkeypatch):
+    class Pool:
+        submitted = 0
+
+        def submit(self, fn, *args):
+            Pool.submitted += 1
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+
+    monkeypatch.setattr(ingest_module, 'RANGES_IN_FLIGHT', 2)
+    ranges = split_ranges(SAMPLE_XML, 10)
+    results = iter_ranges(Pool(), SAMPLE_XML, ranges)
+    first = next(results)
+    assert Pool.submitted == 2
+    assert first == parse_range(SAMPLE_XML, *ranges[0])
+    assert len(list(results)) == len(ranges) - 1
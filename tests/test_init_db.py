@@ -0,0 +1,189 @@
+import io
+import json
+import pytest
+from init_db import (REJECTS_SQL, Counterparties, bulk_insert, coerce_stored_integers,
+                     create_connection, create_tables, iter_json_array, reject_unstorable)
+from templates import TABLE_COLUMNS, parse_message
+
+BANK_TRANSFER = (
+    "You have transferred 50000 RWF to Linda Green (250795963036) from your mobile money "
+    "account 20077201001 imbank.bank at 2024-10-23 09:59:01. Your new balance:  . Message "
+    "from sender: . Message to receiver: . Financial Transaction Id: 16664315282.")
+
+
+@pytest.fixture
+def conn(tmp_path):
+    with create_connection(str(tmp_path / 'momo_data.db')) as conn:
+        create_tables(conn)
+        yield conn
+
+
+def bank_transfer(transaction_id, amount=50000):
+    record = parse_message('bank_transfers', BANK_TRANSFER)._asdict()
+    record.update(transaction_id=transaction_id, amount=amount)
+    return record
+
+
+def stored_amounts(conn):
+    return dict(conn.execute(
+        "SELECT transaction_id, amount FROM bank_transfers ORDER BY transaction_id").fetchall())
+
+
+@pytest.mark.parametrize('staging', [None, True, False])
+def test_bulk_insert_skips_stored_keys(conn, staging):
+    columns = TABLE_COLUMNS['bank_transfers']
+    first = [bank_transfer(transaction_id) for transaction_id in range(1, 6)]
+    assert bulk_insert(conn, 'bank_transfers', first, columns, batch_size=2) == 5
+
+    # Keys 4 and 5 are stored already: they keep their amount
+    second = [bank_transfer(transaction_id, 1) for transaction_id in range(4, 9)]
+    assert bulk_insert(conn, 'bank_transfers', second, columns, batch_size=2,
+                       staging=staging) == 3
+    assert stored_amounts(conn) == {1: 50000, 2: 50000, 3: 50000, 4: 50000, 5: 50000,
+                                    6: 1, 7: 1, 8: 1}
+    assert conn.execute("SELECT name FROM temp.sqlite_master").fetchall() == []
+
+
+def test_bulk_insert_skips_keys_repeated_within_a_load(conn):
+    records = [bank_transfer(1), bank_transfer(1, 1), bank_transfer(2)]
+
+    assert bulk_insert(conn, 'bank_transfers', records, TABLE_COLUMNS['bank_transfers'],
+                       staging=True) == 2
+    assert stored_amounts(conn) == {1: 50000, 2: 50000}
+
+
+# Small enough for chunks to end inside numbers, strings and separators
+CHUNK_SIZES = [1, 2, 3, 7, 64]
+ELEMENTS = [{'amount': 1234567, 'name': 'Linda "LG" Green'}, 12345, -1.5e3, "a, b]", [1, [2]],
+            None, True, {}]
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('text', [
+    json.dumps(ELEMENTS),
+    json.dumps(ELEMENTS, indent=4),
+    json.dumps(ELEMENTS, separators=(',', ':')) + '\n',
+    '[]', ' [ ] ', '[12345]', ' \n[ 12345 ]\n\n',
+])
+def test_json_arrays_are_read_across_chunk_boundaries(text, chunk_size):
+    assert list(iter_json_array(io.StringIO(text), chunk_size)) == json.loads(text)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('text', [
+    '', '{}', '[1, 2', '[1, 2,]', '[1 2]', '[1, 2]]', '[1, 2] 3', '[] []', '[1, 2]\n{"a": 1}',
+])
+def test_invalid_json_arrays_are_rejected(text, chunk_size):
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_array(io.StringIO(text), chunk_size))
+
+
+@pytest.fixture
+def legacy_conn(tmp_path):
+    """A database in the layout of the first release: a table per category."""
+    with create_connection(str(tmp_path / 'legacy.db')) as conn:
+        conn.execute(f"CREATE TABLE bank_transfers ({', '.join(TABLE_COLUMNS['bank_transfers'])})")
+        conn.execute(REJECTS_SQL)
+        yield conn
+
+
+def insert_legacy(conn, rows):
+    conn.executemany("INSERT INTO bank_transfers (transaction_id, amount, ts) VALUES (?, ?, ?)",
+                     rows)
+
+
+def rejected(conn):
+    return [(json.loads(record), reason) for record, reason in conn.execute(
+        "SELECT record, reason FROM rejected_records ORDER BY id")]
+
+
+def test_stored_integers_are_coerced_and_the_rest_rejected(legacy_conn):
+    insert_legacy(legacy_conn, [('1', '50,000', 1), (2, ' 1000 ', 2), (3, 2.0, 3), (4, None, 4),
+                                (5, 'abc', 5), ('6x', 7, 6)])
+
+    coerce_stored_integers(legacy_conn, 'bank_transfers')
+
+    rows = legacy_conn.execute(
+        "SELECT transaction_id, amount, typeof(transaction_id), typeof(amount) "
+        "FROM bank_transfers ORDER BY transaction_id").fetchall()
+    assert [tuple(row) for row in rows] == [
+        (1, 50000, 'integer', 'integer'), (2, 1000, 'integer', 'integer'),
+        (3, 2, 'integer', 'integer'), (4, None, 'integer', 'null')]
+    assert [(record['transaction_id'], reason) for record, reason in rejected(legacy_conn)] == [
+        (5, "amount: 'abc' is not an integer"), ('6x', "transaction_id: '6x' is not an integer")]
+
+
+def test_unstorable_rows_are_copied_to_the_rejects(legacy_conn):
+    insert_legacy(legacy_conn, [(1, 100, 1), (2, 200, None), (None, 300, 3), ('', 400, 4),
+                                ('4x', 500, 5), (6, 600, 6)])
+
+    assert reject_unstorable(legacy_conn, 'bank_transfers', 'bank_transfers') == 4
+    assert [record['amount'] for record, _ in rejected(legacy_conn)] == [200, 300, 400, 500]
+    # They are only copied, the migrations leave them behind
+    assert legacy_conn.execute("SELECT COUNT(*) FROM bank_transfers").fetchone()[0] == 6
+
+
+def test_counterparties_are_interned(conn):
+    counterparties = Counterparties(conn)
+    linda = counterparties.resolve('person', 'Linda Green', '250795963036')
+
+    assert counterparties.resolve('person', 'Linda Green', '250795963036') == linda
+    # Another phone, or another kind, is another counterparty
+    others = {counterparties.resolve('person', 'Linda Green', '250795963037'),
+              counterparties.resolve('agent', 'Linda Green', '250795963036'),
+              counterparties.resolve('person', 'Linda Green')}
+    assert len(others | {linda}) == 4
+    # An empty phone is no phone
+    assert counterparties.resolve('person', 'Linda Green', '') \
+        == counterparties.resolve('person', 'Linda Green', None)
+    assert counterparties.resolve('person', None, '250795963036') is None
+    assert conn.execute("SELECT COUNT(*) FROM counterparties").fetchone()[0] == 4
+
+    # A new map starts from the stored ones
+    assert Counterparties(conn).resolve('person', 'Linda Green', '250795963036') == linda
+
+
+def test_rows_are_written_with_their_counterparty(conn):
+    records = [bank_transfer(1), bank_transfer(2), bank_transfer(3)]
+    records[2]['recipient_phone'] = '250795963037'
+    bulk_insert(conn, 'bank_transfers', records, TABLE_COLUMNS['bank_transfers'])
+
+    rows = conn.execute("SELECT t.txid, c.kind, c.name, c.phone FROM transactions t "
+                        "JOIN counterparties c ON c.id = t.counterparty_id ORDER BY t.txid")
+    assert [tuple(row) for row in rows] == [
+        (1, 'person', 'Linda Green', '250795963036'), (2, 'person', 'Linda Green', '250795963036'),
+        (3, 'person', 'Linda Green', '250795963037')]
+
+
+def totals(conn):
+    return {tuple(row) for row in conn.execute(
+        "SELECT category, counterparty_id, total, count FROM counterparty_totals")}
+
+
+def grouped_totals(conn):
+    return {tuple(row) for row in conn.execute(
+        "SELECT category, counterparty_id, ifnull(SUM(amount), 0), COUNT(*) FROM transactions "
+        "WHERE counterparty_id IS NOT NULL GROUP BY category, counterparty_id")}
+
+
+def test_counterparty_totals_follow_the_transactions(conn):
+    records = [bank_transfer(txid, 1000 * txid) for txid in range(1, 6)]
+    records[4]['amount'] = None
+    records[3]['recipient_phone'] = '250795963037'
+    bulk_insert(conn, 'bank_transfers', records, TABLE_COLUMNS['bank_transfers'])
+    # Already stored: counted once
+    bulk_insert(conn, 'bank_transfers', records, TABLE_COLUMNS['bank_transfers'])
+    assert sorted(total[2:] for total in totals(conn)) == [(4000, 1), (6000, 4)]
+
+    with conn:
+        conn.execute("UPDATE transactions SET amount = 10 WHERE txid = 1")
+        conn.execute("UPDATE transactions SET counterparty_id = "
+                     "(SELECT counterparty_id FROM transactions WHERE txid = 4) WHERE txid = 2")
+        conn.execute("DELETE FROM transactions WHERE txid = 3")
+    assert sorted(total[2:] for total in totals(conn)) == [(10, 2), (6000, 2)]
+    assert totals(conn) == grouped_totals(conn)
+
+    with conn:
+        conn.execute("DELETE FROM transactions WHERE txid IN (1, 5)")
+    assert totals(conn) == grouped_totals(conn)
+    assert len(totals(conn)) == 1
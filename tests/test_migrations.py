@@ -0,0 +1,53 @@
+import os
+import shutil
+import sqlite3
+import pytest
+import init_db
+from init_db import MIGRATIONS, create_connection, create_tables
+from migrations import schema_version
+from test_init_db import grouped_totals, totals
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Still in the layout of the first release: a table per category
+LEGACY_DATABASE = os.path.join(REPO, 'momo_data.db')
+
+
+def test_legacy_database_is_migrated(tmp_path):
+    database = str(tmp_path / 'momo_data.db')
+    shutil.copy(LEGACY_DATABASE, database)
+
+    with create_connection(database) as conn:
+        create_tables(conn)
+        assert schema_version(conn) == MIGRATIONS[-1].version
+        assert conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0] > 0
+        # Counted again after the migrations that rebuilt transactions
+        assert totals(conn) == grouped_totals(conn)
+
+
+def test_interrupted_batched_migration_resumes(tmp_path, monkeypatch):
+    def migrate(database, interrupt_after=None):
+        shutil.copy(LEGACY_DATABASE, database)
+        with create_connection(database) as conn:
+            if interrupt_after is not None:
+                step = MIGRATIONS[2].step
+
+                def interrupted(conn, position=None):
+                    for batch, progress in enumerate(step(conn, position)):
+                        if batch == interrupt_after:
+                            raise sqlite3.OperationalError('interrupted')
+                        yield progress
+
+                migrations = list(MIGRATIONS)
+                migrations[2] = migrations[2]._replace(step=interrupted)
+                monkeypatch.setattr(init_db, 'MIGRATIONS', migrations)
+                with pytest.raises(sqlite3.OperationalError, match='interrupted'):
+                    create_tables(conn)
+                monkeypatch.setattr(init_db, 'MIGRATIONS', MIGRATIONS)
+            create_tables(conn)
+            return sorted(map(tuple, conn.execute("SELECT * FROM transactions")))
+
+    whole = migrate(str(tmp_path / 'whole.db'))
+    monkeypatch.setattr(init_db, 'BATCH_SIZE', 50)
+    resumed = migrate(str(tmp_path / 'resumed.db'), interrupt_after=10)
+
+    assert resumed == whole
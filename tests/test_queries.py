@@ -0,0 +1,38 @@
+import sqlite3
+import pytest
+from ingest import ingest
+from queries import full_scans, parse_filters
+from templates import epoch_seconds
+from conftest import SAMPLE_XML
+
+
+def test_parse_filters_converts_dates_and_amounts():
+    filters = parse_filters({'from': '2024-01-01', 'to': '2024-01-01T00:00:00+02:00',
+                             'min_amount': '1000', 'max_amount': ''})
+
+    # Kigali is UTC+2, so both spellings are the same moment
+    assert filters == {'from': 1704060000, 'to': 1704060000, 'min_amount': 1000}
+    assert epoch_seconds('2024-01-01T00:00:00Z') == 1704067200
+
+
+@pytest.mark.parametrize('args', [
+    {'from': 'yesterday'},
+    {'to': '2024-13-01'},
+    {'min_amount': '1.5'},
+    {'min_amount': '99999999999999999999999'},
+    {'counterparty': str(-2 ** 63 - 1)},
+])
+def test_parse_filters_rejects_invalid_values(args):
+    with pytest.raises(ValueError):
+        parse_filters(args)
+
+
+def test_every_filter_combination_searches_an_index(tmp_path):
+    database = str(tmp_path / 'momo_data.db')
+    ingest([SAMPLE_XML], database, workers=1)
+
+    conn = sqlite3.connect(database)
+    try:
+        assert full_scans(conn) == []
+    finally:
+        conn.close()
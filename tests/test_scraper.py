@@ -0,0 +1,50 @@
+import pytest
+from scraper import iter_sms_fast, parse_sms_records
+
+BODY = ("You have received 2000 RWF from Jane Smith (*********013) on your mobile money "
+        "account at 2024-05-10 16:30:51. Message from sender: . Your new balance:2000 RWF. "
+        "Financial Transaction Id: 76662021700.")
+
+ATTRIBUTES = f'address="M-Money" date="1715351458724" body="{BODY}" sub_id="6"'
+
+RECORD_FORMS = {
+    'self-closing': f'<sms {ATTRIBUTES} />',
+    'with end tag': f'<sms {ATTRIBUTES}></sms>',
+}
+
+
+def backup(*records: str) -> bytes:
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<smses count="%d">\n  %s\n</smses>\n'
+            % (len(records), '\n  '.join(records))).encode()
+
+
+@pytest.mark.parametrize('record', RECORD_FORMS.values(), ids=RECORD_FORMS.keys())
+def test_iter_sms_fast_reads_both_record_forms(tmp_path, record):
+    file_path = tmp_path / 'sms.xml'
+    file_path.write_bytes(backup(record, record))
+
+    assert list(iter_sms_fast(str(file_path))) == [{'body': BODY, 'date': '1715351458724'}] * 2
+
+
+@pytest.mark.parametrize('record', RECORD_FORMS.values(), ids=RECORD_FORMS.keys())
+def test_parse_sms_records_reads_both_record_forms(record):
+    buffer = backup(record, RECORD_FORMS['self-closing'])
+    parsed = list(parse_sms_records(buffer, memoryview(buffer), seen=set()))
+
+    assert [table for table, _, _ in parsed] == ['incoming_money'] * 2
+    assert [fields.txid for _, fields, _ in parsed] == [76662021700] * 2
+    # Both forms hash the same message the same way
+    assert parsed[0][2] == parsed[1][2]
+
+
+def test_message_hash_ignores_how_the_body_is_escaped():
+    escaped = ATTRIBUTES.replace('Jane Smith', 'Jane {} Smith')
+    records = [template.format(escaped.format(ampersand))
+               for template in ('<sms {} />', '<sms {}></sms>')
+               for ampersand in ('&amp;', '&#38;', '&#x26;')]
+    buffer = backup(*records)
+    parsed = list(parse_sms_records(buffer, memoryview(buffer), seen=set()))
+
+    assert len(parsed) == len(records)
+    assert {fields.sender for _, fields, _ in parsed} == {'Jane & Smith'}
+    assert len({digest for _, _, digest in parsed}) == 1
@@ -0,0 +1,36 @@
+import pytest
+from templates import TABLE_COLUMNS, epoch_seconds
+
+numpy = pytest.importorskip('numpy')
+from store import TransactionStore  # noqa: E402
+
+TABLE = 'payment_to_code_holders'
+
+
+def payment(transaction_id, date, amount, fee):
+    values = {'transaction_id': transaction_id, 'amount': amount, 'recipient': 'Jane Smith',
+              'date': date, 'new_balance': 0, 'fee': fee, 'ts': epoch_seconds(date)}
+    return tuple(values[column] for column in TABLE_COLUMNS[TABLE])
+
+
+@pytest.fixture
+def store():
+    store = TransactionStore()
+    store.append(TABLE, [
+        payment(1, '2024-05-01 10:00:00', 2 ** 53 + 1, 100),
+        payment(2, '2024-05-01 11:00:00', 1, None),
+        payment(3, '2024-06-02 09:00:00', None, 20),
+    ])
+    return store
+
+
+def test_totals_leave_out_null_values(store):
+    assert store.totals(TABLE, 'fee') == (120, 2)
+    assert store.totals(TABLE) == (2 ** 53 + 2, 2)
+
+
+def test_group_by_sums_exactly_and_leaves_out_null_values(store):
+    # 2**53 + 2 is not a float64: a float sum would round it
+    assert store.group_by(TABLE, 'day') == {'2024-05-01': (2 ** 53 + 2, 2)}
+    assert store.group_by(TABLE, 'month', column='fee') == {'2024-05': (100, 1),
+                                                              '2024-06': (20, 1)}
@@ -0,0 +1,58 @@
+import time
+import pytest
+from templates import MATCHERS, coerce_integers, natural_key, parse_message
+from tokenizer import extract_fields
+
+
+def test_natural_key_is_stable_negative_and_exact_in_javascript():
+    key = natural_key(1715452487, 10000, '250791666666')
+
+    assert key == natural_key(1715452487, 10000, '250791666666')
+    assert key != natural_key(1715452487, 10000, '250791666667')
+    assert -2 ** 53 < key < 0
+
+
+@pytest.mark.parametrize('body, fee', [
+    ("TxId: 73214484437. Your payment of 1,000 RWF to Jane Smith 12845 has been completed at "
+     "2024-05-10 16:31:39. Your new balance: 1,000 RWF. Fee was 0 RWF.Kanda*182*16#", 0),
+    ("*162*TxId:14977177408*S*Your payment of 673000 RWF to ONAFRIQ MAURITIUS with token  has "
+     "been completed at 2024-07-26 15:16:04. Fee was 8000 RWF. Your new balance: 4950 RWF . "
+     "Message: - Transaction has been processed successfully. *EN#", 8000),
+    ("Your payment of 8000 RWF to Cynthia UMUGANWA (250790698110) has been completed at "
+     "2024-10-29 13:18:05. Message: . Your new balance: 36282 RWF. Fee was 0 RWF. The amount was "
+     "subject to a discount of 0 RWF and coupons worth . Financial Transaction Id: 1651934588.", 0),
+])
+def test_payments_to_code_holders_capture_the_fee(body, fee):
+    assert parse_message('payment_to_code_holders', body).fee == fee
+    # The tokenizer, for messages that match no template
+    assert extract_fields('payment_to_code_holders', body)['fee'] == fee
+
+
+def test_templates_fail_in_linear_time():
+    # Every skip and text field has many places to stop at, none of them right
+    body = "TxId:1*S*Your payment of 1 RWF to X with token " * 800
+
+    start = time.perf_counter()
+    for table, matchers in MATCHERS.items():
+        for pattern, _ in matchers:
+            assert pattern.match(body) is None
+    # Minutes with lazy skips backtracking into each other
+    assert time.perf_counter() - start < 2
+
+
+def test_integer_columns_are_coerced():
+    record = coerce_integers('withdrawals_from_agents', {
+        'amount': '20,000', 'new_balance': ' 6400 ', 'fee': 350.0, 'transaction_id': '14098463509',
+        'account': '36521838', 'name': None})
+
+    assert record == {'amount': 20000, 'new_balance': 6400, 'fee': 350,
+                      'transaction_id': 14098463509, 'account': '36521838', 'name': None}
+
+
+@pytest.mark.parametrize('column, value', [
+    ('amount', '20,000.50'), ('amount', 350.5), ('amount', 'abc'), ('amount', ''),
+    ('transaction_id', '1,000'), ('transaction_id', '14098463509x'),
+])
+def test_values_that_are_not_whole_numbers_are_rejected(column, value):
+    with pytest.raises(ValueError, match=column):
+        coerce_integers('withdrawals_from_agents', {column: value})
@@ -0,0 +1,52 @@
+from collections import defaultdict
+import pytest
+from classifier import classify
+from scraper import iter_sms_bodies
+from templates import RECORD_MATCHERS, RECORD_TYPES, derive_columns, parse_message
+from tokenizer import extract_fields, tokenize
+from conftest import SAMPLE_XML
+
+
+def sample_bodies():
+    bodies = defaultdict(list)
+    for body in iter_sms_bodies(SAMPLE_XML):
+        table = classify(body)
+        if table in RECORD_TYPES:
+            bodies[table].append(body)
+    return bodies
+
+
+SAMPLE_BODIES = sample_bodies()
+
+
+def tokenizer_record(table, body):
+    fields = extract_fields(table, body)
+    return RECORD_TYPES[table](**derive_columns(table, fields)) if fields else None
+
+
+def test_tokens_are_typed():
+    tokens = list(tokenize("Your payment of 1,000 RWF to Jane Smith 12845 has been completed at "
+                           "2024-05-10 16:31:39. Your new balance: 1,000 RWF. Fee was 0 RWF."))
+
+    assert tokens == [('AMOUNT', 1000), ('NAME', 'Jane Smith 12845'),
+                      ('TIMESTAMP', '2024-05-10 16:31:39'), ('BALANCE', 1000), ('FEE', 0)]
+
+
+@pytest.mark.parametrize('table', sorted(RECORD_TYPES))
+def test_tokenizer_agrees_with_the_templates(table):
+    matched = [body for body in SAMPLE_BODIES[table]
+               if any(pattern.match(body) for pattern, _, _ in RECORD_MATCHERS[table])]
+
+    assert matched
+    for body in matched:
+        assert tokenizer_record(table, body) == parse_message(table, body), body
+
+
+@pytest.mark.parametrize('table', sorted(RECORD_TYPES))
+def test_messages_no_template_matches_fall_back_to_the_tokenizer(table):
+    for body in SAMPLE_BODIES[table]:
+        # A reworded message that none of the templates expect
+        changed = body.replace(' at 20', ' on 20', 1)
+
+        assert not any(pattern.match(changed) for pattern, _, _ in RECORD_MATCHERS[table])
+        assert parse_message(table, changed) == tokenizer_record(table, body), body
@@ -0,0 +1,171 @@
+import re
+from typing import Dict, Iterator, List, Tuple
+
+# Token kinds, in the order they are tried at each position. Fee and balance
+# amounts are claimed by FEE / BALANCE before AMOUNT gets a chance to see them.
+TOKEN_PATTERNS = [
+    ('TXID', r"(?:TxId:|Financial Transaction Id:)\s*(\d+)"),
+    ('EXTERNAL_ID', r"External Transaction Id:\s*([\w-]+)"),
+    ('FEE', r"Fee (?:was|paid):?\s*(\d[\d,]*) RWF"),
+    ('BALANCE', r"(?i:balance)\s*:\s*(\d[\d,]*) RWF"),
+    ('AMOUNT', r"(\d[\d,]*) RWF"),
+    ('TIMESTAMP', r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})"),
+    ('PHONE', r"\(([\d*]+)\)"),
+    ('TOKEN', r"with token ([\d-]*)"),
+    ('ACCOUNT', r"(?:account:?|from) (\d{5,})\b"),
+    # Names are bounded so a failed attempt never scans more than 60 chars
+    ('NAME', r"\b(?:to|from|by|You|agent:) ([A-Z][\w.' -]{0,60}?)"
+             r"(?=\s*\(|\s+(?:with token|has been|on your))"),
+]
+
+# Tokens only start at the beginning of a word (or at a '('), and only with one
+# of the characters below. Checking that first lets the scanner skip most
+# positions without trying every alternative.
+TOKEN_START = r"(?<![\w,])(?=[TFEfBbtaYw\d(])"
+
+SCANNER = re.compile(TOKEN_START + '(?:' + '|'.join(
+    f"(?P<{kind}>{pattern})" for kind, pattern in TOKEN_PATTERNS) + ')')
+
+# Index of the capturing group holding each token's value
+VALUE_GROUP = {kind: SCANNER.groupindex[kind] + 1 for kind, _ in TOKEN_PATTERNS}
+
+MONEY_TOKENS = {'FEE', 'BALANCE', 'AMOUNT'}
+
+# Token kinds converted with int(): money (above, once its commas are
+# stripped) and transaction ids
+INTEGER_TOKENS = MONEY_TOKENS | {'TXID'}
+
+# Category field -> (token kind, occurrence). Fields match the templates in
+# constants.CATEGORIES.
+FIELD_MAP = {
+    'airtime_payments': {
+        'txid': ('TXID', 0),
+        'payment_amount': ('AMOUNT', 0),
+        'date': ('TIMESTAMP', 0),
+        'fee': ('FEE', 0),
+        'new_balance': ('BALANCE', 0),
+    },
+    'incoming_money': {
+        'txid': ('TXID', 0),
+        'amount_received': ('AMOUNT', 0),
+        'sender': ('NAME', 0),
+        'sender_phone': ('PHONE', 0),
+        'date': ('TIMESTAMP', 0),
+        'new_balance': ('BALANCE', 0),
+    },
+    'transfers_to_mobile_numbers': {
+        'amount_transferred': ('AMOUNT', 0),
+        'recipient': ('NAME', 0),
+        'recipient_number': ('PHONE', 0),
+        'sender_account': ('ACCOUNT', 0),
+        'date': ('TIMESTAMP', 0),
+        'fee': ('FEE', 0),
+        'new_balance': ('BALANCE', 0),
+    },
+    'cash_power_bill_payments': {
+        'transaction_id': ('TXID', 0),
+        'payment_amount': ('AMOUNT', 0),
+        'provider': ('NAME', 0),
+        'token': ('TOKEN', 0),
+        'date': ('TIMESTAMP', 0),
+        'fee': ('FEE', 0),
+        'new_balance': ('BALANCE', 0),
+    },
+    'withdrawals_from_agents': {
+        'name': ('NAME', 0),
+        'agent_name': ('NAME', 1),
+        'agent_number': ('PHONE', 1),
+        'account': ('ACCOUNT', 0),
+        'amount': ('AMOUNT', 0),
+        'date': ('TIMESTAMP', 0),
+        'fee': ('FEE', 0),
+        'new_balance': ('BALANCE', 0),
+        'transaction_id': ('TXID', 0),
+    },
+    'internet_voice_bundles': {
+        'transaction_id': ('TXID', 0),
+        'amount': ('AMOUNT', 0),
+        'service': ('NAME', 0),
+        'date': ('TIMESTAMP', 0),
+        'new_balance': ('BALANCE', 0),
+    },
+    'payment_to_code_holders': {
+        'transaction_id': ('TXID', 0),
+        'amount': ('AMOUNT', 0),
+        'recipient': ('NAME', 0),
+        'date': ('TIMESTAMP', 0),
+        'fee': ('FEE', 0),
+        'new_balance': ('BALANCE', 0),
+    },
+    'bank_transfers': {
+        'transaction_id': ('TXID', 0),
+        'amount': ('AMOUNT', 0),
+        'recipient_name': ('NAME', 0),
+        'recipient_phone': ('PHONE', 0),
+        'sender_account': ('ACCOUNT', 0),
+        'date': ('TIMESTAMP', 0),
+    },
+    'transactions_initiated_by_third_parties': {
+        'transaction_id': ('TXID', 0),
+        'external_transaction_id': ('EXTERNAL_ID', 0),
+        'amount': ('AMOUNT', 0),
+        'sender': ('NAME', 0),
+        'date': ('TIMESTAMP', 0),
+        'fee': ('FEE', 0),
+        'new_balance': ('BALANCE', 0),
+    },
+}
+
+
+def tokenize(body: str) -> Iterator[Tuple[str, str | int]]:
+    """
+    Walks an SMS body once and emits its typed tokens.
+
+    Args:
+        body (str): The SMS body.
+
+    Yields:
+        Tuple[str, str | int]: (token kind, value). Money values and
+        transaction ids are integers (thousands separators stripped),
+        everything else is a string.
+    """
+    for match in SCANNER.finditer(body):
+        kind = match.lastgroup
+        value = match.group(VALUE_GROUP[kind])
+        if kind in INTEGER_TOKENS:
+            value = int(value.replace(',', ''))
+        yield kind, value
+
+
+def extract_fields(table: str, body: str) -> Dict[str, str | int] | None:
+    """
+    Maps the tokens of an SMS body onto the fields of a category.
+
+    Args:
+        table (str): The category (a key of constants.CATEGORIES).
+        body (str): The SMS body.
+
+    Returns:
+        Dict[str, str | int] | None: The category fields, or None if a field
+        has no matching token.
+    """
+    # Same walk as tokenize(), inlined because this is the per-message hot path
+    tokens: Dict[str, List[str | int]] = {}
+    for match in SCANNER.finditer(body):
+        kind = match.lastgroup
+        value = match.group(VALUE_GROUP[kind])
+        if kind in INTEGER_TOKENS:
+            value = int(value.replace(',', ''))
+        if kind in tokens:
+            tokens[kind].append(value)
+        else:
+            tokens[kind] = [value]
+
+    fields = {}
+    for field, (kind, occurrence) in FIELD_MAP[table].items():
+        values = tokens.get(kind, [])
+        if occurrence >= len(values):
+            return None
+        fields[field] = values[occurrence]
+
+    return fields